@@ -14,6 +14,8 @@
 #include "RooProduct.h"
 #include "RooConstVar.h"
 #include "CombineHarvester/CombineTools/interface/Logging.h"
+#include "CombineHarvester/CombineTools/interface/FilterQuery.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
 
 namespace ch {
 
@@ -27,7 +29,7 @@ CMSHistFuncFactory::CMSHistFuncFactory() : v_(1), hist_mode_(0), rebin_(true) {}
 
 void CMSHistFuncFactory::Run(ch::CombineHarvester &cb, RooWorkspace &ws, std::map<std::string, std::string> process_vs_norm_postfix_map) {
   for (auto const& bin : cb.bin_set()) {
-    for (auto const& proc : cb.cp().bin({bin}).process_set()) {
+    for (auto const& proc : cb.partition(bin).process_set()) {
       if (v_) {
         std::cout << ">> Processing " << bin << "," << proc << "\n";
       }
@@ -41,7 +43,7 @@ void CMSHistFuncFactory::Run(ch::CombineHarvester &cb, RooWorkspace &ws, std::ma
       }
       RunSingleProc(cb, ws, bin, proc);
     }
-    TH1F data_hist = cb.cp().bin({bin}).GetObservedShape();
+    TH1F data_hist = cb.partition(bin).GetObservedShape();
     if (rebin_) data_hist = RebinHist(data_hist);
     // data_hist.Print("range");
 
@@ -51,7 +53,7 @@ void CMSHistFuncFactory::Run(ch::CombineHarvester &cb, RooWorkspace &ws, std::ma
 
     ws.import(rdh_dat);
 
-    cb.cp().bin({bin}).ForEachObs([&](ch::Observation * p) {
+    cb.partition(bin).ForEachObs([&](ch::Observation * p) {
       p->set_shape(nullptr, false);
       p->set_rate(1.0);
     });
@@ -74,7 +76,7 @@ void CMSHistFuncFactory::RunSingleProc(CombineHarvester& cb, RooWorkspace& ws,
   TString key = bin + "_" + process;
 
 
-  CombineHarvester cbp = cb.cp().bin({bin}).process({process});
+  CombineHarvester cbp = cb.query().bin({bin}).process({process}).cp();
   vector<string> m_str_vec = Set2Vec(cbp.SetFromProcs(
       std::mem_fn(&ch::Process::mass)));
   unsigned m = m_str_vec.size();
@@ -143,19 +145,19 @@ void CMSHistFuncFactory::RunSingleProc(CombineHarvester& cb, RooWorkspace& ws,
     // Now let's fill some of these arrays...
     for (unsigned mi = 0; mi < m; ++mi) {
       // The ch::Process pointers
-      cbp.cp().mass({m_str_vec[mi]}).ForEachProc([&](ch::Process *p) {
+      cbp.query().mass({m_str_vec[mi]}).ForEachProc([&](ch::Process *p) {
         pr_arr[mi] = p;
       });
       for (unsigned ssi = 0; ssi < ss; ++ssi) {
         // The ch::Systematic pointers for shape systematics
-        cbp.cp().mass({m_str_vec[mi]}).syst_name({ss_vec[ssi]})
+        cbp.query().mass({m_str_vec[mi]}).syst_name({ss_vec[ssi]})
           .ForEachSyst([&](ch::Systematic *n) {
               ss_arr[ssi][mi] = n;
           });
       }
       for (unsigned lsi = 0; lsi < ls; ++lsi) {
         // The ch::Systematic pointers for lnN systematics
-        cbp.cp().mass({m_str_vec[mi]}).syst_name({ls_vec[lsi]})
+        cbp.query().mass({m_str_vec[mi]}).syst_name({ls_vec[lsi]})
           .ForEachSyst([&](ch::Systematic *n) {
               ls_arr[lsi][mi] = n;
           });
@@ -0,0 +1,149 @@
+#include <chrono>
+#include <fstream>
+#include <iostream>
+#include <memory>
+#include <string>
+#include <vector>
+#include "TSystem.h"
+#include "boost/algorithm/string.hpp"
+#include "boost/format.hpp"
+#include "boost/program_options.hpp"
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/DatacardTokens.h"
+#include "CombineHarvester/CombineTools/interface/zstr.hpp"
+
+namespace po = boost::program_options;
+
+using namespace std;
+
+namespace {
+typedef std::vector<std::vector<std::string>> Words;
+
+// The tokenization used by ParseDatacard before DatacardTokens: read the
+// lines into strings, trim and split each one, then make the keyword passes
+// over the words with boost::iequals
+Words LegacyTokenize(string const& filename, unsigned *n_keywords) {
+  vector<string> lines;
+  unique_ptr<istream> file;
+  if (boost::ends_with(filename, ".gz")) {
+    file = unique_ptr<istream>(new zstr::ifstream(filename));
+  } else {
+    file = unique_ptr<istream>(new ifstream(filename));
+  }
+  string line;
+  while (getline(*file, line)) lines.push_back(line);
+  Words words;
+  for (unsigned i = 0; i < lines.size(); ++i) {
+    boost::trim(lines[i]);
+    if (lines[i].size() == 0) continue;
+    if (lines[i].at(0) == '#' || lines[i].at(0) == '-') continue;
+    words.push_back(vector<string>());
+    boost::split(words.back(), lines[i], boost::is_any_of("\t "),
+                 boost::token_compress_on);
+  }
+  unsigned n = 0;
+  for (auto const& w : words) {
+    if (w.size() > 1 && boost::iequals(w[0], "shapes")) ++n;
+  }
+  for (auto const& w : words) {
+    if (w.size() >= 3 && boost::iequals(w[1], "extArg")) ++n;
+  }
+  for (auto const& w : words) {
+    if (w.size() <= 1) continue;
+    if (boost::iequals(w[0], "observation")) ++n;
+    if (boost::iequals(w[0], "rate")) ++n;
+    if (boost::iequals(w[0], "process")) ++n;
+    if (boost::iequals(w[0], "bin")) ++n;
+    if (boost::iequals(w[1], "param")) ++n;
+    if (boost::iequals(w[1], "rateParam")) ++n;
+    if (boost::iequals(w[1], "group")) ++n;
+    if (boost::iequals(w[1], "autoMCStats")) ++n;
+  }
+  *n_keywords = n;
+  return words;
+}
+
+bool SameWords(Words const& legacy, ch::DatacardTokens const& tokens) {
+  if (legacy.size() != tokens.size()) return false;
+  for (unsigned i = 0; i < legacy.size(); ++i) {
+    if (legacy[i].size() != tokens[i].size()) return false;
+    for (unsigned p = 0; p < legacy[i].size(); ++p) {
+      if (tokens[i][p] != legacy[i][p]) return false;
+    }
+  }
+  return true;
+}
+
+template <typename Function>
+double TimeIt(unsigned repeat, Function func) {
+  auto start = chrono::steady_clock::now();
+  for (unsigned i = 0; i < repeat; ++i) func();
+  chrono::duration<double> elapsed = chrono::steady_clock::now() - start;
+  return elapsed.count() / double(repeat);
+}
+}
+
+int main(int argc, char* argv[]){
+  vector<string> datacards;
+  string mass       = "";
+  unsigned repeat   = 3;
+  bool parse        = true;
+
+  gSystem->Load("libHiggsAnalysisCombinedLimit.dylib");
+
+  po::options_description config("Configuration");
+  config.add_options()
+    ("help,h", "produce help message")
+    ("input,i",  po::value<vector<string>>(&datacards)->required()->multitoken(),
+        "The datacard .txt or .txt.gz files [REQUIRED]")
+    ("mass,m",   po::value<string>(&mass)->default_value(""),
+        "Signal mass point of the input datacards")
+    ("repeat,n", po::value<unsigned>(&repeat)->default_value(repeat),
+        "Number of times each measurement is repeated")
+    ("parse",    po::value<bool>(&parse)->default_value(parse)->implicit_value(true),
+        "Also time the complete ParseDatacard");
+
+  po::variables_map vm;
+  po::store(po::command_line_parser(argc, argv).options(config).run(), vm);
+  if (vm.count("help")) {
+    cout << config << "\n";
+    cout << "Example usage: " << endl;
+    cout << "BenchmarkDatacardParser -i combined.txt.gz -n 5\n";
+    return 1;
+  }
+  po::notify(vm);
+  if (repeat == 0) repeat = 1;
+
+  cout << boost::format("%-40s %10s %12s %12s %8s %12s %10s\n") %
+              "datacard" % "lines" % "legacy [s]" % "tokens [s]" % "speedup" %
+              "parse [s]" % "objects";
+  int ret = 0;
+  for (auto const& card : datacards) {
+    unsigned n_keywords = 0;
+    Words legacy;
+    double t_legacy =
+        TimeIt(repeat, [&]() { legacy = LegacyTokenize(card, &n_keywords); });
+    double t_tokens = TimeIt(repeat, [&]() { ch::DatacardTokens tokens(card); });
+    ch::DatacardTokens tokens(card);
+    if (!SameWords(legacy, tokens)) {
+      cout << "ERROR: tokens differ from the legacy tokenization for " << card
+           << "\n";
+      ret = 1;
+    }
+    double t_parse = 0.;
+    unsigned n_objects = 0;
+    if (parse) {
+      t_parse = TimeIt(repeat, [&]() {
+        ch::CombineHarvester cb;
+        cb.ParseDatacard(card, "", "", "", 0, mass);
+        n_objects = 0;
+        cb.ForEachObj([&](ch::Object const*) { ++n_objects; });
+      });
+    }
+    cout << boost::format("%-40s %10i %12.4f %12.4f %8.2f %12.4f %10i\n") %
+                card % tokens.size() % t_legacy % t_tokens %
+                (t_tokens > 0. ? t_legacy / t_tokens : 0.) % t_parse %
+                n_objects;
+  }
+  return ret;
+}
@@ -1,6 +1,8 @@
 #ifndef CombineTools_BinByBin_h
 #define CombineTools_BinByBin_h
+#include <ostream>
 #include <string>
+#include <vector>
 #include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
 
 namespace ch {
@@ -16,6 +18,11 @@ namespace ch {
  *     bbb.MergeBinErrors(cb.cp().backgrounds());
  *     bbb.AddBinByBin(cb.cp().backgrounds(), cb);
  * 
+ * Both methods can process independent analysis bins and processes in
+ * parallel (\ref SetThreads). For large numbers of bin-by-bin systematics
+ * the up and down templates can be stored as single-bin changes of the
+ * nominal template instead of full copies (\ref SetSparseShapes).
+ *
  * See below for details on each class method.
  */
 class BinByBinFactory {
@@ -150,6 +157,33 @@ class BinByBinFactory {
     return *this;
   }
 
+  /**
+   * Set the number of threads used by MergeBinErrors and AddBinByBin
+   *
+   * With more than one thread the bins are merged in parallel, and the
+   * systematics for different processes are created in parallel before
+   * being added to the destination in the same order as in serial mode.
+   * The results do not depend on the number of threads.
+   */
+  inline BinByBinFactory& SetThreads(unsigned n_threads) {
+    n_threads_ = n_threads;
+    return *this;
+  }
+
+  /**
+   * Store the bin-by-bin up and down templates as single-bin changes of
+   * a nominal template shared by all the systematics of a process
+   *
+   * See Systematic::set_sparse_shapes(). This avoids two full histogram
+   * copies per systematic. The full templates are only built if they are
+   * requested through Systematic::shape_u() or Systematic::shape_d(), which
+   * is not needed to write the datacard.
+   */
+  inline BinByBinFactory& SetSparseShapes(bool sparse) {
+    sparse_shapes_ = sparse;
+    return *this;
+  }
+
   /**
    * Getter functions for class attributes
    */
@@ -161,6 +195,8 @@ class BinByBinFactory {
   inline bool GetPoissonErrors() {return poisson_errors_;}
   inline bool GetMergeZeroBins() {return merge_zero_bins_;}
   inline bool GetMergeSaturatedBins() {return merge_saturated_bins_;}
+  inline unsigned GetThreads() {return n_threads_;}
+  inline bool GetSparseShapes() {return sparse_shapes_;}
 
  private:
   std::string pattern_;
@@ -171,6 +207,13 @@ class BinByBinFactory {
   bool poisson_errors_;
   bool merge_zero_bins_;
   bool merge_saturated_bins_;
+  unsigned n_threads_;
+  bool sparse_shapes_;
+
+  void MergeBin(std::string const& bin, CombineHarvesterView & view,
+                std::ostream & out) const;
+  void CreateBinByBin(Process const& proc, std::vector<Systematic> & res,
+                      std::ostream & out) const;
 };
 }
 
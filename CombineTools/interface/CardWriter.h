@@ -2,6 +2,7 @@
 #define CombineTools_CardWriter_h
 #include <string>
 #include <map>
+#include <unordered_map>
 #include <vector>
 #include <set>
 #include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
@@ -46,6 +47,10 @@ namespace ch {
  * files treats this object as matching any mass value. It is possible to
  * alter or remove this behaviour by supplying a new list of wildcard values
  * with the \ref SetWildcardMasses method.
+ *
+ * The ROOT files, together with the datacards that refer to them, can be
+ * written by several processes in parallel with \ref SetWorkers. With
+ * \ref SetIncremental only the files whose content changed are rewritten.
  */
 class CardWriter {
  public:
@@ -59,6 +64,30 @@ class CardWriter {
   CardWriter& CreateDirectories(bool flag);
   /// Redefine the mass values that should be treated as wildcards
   CardWriter& SetWildcardMasses(std::vector<std::string> const& masses);
+  /**
+   * Write the output ROOT files and their datacards in up to `n_workers`
+   * child processes at once
+   *
+   * Each ROOT file and the datacards that use it are written by a single
+   * forked process, so no ROOT objects are shared between workers. The
+   * assignment of objects to files and datacards is still done in the
+   * calling process, and the returned map is the same as in serial mode.
+   * A value of zero or one writes everything in the calling process.
+   *
+   * @note Any changes WriteDatacard might make to the objects while writing
+   * are not seen by the calling process
+   */
+  CardWriter& SetWorkers(unsigned n_workers);
+  /**
+   * Only rewrite the output files whose content has changed
+   *
+   * The datacards and templates for each ROOT file are produced in memory
+   * and compared with the hashes recorded in a manifest next to the file by
+   * the previous call, see ch::WriteDatacardsIncremental. Unchanged
+   * datacards and ROOT files are not touched and keep their modification
+   * time, and only the templates that changed are rewritten in a ROOT file.
+   */
+  CardWriter& SetIncremental(bool flag);
 
  private:
   typedef std::map<std::string, std::set<std::string>> PatternMap;
@@ -68,12 +97,17 @@ class CardWriter {
   std::vector<std::string> wildcard_masses_;
   unsigned v_;
   bool create_dirs_;
+  unsigned workers_;
+  bool incremental_;
 
   std::string Compile(std::string pattern, ch::Object const* obj,
                       bool skip_mass = false) const;
   PatternMap BuildMap(std::string const& pattern,
                       ch::CombineHarvester& cmb) const;
   void MakeDirs(PatternMap const& map) const;
+  std::vector<CombineHarvester> Partition(
+      ch::CombineHarvester& cmb, PatternMap const& map,
+      std::unordered_map<Object const*, std::string> const& keys) const;
 };
 }
 
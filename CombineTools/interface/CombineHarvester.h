@@ -10,6 +10,7 @@
 #include <cmath>
 #include <set>
 #include <functional>
+#include <mutex>
 #include "boost/range/algorithm_ext/erase.hpp"
 #include "TFile.h"
 #include "TH1.h"
@@ -27,6 +28,12 @@ namespace ch {
 // Define some useful CombineHarvester-specific typedefs
 typedef std::vector<std::pair<int, std::string>> Categories;
 
+class EvaluationPlan;
+class FilterQuery;
+class CombineHarvesterView;
+class DatacardTokens;
+class TFileBatchWriter;
+
 class CombineHarvester {
  public:
   /**
@@ -81,6 +88,16 @@ class CombineHarvester {
    * independent of the original instance.
    */
   CombineHarvester deep();
+
+  /**
+   * Creates a lightweight, read-only view of all the entries in this
+   * instance
+   *
+   * Filtering the returned ch::CombineHarvesterView only updates a list of
+   * entry positions, so unlike cp() it does not copy the object lists.
+   * Include CombineHarvesterView.h to use it.
+   */
+  CombineHarvesterView view();
   /**@}*/
 
   /**
@@ -115,9 +132,83 @@ class CombineHarvester {
   int ParseDatacard(std::string const& filename,
       std::string parse_rule = "");
 
+  /**
+   * Write the datacard `name` and its templates into the ROOT file
+   * `root_file`, which is recreated
+   *
+   * When the `incremental-write` flag is set, the outputs are instead only
+   * rewritten where their content changed since the last write, as
+   * described for ch::WriteDatacardsIncremental.
+   */
   void WriteDatacard(std::string const& name, std::string const& root_file);
   void WriteDatacard(std::string const& name, TFile & root_file);
   void WriteDatacard(std::string const& name);
+
+  /**
+   * Produce the datacard `name` without writing any files
+   *
+   * The text of the card is written to `txt_file`, and the TH1 templates and
+   * RooWorkspaces it needs are queued in `writer` instead of being written.
+   * `root_file` is the path of the ROOT file the queued objects will be
+   * written to, which is needed for the `shapes` lines. It may only be empty
+   * for a counting experiment. This is what WriteDatacard uses internally,
+   * and allows the output to be compared with what is already on disk
+   * before anything is overwritten.
+   */
+  void FormatDatacard(std::string const& name, std::string const& root_file,
+                      std::ostream & txt_file, TFileBatchWriter & writer);
+
+  /**
+   * Read the TH1 templates needed by each parsed datacard ahead of time,
+   * using `n_threads` threads
+   *
+   * Before the datacard is processed, all TH1 objects in its shape files
+   * that match one of the `shapes` patterns, given the bin and process names
+   * in the card, are read in parallel into the process-wide ch::TFileCache.
+   * The templates are then taken from memory as each entry is created.
+   * Setting a non-zero value implies the `cache-shape-files` flag. A value
+   * of zero, the default, disables prefetching.
+   */
+  void SetShapePrefetchThreads(unsigned n_threads);
+
+  /**
+   * Set how WriteDatacard writes the TH1 templates into the ROOT file
+   *
+   * The templates of each WriteDatacard call are collected and written
+   * together at the end with a ch::TFileBatchWriter. `compression` gives the
+   * ROOT compression settings (algorithm * 100 + level) to use for them, or
+   * -1, the default, to keep the settings of the file. `buffer_size` is the
+   * initial size in bytes of the buffer each template is serialised into,
+   * where 0 uses the ROOT default.
+   */
+  void SetShapeWriteSettings(int compression, int buffer_size = 0);
+
+  /**
+   * Save the full contents of this instance to a binary snapshot file
+   *
+   * The snapshot contains all Observation, Process, Systematic and Parameter
+   * entries (including parameter groups), the autoMCStats settings and any
+   * extra datacard lines. TH1 templates are stored as raw arrays of bin
+   * contents and squared weights, so that restoring them does not go through
+   * the ROOT I/O layer. Any RooWorkspaces are stored in their streamed form,
+   * and the RooFit objects attached to each entry are recorded by name.
+   *
+   * The file starts with a version number and all arrays are 8-byte
+   * aligned, so it can be memory-mapped and read back in a single pass with
+   * LoadSnapshot. Histograms of types other than TH1F are restored as TH1D.
+   *
+   * @note Every RooFit object attached to an entry must belong to one of the
+   * workspaces of this instance, otherwise an exception is thrown
+   */
+  void SaveSnapshot(std::string const& filename);
+
+  /**
+   * Restore the contents of a file written by SaveSnapshot
+   *
+   * This instance must be empty. The `flags` and logging settings are not
+   * part of the snapshot and are left unchanged.
+   */
+  void LoadSnapshot(std::string const& filename);
   /**@}*/
 
   /**
@@ -165,6 +256,55 @@ class CombineHarvester {
   CombineHarvester& FilterProcs(Function func);
   template<typename Function>
   CombineHarvester& FilterSysts(Function func);
+
+  /**
+   * Start a lazily-evaluated chain of filters on this instance
+   *
+   * The filters of the returned ch::FilterQuery are only evaluated when the
+   * result is requested, in a single pass over the entries, e.g.
+   * `cb.query().bin({"b1"}).process({"ZTT"}).cp()`. Include
+   * FilterQuery.h to use it.
+   */
+  FilterQuery query();
+  /**@}*/
+
+  /**
+   * \name Bin partitions
+   * \brief Methods to access the entries of each bin directly
+   *
+   * \details The entries are grouped by their bin() value, and each group is
+   * returned as a ch::CombineHarvesterView. When the `partition-by-bin` flag
+   * is set the grouping is computed once, in a single pass, and kept until
+   * the entries or their properties change, so that accessing a partition
+   * costs O(objects in the bin) instead of a full scan of the instance. With
+   * the flag unset, the default, each call scans all of the entries.
+   * Include CombineHarvesterView.h to use the returned views.
+   */
+  /**@{*/
+  /**
+   * The bins that have at least one entry, in the same order as bin_set()
+   */
+  std::vector<std::string> partition_bins();
+
+  /**
+   * A view of the Observation, Process and Systematic entries in `bin`
+   *
+   * The view is empty if there are no entries in this bin. If the
+   * `filters-use-regex` flag is set `bin` is a regular expression, and the
+   * view contains the entries of every bin that it matches.
+   */
+  CombineHarvesterView partition(std::string const& bin);
+
+  /**
+   * Call `func(bin, view)` for each bin and the view of its entries
+   *
+   * With `n_threads` > 1 the bins are processed in parallel, in which case
+   * `func` must be safe to call concurrently for different bins.
+   */
+  void ForEachPartition(
+      std::function<void(std::string const&, CombineHarvesterView &)> const&
+          func,
+      unsigned n_threads = 1);
   /**@}*/
 
 
@@ -368,6 +508,51 @@ class CombineHarvester {
 
   TH2F GetRateCovariance(RooFitResult const& fit, unsigned n_samples);
   TH2F GetRateCorrelation(RooFitResult const& fit, unsigned n_samples);
+
+  /**
+   * Use several threads in the RooFitResult versions of GetUncertainty,
+   * GetShapeWithUncertainty and GetRateCovariance
+   *
+   * With `n_threads` > 0 the samples are drawn directly from the fit
+   * covariance matrix, each from its own random number stream seeded with
+   * `seed` and the index of the sample, and are split across a pool of
+   * `n_threads` threads. The parameters of this instance are not modified,
+   * and the result is the same for any number of threads. With `n_threads`
+   * = 0, the default, the samples are generated one by one with
+   * RooFitResult::randomizePars.
+   *
+   * @note Threads are only used when all processes can be compiled into a
+   * ch::EvaluationPlan, otherwise the serial method is used
+   */
+  void SetSamplingThreads(unsigned n_threads, unsigned long seed = 0);
+
+  /**
+   * Evaluate the total rate for many sets of parameter values in one call
+   *
+   * Each row of `vals` gives the values of the parameters listed in `names`,
+   * while all other parameters keep their current values. The parameters of
+   * this instance are not modified.
+   *
+   * @param names The parameter names corresponding to the columns of `vals`
+   * @param vals Row-major matrix of n_points x `names.size()` values
+   * @return The total rate for each of the n_points rows
+   *
+   * @note The evaluation is done with a ch::EvaluationPlan, and so is only
+   * possible when every process is described by a TH1 template or a fixed
+   * rate
+   */
+  std::vector<double> GetRates(std::vector<std::string> const& names,
+                               std::vector<double> const& vals);
+
+  /**
+   * Evaluate the total shape for many sets of parameter values in one call
+   *
+   * Follows the same conventions as GetRates.
+   *
+   * @return Row-major matrix of n_points x n_bins bin contents
+   */
+  std::vector<double> GetShapes(std::vector<std::string> const& names,
+                                std::vector<double> const& vals);
   /**@}*/
 
   /**
@@ -470,6 +655,12 @@ class CombineHarvester {
   void AddExtArgValue(std::string const& name, double const& value);
  private:
   friend void swap(CombineHarvester& first, CombineHarvester& second);
+  friend class FilterQuery;
+  friend class CombineHarvesterView;
+
+  // Shallow copy of everything except, if copy_entries is false, the
+  // Observation, Process and Systematic entries
+  CombineHarvester(CombineHarvester const& other, bool copy_entries);
 
   // ---------------------------------------------------------------
   // Main data members
@@ -512,6 +703,16 @@ class CombineHarvester {
   // ---------------------------------------------------------------
   unsigned verbosity_;
   std::ostream * log_;
+
+  // ---------------------------------------------------------------
+  // Sampling settings for the evaluation methods
+  // ---------------------------------------------------------------
+  unsigned sampling_threads_;
+  unsigned long sampling_seed_;
+
+  unsigned shape_prefetch_threads_;
+  int shape_write_compression_;
+  int shape_write_buffer_size_;
   std::ostream& log() const { return *log_; }
 
   // ---------------------------------------------------------------
@@ -535,6 +736,12 @@ class CombineHarvester {
   std::shared_ptr<RooWorkspace> SetupWorkspace(RooWorkspace const& ws,
                                     bool can_rename = false);
 
+  // Implemented in src/CombineHarvester_Datacards.cc
+  void PrefetchShapes(DatacardTokens const& words,
+                      std::vector<HistMapping> const& mappings,
+                      std::map<std::string, std::shared_ptr<TFile>> const& files,
+                      std::string const& mass);
+
   void ImportParameters(RooArgSet *vars);
 
   RooAbsData const* FindMatchingData(Process const* proc);
@@ -547,9 +754,10 @@ class CombineHarvester {
   // Private methods for the shape writing routines
   // ---------------------------------------------------------------
   void WriteHistToFile(
-      TH1 * hist,
-      TFile * file,
+      std::unique_ptr<TH1> hist,
+      TFileBatchWriter & writer,
       std::vector<HistMapping> const& mappings,
+      std::map<std::pair<std::string, std::string>, int> & mapping_cache,
       std::string const& bin,
       std::string const& process,
       std::string const& mass,
@@ -565,9 +773,82 @@ void FillHistMappings(std::vector<HistMapping> & mappings);
   typedef std::vector<std::vector<Systematic const*>> ProcSystMap;
   ProcSystMap GenerateProcSystMap();
 
+  /**
+   * Hash index of the Process entries of this instance, keyed on
+   * ch::MatchingProcessHash
+   *
+   * Each instance builds its own index when it is first needed. The index
+   * holds a copy of the `procs_` it was built from, so the Process objects
+   * cannot be destroyed and their addresses reused while it exists. Entries
+   * appended to `procs_` since are added to the index, but it is rebuilt
+   * when the existing entries no longer match this copy or when
+   * Object::Generation() has changed, i.e. when the properties of any object
+   * have been modified. All access goes through `proc_index_mutex_` so that
+   * the index can be used from several threads.
+   */
+  struct ProcIndex {
+    unsigned long generation;
+    std::vector<std::shared_ptr<Process>> procs;
+    std::unordered_multimap<std::size_t, unsigned> positions;
+  };
+  std::unique_ptr<ProcIndex> proc_index_;
+  std::mutex proc_index_mutex_;
+
+  // These must be called with proc_index_mutex_ held
+  bool ProcIndexIsCurrent() const;
+  void ExtendProcIndex();
+
+  /**
+   * Positions of the Observation, Process and Systematic entries in each
+   * bin, used when the `partition-by-bin` flag is set
+   *
+   * The partitions are shared between shallow copies. They are rebuilt when
+   * Object::Generation() or the number of entries changes. Only the removal
+   * of entries leaves the generation unchanged, so any change to the
+   * contents of an instance changes one or the other.
+   */
+  struct BinPartitions {
+    unsigned long generation;
+    std::size_t n_obs;
+    std::size_t n_procs;
+    std::size_t n_systs;
+    std::vector<std::string> bins;
+    std::unordered_map<std::string, unsigned> index;
+    std::vector<std::vector<unsigned>> obs;
+    std::vector<std::vector<unsigned>> procs;
+    std::vector<std::vector<unsigned>> systs;
+  };
+  std::shared_ptr<BinPartitions> bin_partitions_;
+
+  // Implemented in src/CombineHarvester_Partitions.cc
+  std::shared_ptr<BinPartitions const> GetBinPartitions();
+  std::shared_ptr<BinPartitions> BuildBinPartitions() const;
+
   double GetRateInternal(ProcSystMap const& lookup,
     std::string const& single_sys = "");
 
+  std::vector<double> PlanValues(EvaluationPlan const& plan,
+                                 std::vector<std::string> const& names,
+                                 std::vector<double> const& vals) const;
+
+  /**
+   * Sample the plan parameters `n_samples` times from the covariance matrix
+   * of `fit` and evaluate them
+   *
+   * For each sample `evaluate` is called with the parameter values, ordered
+   * as in EvaluationPlan::ParameterNames, and fills `width` output values.
+   * The outputs of a group of samples are then passed to `reduce` together
+   * with a range [first, last) of the `n_out` output elements it should
+   * accumulate. Both may be called concurrently from different threads, but
+   * never for overlapping output ranges.
+   */
+  void SampleFromFit(
+      EvaluationPlan const& plan, RooFitResult const& fit, unsigned n_samples,
+      unsigned width, unsigned n_out,
+      std::function<void(double const*, double *)> evaluate,
+      std::function<void(double const*, unsigned, unsigned, unsigned)> reduce)
+      const;
+
   TH1F GetShapeInternal(ProcSystMap const& lookup,
     std::string const& single_sys = "");
 
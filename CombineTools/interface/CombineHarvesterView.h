@@ -0,0 +1,293 @@
+#ifndef CombineTools_CombineHarvesterView_h
+#define CombineTools_CombineHarvesterView_h
+#include <memory>
+#include <set>
+#include <string>
+#include <type_traits>
+#include <vector>
+#include "TH1F.h"
+#include "TH2F.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/Algorithm.h"
+
+namespace ch {
+/**
+ * A read-only selection of the entries of a CombineHarvester instance
+ *
+ * A view stores only the positions of the selected Observation, Process and
+ * Systematic entries in the parent instance. Creating, copying and filtering
+ * a view never copies the parent's object lists or touches the reference
+ * counts of the shared pointers they contain, which makes it much cheaper
+ * than CombineHarvester::cp() for the common pattern of repeatedly selecting
+ * a small subset of a large instance:
+ *
+ *     for (auto const& bin : cb.bin_set()) {
+ *       TH1F h = cb.view().bin({bin}).backgrounds().GetShape();
+ *     }
+ *
+ * The filter methods behave exactly as the
+ * \ref CH-Filters "CombineHarvester filters", including the use of the
+ * parent's `filters-use-regex` flag, and the set producers and ForEach
+ * methods are also available. Anything that can modify the set of entries,
+ * e.g. adding objects or renaming bins, requires an owning instance, which
+ * is created from the current selection with cp(). The rate and shape
+ * evaluation methods do this internally, so only the selected entries are
+ * copied.
+ *
+ * @note The view refers to the parent instance, which must outlive it and
+ * must not have entries added or removed while the view is in use
+ */
+class CombineHarvesterView {
+ public:
+  explicit CombineHarvesterView(CombineHarvester & cb);
+
+  /**
+   * Create an owning shallow copy containing only the selected entries
+   */
+  CombineHarvester cp() const;
+
+  unsigned NumObs() const { return obs_idx_.size(); }
+  unsigned NumProcs() const { return procs_idx_.size(); }
+  unsigned NumSysts() const { return systs_idx_.size(); }
+
+  /**
+   * \name Filters
+   */
+  /**@{*/
+  CombineHarvesterView& bin(std::vector<std::string> const& vec,
+                            bool cond = true);
+  CombineHarvesterView& bin_id(std::vector<int> const& vec, bool cond = true);
+  CombineHarvesterView& process(std::vector<std::string> const& vec,
+                                bool cond = true);
+  CombineHarvesterView& analysis(std::vector<std::string> const& vec,
+                                 bool cond = true);
+  CombineHarvesterView& era(std::vector<std::string> const& vec,
+                            bool cond = true);
+  CombineHarvesterView& channel(std::vector<std::string> const& vec,
+                                bool cond = true);
+  CombineHarvesterView& mass(std::vector<std::string> const& vec,
+                             bool cond = true);
+  CombineHarvesterView& attr(std::vector<std::string> const& vec,
+                             std::string attr_label, bool cond = true);
+  CombineHarvesterView& syst_name(std::vector<std::string> const& vec,
+                                  bool cond = true);
+  CombineHarvesterView& syst_type(std::vector<std::string> const& vec,
+                                  bool cond = true);
+
+  CombineHarvesterView& process_rgx(std::vector<std::string> const& vec,
+                                    bool cond = true);
+
+  CombineHarvesterView& signals();
+  CombineHarvesterView& backgrounds();
+  CombineHarvesterView& histograms();
+  CombineHarvesterView& pdfs();
+  CombineHarvesterView& data();
+
+  template<typename Function>
+  CombineHarvesterView& FilterAll(Function func);
+  template<typename Function>
+  CombineHarvesterView& FilterObs(Function func);
+  template<typename Function>
+  CombineHarvesterView& FilterProcs(Function func);
+  template<typename Function>
+  CombineHarvesterView& FilterSysts(Function func);
+  /**@}*/
+
+  /**
+   * \name Set producers
+   */
+  /**@{*/
+  std::set<std::string> bin_set() const;
+  std::set<int> bin_id_set() const;
+  std::set<std::string> process_set() const;
+  std::set<std::string> analysis_set() const;
+  std::set<std::string> era_set() const;
+  std::set<std::string> channel_set() const;
+  std::set<std::string> mass_set() const;
+  std::set<std::string> syst_name_set() const;
+  std::set<std::string> syst_type_set() const;
+
+  template <typename T,
+            typename R = typename std::decay<
+                typename std::result_of<T(Object const*)>::type>::type>
+  std::set<R> SetFromAll(T func) const;
+
+  template <typename T,
+            typename R = typename std::decay<
+                typename std::result_of<T(Observation const*)>::type>::type>
+  std::set<R> SetFromObs(T func) const;
+
+  template <typename T,
+            typename R = typename std::decay<
+                typename std::result_of<T(Process const*)>::type>::type>
+  std::set<R> SetFromProcs(T func) const;
+
+  template <typename T,
+            typename R = typename std::decay<
+                typename std::result_of<T(Systematic const*)>::type>::type>
+  std::set<R> SetFromSysts(T func) const;
+  /**@}*/
+
+  /**
+   * \name Iteration and evaluation
+   */
+  /**@{*/
+  template<typename Function>
+  void ForEachObj(Function func) const;
+
+  template<typename Function>
+  void ForEachObs(Function func) const;
+
+  template<typename Function>
+  void ForEachProc(Function func) const;
+
+  template<typename Function>
+  void ForEachSyst(Function func) const;
+
+  ch::Parameter const* GetParameter(std::string const& name) const {
+    return cb_->GetParameter(name);
+  }
+
+  double GetRate() const { return cp().GetRate(); }
+  double GetObservedRate() const { return cp().GetObservedRate(); }
+  double GetUncertainty() const { return cp().GetUncertainty(); }
+  double GetUncertainty(RooFitResult const& fit, unsigned n_samples) const {
+    return cp().GetUncertainty(fit, n_samples);
+  }
+  TH1F GetShape() const { return cp().GetShape(); }
+  TH1F GetObservedShape() const { return cp().GetObservedShape(); }
+  TH1F GetShapeWithUncertainty() const {
+    return cp().GetShapeWithUncertainty();
+  }
+  TH1F GetShapeWithUncertainty(RooFitResult const& fit,
+                               unsigned n_samples) const {
+    return cp().GetShapeWithUncertainty(fit, n_samples);
+  }
+  TH2F GetRateCovariance(RooFitResult const& fit, unsigned n_samples) const {
+    return cp().GetRateCovariance(fit, n_samples);
+  }
+  /**@}*/
+
+ private:
+  friend class CombineHarvester;
+  friend class CardWriter;
+
+  CombineHarvester * cb_;
+  std::vector<unsigned> obs_idx_;
+  std::vector<unsigned> procs_idx_;
+  std::vector<unsigned> systs_idx_;
+
+  CombineHarvesterView(CombineHarvester & cb,
+                       std::vector<unsigned> obs_idx,
+                       std::vector<unsigned> procs_idx,
+                       std::vector<unsigned> systs_idx);
+
+  template <typename T, typename Filter, typename Converter>
+  void FilterIndex(std::vector<unsigned> & idx,
+                   std::vector<std::shared_ptr<T>> const& objs,
+                   Filter const& vec, Converter fn, bool cond);
+
+  template <typename T, typename Function>
+  void EraseIf(std::vector<unsigned> & idx,
+               std::vector<std::shared_ptr<T>> const& objs, Function func);
+};
+
+template <typename T, typename Filter, typename Converter>
+void CombineHarvesterView::FilterIndex(
+    std::vector<unsigned> & idx, std::vector<std::shared_ptr<T>> const& objs,
+    Filter const& vec, Converter fn, bool cond) {
+  auto get = [&](unsigned i) -> decltype(fn(*(objs[i]))) {
+    return fn(*(objs[i]));
+  };
+  if (cb_->GetFlag("filters-use-regex")) {
+    FilterContainingRgx(idx, vec, get, cond);
+  } else {
+    FilterContaining(idx, vec, get, cond);
+  }
+}
+
+template <typename T, typename Function>
+void CombineHarvesterView::EraseIf(
+    std::vector<unsigned> & idx, std::vector<std::shared_ptr<T>> const& objs,
+    Function func) {
+  ch::erase_if(idx, [&](unsigned i) { return func(objs[i].get()); });
+}
+
+template<typename Function>
+CombineHarvesterView& CombineHarvesterView::FilterAll(Function func) {
+  FilterObs(func);
+  FilterProcs(func);
+  FilterSysts(func);
+  return *this;
+}
+
+template<typename Function>
+CombineHarvesterView& CombineHarvesterView::FilterObs(Function func) {
+  EraseIf(obs_idx_, cb_->obs_, func);
+  return *this;
+}
+
+template<typename Function>
+CombineHarvesterView& CombineHarvesterView::FilterProcs(Function func) {
+  EraseIf(procs_idx_, cb_->procs_, func);
+  return *this;
+}
+
+template<typename Function>
+CombineHarvesterView& CombineHarvesterView::FilterSysts(Function func) {
+  EraseIf(systs_idx_, cb_->systs_, func);
+  return *this;
+}
+
+template<typename Function>
+void CombineHarvesterView::ForEachObj(Function func) const {
+  ForEachObs(func);
+  ForEachProc(func);
+  ForEachSyst(func);
+}
+
+template<typename Function>
+void CombineHarvesterView::ForEachObs(Function func) const {
+  for (unsigned i : obs_idx_) func(cb_->obs_[i].get());
+}
+
+template<typename Function>
+void CombineHarvesterView::ForEachProc(Function func) const {
+  for (unsigned i : procs_idx_) func(cb_->procs_[i].get());
+}
+
+template<typename Function>
+void CombineHarvesterView::ForEachSyst(Function func) const {
+  for (unsigned i : systs_idx_) func(cb_->systs_[i].get());
+}
+
+template <typename T, typename R>
+std::set<R> CombineHarvesterView::SetFromAll(T func) const {
+  std::set<R> ret;
+  ForEachObj([&](Object const* obj) { ret.insert(func(obj)); });
+  return ret;
+}
+
+template <typename T, typename R>
+std::set<R> CombineHarvesterView::SetFromObs(T func) const {
+  std::set<R> ret;
+  ForEachObs([&](Observation const* obs) { ret.insert(func(obs)); });
+  return ret;
+}
+
+template <typename T, typename R>
+std::set<R> CombineHarvesterView::SetFromProcs(T func) const {
+  std::set<R> ret;
+  ForEachProc([&](Process const* proc) { ret.insert(func(proc)); });
+  return ret;
+}
+
+template <typename T, typename R>
+std::set<R> CombineHarvesterView::SetFromSysts(T func) const {
+  std::set<R> ret;
+  ForEachSyst([&](Systematic const* sys) { ret.insert(func(sys)); });
+  return ret;
+}
+}
+
+#endif
@@ -0,0 +1,98 @@
+#ifndef CombineTools_DatacardTokens_h
+#define CombineTools_DatacardTokens_h
+#include <string>
+#include <vector>
+#include "boost/utility/string_ref.hpp"
+
+namespace ch {
+/**
+ * A datacard split into lines of whitespace-separated words
+ *
+ * The whole file is read into a single buffer, which is then tokenized in
+ * one pass. Lines and words are stored as `boost::string_ref` views of this
+ * buffer, so no strings are allocated per line or per word. Files with the
+ * extension `.gz` are decompressed as they are read.
+ *
+ * The lines are split exactly as CombineHarvester::ParseDatacard has always
+ * done: leading and trailing whitespace is ignored, lines that are then
+ * empty or begin with `#` or `-` are skipped, and the remaining text is
+ * split on any number of spaces and tabs. In the same pass the first two
+ * words of every line are matched against the datacard keywords, so the
+ * parser can switch on a Keyword instead of repeating case-insensitive
+ * string comparisons.
+ *
+ * @note The views refer to memory owned by this object, so it can be
+ * neither copied nor moved
+ */
+class DatacardTokens {
+ public:
+  enum class Keyword {
+    none,
+    bin,
+    observation,
+    process,
+    rate,
+    shapes,
+    param,
+    rateParam,
+    extArg,
+    group,
+    autoMCStats
+  };
+
+  class Line {
+   public:
+    unsigned size() const { return n_; }
+    boost::string_ref operator[](unsigned i) const { return words_[i]; }
+    std::string str(unsigned i) const { return words_[i].to_string(); }
+    boost::string_ref const* begin() const { return words_; }
+    boost::string_ref const* end() const { return words_ + n_; }
+
+    /**
+     * The Keyword matching the word at position `i`, which must be zero or
+     * one
+     */
+    Keyword keyword(unsigned i) const { return keys_[i]; }
+
+   private:
+    friend class DatacardTokens;
+    boost::string_ref const* words_;
+    unsigned n_;
+    Keyword keys_[2];
+  };
+
+  /**
+   * Read and tokenize the file `filename`
+   *
+   * @throws std::runtime_error if the file cannot be opened or read
+   */
+  explicit DatacardTokens(std::string const& filename);
+
+  DatacardTokens(DatacardTokens const&) = delete;
+  DatacardTokens& operator=(DatacardTokens const&) = delete;
+
+  unsigned size() const { return lines_.size(); }
+  Line const& operator[](unsigned i) const { return lines_[i]; }
+  std::vector<Line>::const_iterator begin() const { return lines_.begin(); }
+  std::vector<Line>::const_iterator end() const { return lines_.end(); }
+
+  /**
+   * Case-insensitive match of `word` against the datacard keywords
+   */
+  static Keyword Classify(boost::string_ref word);
+
+ private:
+  std::string buffer_;
+  std::vector<boost::string_ref> words_;
+  std::vector<Line> lines_;
+
+  void Tokenize();
+};
+
+/**
+ * Case-insensitive comparison of a word with a lower-case keyword
+ */
+bool IEquals(boost::string_ref word, boost::string_ref lower);
+}
+
+#endif
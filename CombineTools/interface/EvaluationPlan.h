@@ -0,0 +1,189 @@
+#ifndef CombineTools_EvaluationPlan_h
+#define CombineTools_EvaluationPlan_h
+#include <string>
+#include <unordered_map>
+#include <vector>
+#include "TH1F.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+
+namespace ch {
+/**
+ * A compiled, read-only representation of the Process and Systematic entries
+ * of a CombineHarvester instance, for fast repeated evaluation of the total
+ * rate and shape
+ *
+ * On construction the nominal templates and the up/down shape variations
+ * are flattened into contiguous arrays of doubles, and the normalisation
+ * effects into a table of log-kappa values. The total rate or shape can then
+ * be evaluated for any vector of parameter values without modifying the
+ * CombineHarvester instance and without allocating any memory, e.g.:
+ *
+ *     ch::EvaluationPlan plan(cb.cp().bin({"bin1"}).backgrounds());
+ *     std::vector<double> vals = plan.CurrentValues(cb);
+ *     std::vector<double> shape(plan.NumBins());
+ *     plan.EvaluateShape(vals.data(), shape.data());
+ *
+ * The result is the same as CombineHarvester::GetRate and
+ * CombineHarvester::GetShape called with the same parameter values, up to the
+ * single-precision rounding these apply when interpolating shapes. As with
+ * those methods, rateParam entries are ignored.
+ *
+ * Since the plan is never modified after construction, the evaluation methods
+ * may be called concurrently from several threads.
+ *
+ * A plan built with `rate_only` set does not store the templates, and only
+ * the rate evaluation methods are meaningful: NumBins is zero and the shape
+ * methods produce no output. The processes may then have different binnings,
+ * as is usual when the instance contains several bins.
+ *
+ * @note Only processes described by a TH1 template or by a rate alone
+ * (counting experiments) are supported. An exception is thrown if any process
+ * has a RooAbsPdf, RooAbsData or RooAbsReal normalisation attached, or, unless
+ * `rate_only` is set, if the templates have different numbers of bins. The
+ * plan does not track later changes to the CombineHarvester instance it was
+ * built from.
+ */
+class EvaluationPlan {
+ public:
+  explicit EvaluationPlan(CombineHarvester & cb, bool rate_only = false);
+
+  /**
+   * Names of the parameters the plan depends on
+   *
+   * The parameter vectors passed to the evaluation methods must be given in
+   * this order.
+   */
+  std::vector<std::string> const& ParameterNames() const { return par_names_; }
+
+  /**
+   * Position of the parameter `name` in \ref ParameterNames, or -1 if the
+   * plan does not depend on it
+   */
+  int ParameterIndex(std::string const& name) const;
+
+  /**
+   * Number of histogram bins in the evaluated shape
+   */
+  unsigned NumBins() const { return n_bins_; }
+
+  unsigned NumProcesses() const { return procs_.size(); }
+
+  /**
+   * Check whether every process in `cb` is of a type the plan supports and,
+   * unless `rate_only` is set, whether all the templates have the same
+   * number of bins
+   */
+  static bool CanCompile(CombineHarvester & cb, bool rate_only = false);
+
+  /**
+   * Get the current values of the plan parameters from a CombineHarvester
+   * instance, ordered as in \ref ParameterNames
+   */
+  std::vector<double> CurrentValues(CombineHarvester const& cb) const;
+
+  /**
+   * Evaluate the total rate for the parameter values `vals`
+   */
+  double EvaluateRate(double const* vals) const;
+
+  /**
+   * Evaluate the total shape for the parameter values `vals`, writing the
+   * content of each bin into `out`, which must have room for \ref NumBins
+   * values
+   */
+  void EvaluateShape(double const* vals, double * out) const;
+
+  /**
+   * Evaluate the rate of each process separately, in the order they appear
+   * in the CombineHarvester instance, writing \ref NumProcesses values into
+   * `out`
+   */
+  void EvaluateProcessRates(double const* vals, double * out) const;
+
+  /**
+   * Evaluate the total rate for `n_points` sets of parameter values
+   *
+   * @param vals Row-major matrix of `n_points` x \ref ParameterNames values
+   * @param n_points Number of rows in `vals`
+   * @param out Receives the `n_points` rates
+   */
+  void EvaluateRates(double const* vals, unsigned n_points,
+                     double * out) const;
+
+  /**
+   * Evaluate the total shape for `n_points` sets of parameter values
+   *
+   * @param vals Row-major matrix of `n_points` x \ref ParameterNames values
+   * @param n_points Number of rows in `vals`
+   * @param out Receives a row-major matrix of `n_points` x \ref NumBins
+   * bin contents
+   */
+  void EvaluateShapes(double const* vals, unsigned n_points,
+                      double * out) const;
+
+  double GetRate(std::vector<double> const& vals) const;
+
+  /**
+   * Evaluate the total shape as a TH1F, with the binning of the first
+   * process template
+   */
+  TH1F GetShape(std::vector<double> const& vals) const;
+
+ private:
+  struct ProcEntry {
+    double rate;
+    bool has_shape;
+    unsigned kappa_begin;
+    unsigned kappa_end;
+    unsigned morph_begin;
+    unsigned morph_end;
+    unsigned nominal_offset;
+    unsigned coeff_offset;
+  };
+
+  // Normalisation effect of one Systematic on one Process
+  struct Kappa {
+    unsigned par;
+    double scale;
+    bool asymm;
+    double log_hi;  // log(value_u)
+    double log_lo;  // -log(value_d), only used when asymm
+  };
+
+  // Shape effect of one Systematic on one Process
+  struct Morph {
+    unsigned par;
+    double scale;
+    bool linear;
+  };
+
+  unsigned n_bins_;
+  TH1F axis_;
+  std::vector<std::string> par_names_;
+  std::unordered_map<std::string, unsigned> par_index_;
+  std::vector<ProcEntry> procs_;
+  std::vector<Kappa> kappas_;
+  std::vector<Morph> morphs_;
+  // Unit-normalised nominal templates, [process][bin]
+  std::vector<double> nominal_;
+  // Interpolation coefficients of each Morph, [process][bin][morph]
+  std::vector<double> coeff_diff_;
+  std::vector<double> coeff_sum_;
+
+  double LogKappa(ProcEntry const& proc, double const* vals) const;
+
+  static bool Supported(Process const* proc) {
+    return !proc->pdf() && !proc->data() && !proc->norm();
+  }
+
+  void CheckSize(std::vector<double> const& vals) const;
+
+  static double SmoothStep(double x) {
+    if (std::fabs(x) >= 1.0) return x > 0 ? +1 : -1;
+    double x2 = x * x;
+    return 0.125 * x * (x2 * (3. * x2 - 10.) + 15);
+  }
+};
+}
+
+#endif
@@ -0,0 +1,188 @@
+#ifndef CombineTools_FilterQuery_h
+#define CombineTools_FilterQuery_h
+#include <string>
+#include <unordered_set>
+#include <vector>
+#include "boost/regex.hpp"
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/Observation.h"
+#include "CombineHarvester/CombineTools/interface/Process.h"
+#include "CombineHarvester/CombineTools/interface/Systematic.h"
+
+namespace ch {
+/**
+ * A lazily-evaluated chain of filters on a CombineHarvester instance
+ *
+ * The filter methods have the same names, arguments and meaning as the
+ * \ref CH-Filters "CombineHarvester filters", but only record the
+ * selection. Each list of values is compiled into a hash set, and nothing is
+ * evaluated until the result is requested. At that point each Observation,
+ * Process and Systematic entry is tested against all of the filters in a
+ * single pass, so that
+ *
+ *     ch::CombineHarvester res =
+ *         cb.query().bin({b}).process({p}).syst_type({"shape"}).cp();
+ *
+ * gives the same result as `cb.cp().bin({b}).process({p}).syst_type({"shape"})`
+ * without copying the full object lists first and then shrinking them once
+ * per filter. The entries can also be visited without creating a new
+ * instance at all using the ForEach methods.
+ *
+ * As with the regular filters, the `filters-use-regex` flag of the parent
+ * instance is read when each filter is added.
+ *
+ * @note The query holds a reference to the CombineHarvester instance it was
+ * created from, which must outlive it
+ */
+class FilterQuery {
+ public:
+  explicit FilterQuery(CombineHarvester & cb);
+
+  /**
+   * \name Filters
+   */
+  /**@{*/
+  FilterQuery& bin(std::vector<std::string> const& vec, bool cond = true);
+  FilterQuery& bin_id(std::vector<int> const& vec, bool cond = true);
+  FilterQuery& process(std::vector<std::string> const& vec, bool cond = true);
+  FilterQuery& analysis(std::vector<std::string> const& vec, bool cond = true);
+  FilterQuery& era(std::vector<std::string> const& vec, bool cond = true);
+  FilterQuery& channel(std::vector<std::string> const& vec, bool cond = true);
+  FilterQuery& mass(std::vector<std::string> const& vec, bool cond = true);
+  FilterQuery& attr(std::vector<std::string> const& vec,
+                    std::string attr_label, bool cond = true);
+  FilterQuery& syst_name(std::vector<std::string> const& vec,
+                         bool cond = true);
+  FilterQuery& syst_type(std::vector<std::string> const& vec,
+                         bool cond = true);
+
+  FilterQuery& process_rgx(std::vector<std::string> const& vec,
+                           bool cond = true);
+
+  FilterQuery& signals();
+  FilterQuery& backgrounds();
+  FilterQuery& histograms();
+  FilterQuery& pdfs();
+  FilterQuery& data();
+  /**@}*/
+
+  /**
+   * \name Evaluation
+   */
+  /**@{*/
+  /**
+   * Create a shallow copy of the parent instance that contains only the
+   * entries passing all filters
+   */
+  CombineHarvester cp() const;
+
+  /**
+   * Remove the entries that fail any filter from the parent instance
+   */
+  CombineHarvester& Apply();
+
+  template<typename Function>
+  void ForEachObs(Function func) const;
+
+  template<typename Function>
+  void ForEachProc(Function func) const;
+
+  template<typename Function>
+  void ForEachSyst(Function func) const;
+
+  template<typename Function>
+  void ForEachObj(Function func) const;
+  /**@}*/
+
+ private:
+  enum class Property {
+    bin, bin_id, process, analysis, era, channel, mass, attr, syst_name,
+    syst_type, signal, histogram, pdf, data
+  };
+
+  // Bitmask of the object collections a filter acts on
+  enum Target : unsigned { kObs = 1, kProcs = 2, kSysts = 4 };
+
+  struct Filter {
+    Property property;
+    unsigned targets;
+    bool cond;
+    bool use_regex;
+    std::string attr_label;
+    std::unordered_set<std::string> values;
+    std::unordered_set<int> ids;
+    std::vector<boost::regex> rgx;
+
+    bool Test(std::string const& val) const;
+    bool Test(int val) const;
+  };
+
+  CombineHarvester * cb_;
+  std::vector<Filter> filters_;
+
+  FilterQuery& AddFilter(Property property, unsigned targets,
+                         std::vector<std::string> const& vec, bool cond,
+                         bool use_regex, std::string const& attr_label = "");
+  FilterQuery& AddFlagFilter(Property property, unsigned targets, bool cond);
+
+  static bool TestObject(Filter const& filter, Object const& obj);
+  static bool TestEntry(Filter const& filter, Observation const& obs);
+  static bool TestEntry(Filter const& filter, Process const& proc);
+  static bool TestEntry(Filter const& filter, Systematic const& sys);
+
+  template <typename T>
+  bool Keep(T const& obj, unsigned target) const;
+
+  template <typename T>
+  std::vector<std::shared_ptr<T>> Select(
+      std::vector<std::shared_ptr<T>> const& in, unsigned target) const;
+};
+
+template <typename T>
+bool FilterQuery::Keep(T const& obj, unsigned target) const {
+  for (auto const& filter : filters_) {
+    if ((filter.targets & target) && !TestEntry(filter, obj)) return false;
+  }
+  return true;
+}
+
+template <typename T>
+std::vector<std::shared_ptr<T>> FilterQuery::Select(
+    std::vector<std::shared_ptr<T>> const& in, unsigned target) const {
+  std::vector<std::shared_ptr<T>> res;
+  for (auto const& ptr : in) {
+    if (Keep(*ptr, target)) res.push_back(ptr);
+  }
+  return res;
+}
+
+template<typename Function>
+void FilterQuery::ForEachObs(Function func) const {
+  for (auto const& item : cb_->obs_) {
+    if (Keep(*item, kObs)) func(item.get());
+  }
+}
+
+template<typename Function>
+void FilterQuery::ForEachProc(Function func) const {
+  for (auto const& item : cb_->procs_) {
+    if (Keep(*item, kProcs)) func(item.get());
+  }
+}
+
+template<typename Function>
+void FilterQuery::ForEachSyst(Function func) const {
+  for (auto const& item : cb_->systs_) {
+    if (Keep(*item, kSysts)) func(item.get());
+  }
+}
+
+template<typename Function>
+void FilterQuery::ForEachObj(Function func) const {
+  ForEachObs(func);
+  ForEachProc(func);
+  ForEachSyst(func);
+}
+}
+
+#endif
@@ -2,6 +2,7 @@
 #define CombineTools_Object_h
 #include <string>
 #include <map>
+#include <atomic>
 
 namespace ch {
 
@@ -13,28 +14,52 @@ class Object {
   Object(Object&& other);
   Object& operator=(Object other);
 
-  virtual void set_bin(std::string const& bin) { bin_ = bin; }
+  virtual void set_bin(std::string const& bin) {
+    bin_ = bin;
+    ++generation_;
+  }
   virtual std::string const& bin() const { return bin_; }
 
-  virtual void set_process(std::string const& process) { process_ = process; }
+  virtual void set_process(std::string const& process) {
+    process_ = process;
+    ++generation_;
+  }
   virtual std::string const& process() const { return process_; }
 
-  void set_signal(bool const& signal) { signal_ = signal; }
+  void set_signal(bool const& signal) {
+    signal_ = signal;
+    ++generation_;
+  }
   bool signal() const { return signal_; }
 
-  virtual void set_analysis(std::string const& analysis) { analysis_ = analysis; }
+  virtual void set_analysis(std::string const& analysis) {
+    analysis_ = analysis;
+    ++generation_;
+  }
   virtual std::string const& analysis() const { return analysis_; }
 
-  virtual void set_era(std::string const& era) { era_ = era; }
+  virtual void set_era(std::string const& era) {
+    era_ = era;
+    ++generation_;
+  }
   virtual std::string const& era() const { return era_; }
 
-  virtual void set_channel(std::string const& channel) { channel_ = channel; }
+  virtual void set_channel(std::string const& channel) {
+    channel_ = channel;
+    ++generation_;
+  }
   virtual std::string const& channel() const { return channel_; }
 
-  virtual void set_bin_id(int const& bin_id) { bin_id_ = bin_id; }
+  virtual void set_bin_id(int const& bin_id) {
+    bin_id_ = bin_id;
+    ++generation_;
+  }
   virtual int bin_id() const { return bin_id_; }
 
-  virtual void set_mass(std::string const& mass) { mass_ = mass; }
+  virtual void set_mass(std::string const& mass) {
+    mass_ = mass;
+    ++generation_;
+  }
   virtual std::string const& mass() const { return mass_; }
 
   virtual void set_attribute(std::string const& attr_label, std::string const& attr_value);
@@ -43,6 +68,22 @@ class Object {
   virtual std::map<std::string,std::string> const& all_attributes() const { return attributes_;}
   virtual std::string const attribute(std::string const& attr_label) const { return attributes_.count(attr_label) >0 ? attributes_.at(attr_label) : "" ; }
 
+  /**
+   * Counter that is incremented whenever the bin, process, signal, analysis,
+   * era, channel, bin_id or mass of any Object is modified, or an Object is
+   * added to a CombineHarvester instance
+   *
+   * Used by the CombineHarvester to detect when a lookup keyed on these
+   * properties (see ch::MatchingProcess) has to be rebuilt. Copying an
+   * Object does not change the counter.
+   */
+  static unsigned long Generation() { return generation_; }
+
+  /**
+   * Increment the counter returned by Generation()
+   */
+  static void IncrementGeneration() { ++generation_; }
+
  private:
   std::string bin_;
   std::string process_;
@@ -53,6 +94,7 @@ class Object {
   int bin_id_;
   std::string mass_;
   std::map<std::string,std::string> attributes_;
+  static std::atomic<unsigned long> generation_;
   friend void swap(Object& first, Object& second);
 };
 }
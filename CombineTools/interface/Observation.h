@@ -43,6 +43,8 @@ class Observation : public Object {
   RooAbsData* data_;
 
   friend void swap(Observation& first, Observation& second);
+  // Restores the normalised shapes directly in LoadSnapshot
+  friend class CombineHarvester;
 };
 }
 
@@ -0,0 +1,103 @@
+#ifndef CombineTools_OutputManifest_h
+#define CombineTools_OutputManifest_h
+#include <cstdint>
+#include <ctime>
+#include <map>
+#include <string>
+#include <utility>
+#include <vector>
+
+namespace ch {
+
+class CombineHarvester;
+
+/**
+ * Content hashes of a ROOT file and the datacards that refer to it
+ *
+ * The manifest is stored as a json file next to the ROOT file, see PathFor.
+ * For each output file it records a hash of the content that was written,
+ * together with the size and modification time the file had afterwards.
+ * The hash of each object in the ROOT file is also kept, so that a later
+ * write can update just the objects that changed.
+ */
+class OutputManifest {
+ public:
+  OutputManifest();
+
+  /**
+   * Read the manifest of the ROOT file `root_file`
+   *
+   * A missing or unreadable manifest gives an empty one, so that everything
+   * is treated as changed.
+   */
+  static OutputManifest Read(std::string const& root_file);
+
+  /// The path of the manifest of the ROOT file `root_file`
+  static std::string PathFor(std::string const& root_file);
+
+  /**
+   * True if `file` was recorded with `hash` and is still on disk with the
+   * recorded size and modification time
+   */
+  bool IsCurrent(std::string const& file, std::string const& hash) const;
+
+  /**
+   * True if `file` is on disk with the size and modification time it was
+   * recorded with, whatever its hash
+   */
+  bool IsUnmodified(std::string const& file) const;
+
+  /// Record the current size and modification time of `file` with `hash`
+  void Record(std::string const& file, std::string const& hash);
+
+  std::map<std::string, std::string> const& objects() const {
+    return objects_;
+  }
+  int compression() const { return compression_; }
+
+  /// Set the hashes of the objects in the ROOT file, keyed by path
+  void SetObjects(std::map<std::string, std::string> const& objects,
+                  int compression);
+
+  /// Write the manifest of the ROOT file `root_file`
+  void Write(std::string const& root_file) const;
+
+ private:
+  struct FileEntry {
+    std::string hash;
+    std::uintmax_t size;
+    std::time_t mtime;
+  };
+  std::map<std::string, FileEntry> files_;
+  std::map<std::string, std::string> objects_;
+  int compression_;
+};
+
+/**
+ * Write a set of datacards that share the ROOT file `root_file`, only
+ * replacing the outputs whose content has changed
+ *
+ * Each entry of `cards` gives the name of a datacard and the instance it is
+ * produced from, as with CombineHarvester::WriteDatacard. All the cards are
+ * first produced in memory with CombineHarvester::FormatDatacard and hashed,
+ * then compared with the OutputManifest of `root_file`:
+ *
+ *   - a datacard whose text is unchanged, and which has not been modified
+ *     on disk since, is not written again
+ *   - if none of the objects for the ROOT file have changed the file is not
+ *     opened, otherwise only the objects that changed are written and any
+ *     that are no longer needed are deleted
+ *   - if the ROOT file is missing, was modified since it was recorded or
+ *     was written with different compression settings, it is recreated
+ *
+ * Unchanged files therefore keep their modification time, and tools further
+ * down the chain can skip them as well.
+ *
+ * @return The files that were written
+ */
+std::vector<std::string> WriteDatacardsIncremental(
+    std::string const& root_file,
+    std::vector<std::pair<std::string, CombineHarvester *>> const& cards);
+}
+
+#endif
@@ -81,6 +81,8 @@ class Process : public Object {
   mutable RooAbsReal* cached_int_;
 
   friend void swap(Process& first, Process& second);
+  // Restores the normalised shapes directly in LoadSnapshot
+  friend class CombineHarvester;
 };
 }
 
@@ -1,6 +1,7 @@
 #ifndef CombineTools_Systematic_h
 #define CombineTools_Systematic_h
 #include <memory>
+#include <mutex>
 #include <string>
 #include "TH1.h"
 #include "RooDataHist.h"
@@ -35,7 +36,10 @@ class Systematic : public Object {
   void set_asymm(bool const& asymm) { asymm_ = asymm; }
   bool asymm() const { return asymm_; }
 
-  TH1 const* shape_u() const { return shape_u_.get(); }
+  TH1 const* shape_u() const {
+    if (sparse_) return sparse_->ShapeU();
+    return shape_u_.get();
+  }
 
   std::unique_ptr<TH1> ClonedShapeU() const;
   std::unique_ptr<TH1> ClonedShapeD() const;
@@ -43,7 +47,25 @@ class Systematic : public Object {
   TH1F ShapeUAsTH1F() const;
   TH1F ShapeDAsTH1F() const;
 
-  TH1 const* shape_d() const { return shape_d_.get(); }
+  TH1 const* shape_d() const {
+    if (sparse_) return sparse_->ShapeD();
+    return shape_d_.get();
+  }
+
+  /**
+   * True if this systematic has up and down TH1 shapes, in either the full
+   * or the sparse representation
+   *
+   * Unlike shape_u() and shape_d(), this never builds the full templates of
+   * a sparse systematic.
+   */
+  bool has_shapes() const { return sparse_ || (shape_u_ && shape_d_); }
+
+  /**
+   * True if the shapes are stored as a single-bin change of a nominal
+   * template, see set_sparse_shapes()
+   */
+  bool sparse_shapes() const { return bool(sparse_); }
 
   RooDataHist const* data_u() const { return data_u_; }
 
@@ -65,6 +87,21 @@ class Systematic : public Object {
   void set_shapes(TH1 const& shape_u, TH1 const& shape_d,
                   TH1 const& nominal);
 
+  /**
+   * Set up and down shapes that differ from the **nominal** template only in
+   * the content of bin **bin**, which becomes **content_u** and
+   * **content_d** respectively
+   *
+   * Only the bin contents are stored, and the **nominal** template may be
+   * shared between many systematics. The full shapes, normalised to unity
+   * as in set_shapes(), are built the first time shape_u() or shape_d() is
+   * called and are then kept for the lifetime of this object and its copies.
+   * ClonedShapeU() and ClonedShapeD() return new histograms without keeping
+   * them. Unlike set_shapes(), this does not change value_u() or value_d().
+   */
+  void set_sparse_shapes(std::shared_ptr<TH1 const> nominal, int bin,
+                         double content_u, double content_d);
+
   friend std::ostream& operator<< (std::ostream &out, Systematic const& val);
   static std::ostream& PrintHeader(std::ostream &out);
 
@@ -84,7 +121,28 @@ class Systematic : public Object {
   RooDataHist * data_u_;
   RooDataHist * data_d_;
 
+  struct SparseShapes {
+    std::shared_ptr<TH1 const> nominal;
+    int bin;
+    double content_u;
+    double content_d;
+
+    std::unique_ptr<TH1> Build(bool up) const;
+    TH1 const* ShapeU() const;
+    TH1 const* ShapeD() const;
+
+   private:
+    void Materialise() const;
+    mutable std::once_flag once_;
+    mutable std::unique_ptr<TH1> shape_u_;
+    mutable std::unique_ptr<TH1> shape_d_;
+  };
+  // Shared between copies, as it never changes once set
+  std::shared_ptr<SparseShapes> sparse_;
+
   friend void swap(Systematic& first, Systematic& second);
+  // Restores the normalised shapes directly in LoadSnapshot
+  friend class CombineHarvester;
 };
 }
 
@@ -0,0 +1,149 @@
+#ifndef CombineTools_TFileCache_h
+#define CombineTools_TFileCache_h
+#include <list>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <unordered_map>
+#include <vector>
+#include "TFile.h"
+#include "TH1.h"
+
+namespace ch {
+/**
+ * Process-wide pool of open TFile handles and of the TH1 objects read from
+ * them
+ *
+ * Opening a file through the cache returns the same shared handle for every
+ * caller until the file on disk changes (as determined by its device, inode,
+ * size and modification time, the latter to the nanosecond where the
+ * filesystem supports it) or the cache is cleared. Histograms requested via
+ * TFileCache::GetClonedTH1 are read and decompressed once, then served as
+ * clones of the in-memory copy. This avoids re-reading the same templates
+ * when many datacards share a small number of shape files, or when the
+ * nominal template is needed for every shape systematic.
+ *
+ * The memory used by the cached histograms is bounded: once it exceeds
+ * TFileCache::SetMaxBytes the least recently used histograms are dropped,
+ * and are read from the file again if they are needed later.
+ *
+ * Histograms can also be read ahead of time on several threads with
+ * TFileCache::Prefetch, each thread using its own TFile handle.
+ *
+ * All methods may be called from several threads.
+ */
+class TFileCache {
+ public:
+  static TFileCache& Instance();
+
+  TFileCache(TFileCache const&) = delete;
+  TFileCache& operator=(TFileCache const&) = delete;
+
+  /**
+   * Get a shared, read-only handle to the file at `path`
+   *
+   * If the file could not be opened the returned TFile is a zombie, and it
+   * is not stored in the pool.
+   */
+  std::shared_ptr<TFile> GetFile(std::string const& path);
+
+  /**
+   * Equivalent to ch::GetClonedTH1, using the in-memory copy of the object
+   * when `file` is a handle from this pool
+   */
+  std::unique_ptr<TH1> GetClonedTH1(TFile* file, std::string const& path);
+
+  /**
+   * Full paths of all TH1 objects in the file at `path`, including those in
+   * subdirectories
+   *
+   * The directory structure is only traversed the first time a file is
+   * listed.
+   */
+  std::vector<std::string> ListTH1Keys(std::string const& path);
+
+  /**
+   * Read the TH1 objects `objects` from the file at `path` into the cache,
+   * spreading the reads over `n_threads` threads
+   *
+   * Objects that are already cached are skipped. Calling this with more than
+   * one thread enables ROOT's thread safety for the rest of the process.
+   */
+  void Prefetch(std::string const& path,
+                std::vector<std::string> const& objects, unsigned n_threads);
+
+  /**
+   * Close all files and drop all cached objects
+   *
+   * Handles that are still held elsewhere stay valid.
+   */
+  void Clear();
+
+  /**
+   * Set the approximate limit on the memory used by the cached histograms,
+   * by default 512 MB
+   *
+   * Histograms are dropped, least recently used first, until the total is
+   * below the new limit. A limit of zero disables the caching of histograms.
+   */
+  void SetMaxBytes(std::size_t max_bytes);
+
+  /**
+   * The approximate memory currently used by the cached histograms
+   */
+  std::size_t CachedBytes();
+
+ private:
+  TFileCache() = default;
+
+  // Identifies the version of a file on disk
+  struct FileStamp {
+    long device;
+    long inode;
+    long size;
+    long mtime_sec;
+    long mtime_nsec;
+    bool operator==(FileStamp const& other) const;
+  };
+
+  // The file path and object path of each cached histogram, most recently
+  // used first
+  typedef std::list<std::pair<std::string, std::string>> LRUList;
+
+  struct CachedHist {
+    std::shared_ptr<TH1 const> hist;
+    std::size_t bytes;
+    LRUList::iterator lru;
+  };
+
+  struct Entry {
+    std::shared_ptr<TFile> file;
+    // Serialises reads on the shared handle
+    std::shared_ptr<std::mutex> io_mutex;
+    FileStamp stamp;
+    bool listed;
+    std::vector<std::string> th1_keys;
+    std::unordered_map<std::string, CachedHist> hists;
+  };
+
+  std::mutex mutex_;
+  std::map<std::string, Entry> files_;
+  std::unordered_map<TFile const*, std::string> paths_;
+  LRUList lru_;
+  std::size_t bytes_ = 0;
+  std::size_t max_bytes_ = std::size_t(512) << 20;
+
+  // These must be called with mutex_ held
+  Entry& GetEntry(std::string const& path);
+  void EraseEntry(std::map<std::string, Entry>::iterator it);
+  void InsertHist(std::string const& path, Entry& entry,
+                  std::string const& obj, std::shared_ptr<TH1 const> hist);
+  void Evict();
+
+  static FileStamp FileStatus(std::string const& path);
+  static std::size_t HistBytes(TH1 const* hist);
+};
+}
+
+#endif
@@ -1,5 +1,7 @@
 #ifndef CombineTools_TFileIO_h
 #define CombineTools_TFileIO_h
+#include <functional>
+#include <map>
 #include <memory>
 #include <string>
 #include <vector>
@@ -16,6 +18,106 @@ std::unique_ptr<TH1> GetClonedTH1(TFile* file, std::string const& path);
 template <class T>
 void WriteToTFile(T * ptr, TFile* file, std::string const& path);
 
+/**
+ * Collects TH1 objects for a TFile and writes them all in one go
+ *
+ * Unlike calling WriteToTFile for each object, the path of each object is
+ * only split once, each directory is looked up or created once, and the
+ * objects are written grouped by directory in order of name, which keeps
+ * the keys of a directory together in the file:
+ *
+ *     ch::TFileBatchWriter writer(&file);
+ *     writer.SetCompression(101);
+ *     for (...) writer.Add("bin/" + process, std::move(hist));
+ *     writer.Write();
+ *
+ * As with WriteToTFile, an object is not written if the directory already
+ * contains a key with the same name, and only the first object added for a
+ * given path is kept.
+ *
+ * Objects that are owned elsewhere, e.g. RooWorkspaces, can be queued as a
+ * `std::shared_ptr`. The file can also be given later with SetFile, so the
+ * objects can be collected and hashed before deciding whether the file
+ * needs to be opened at all.
+ */
+class TFileBatchWriter {
+ public:
+  explicit TFileBatchWriter(TFile* file);
+
+  /**
+   * Set the file the objects are written to
+   */
+  TFileBatchWriter& SetFile(TFile* file);
+
+  /**
+   * The ROOT compression settings (algorithm * 100 + level) used for the
+   * objects written by Write(). The default of -1 keeps the settings of
+   * the file.
+   */
+  TFileBatchWriter& SetCompression(int settings);
+
+  int GetCompression() const { return compression_; }
+
+  /**
+   * The initial size in bytes of the buffer each object is serialised into,
+   * passed on to TDirectory::WriteTObject. A value that fits the typical
+   * object avoids repeated buffer expansion. The default of 0 uses the
+   * ROOT default.
+   */
+  TFileBatchWriter& SetBufferSize(int size);
+
+  /**
+   * Queue `hist` to be written at `path`, which may contain directories
+   */
+  void Add(std::string const& path, std::unique_ptr<TH1> hist);
+
+  /**
+   * Queue an object that may also be owned elsewhere
+   */
+  void Add(std::string const& path, std::shared_ptr<TObject> obj);
+
+  /**
+   * A hash of the serialised form of each queued object, keyed by path
+   *
+   * Each object is streamed into a memory buffer under the name it will be
+   * written with, so two objects with the same hash are written as the same
+   * bytes. The hashes are computed once and kept until another object is
+   * added.
+   */
+  std::map<std::string, std::string> const& Hashes();
+
+  /**
+   * Write and then discard all the queued objects
+   */
+  void Write();
+
+  /**
+   * Bring a file written earlier by this class up to date with the queued
+   * objects, then discard them
+   *
+   * `previous` gives the Hashes() of the objects that were written into the
+   * file before. Only the objects whose hash is new or differs are
+   * (over)written, and keys in `previous` that are no longer queued are
+   * deleted. All other keys are left untouched. The file must be open in
+   * `UPDATE` mode.
+   */
+  void Update(std::map<std::string, std::string> const& previous);
+
+  unsigned size() const;
+
+ private:
+  TFile* file_;
+  int compression_;
+  int buffer_size_;
+  // directory -> object name -> object
+  std::map<std::string, std::map<std::string, std::shared_ptr<TObject>>>
+      objects_;
+  std::map<std::string, std::string> hashes_;
+
+  TDirectory* GetDirectory(std::string const& dir);
+  void WriteObjects(std::function<bool(std::string const&)> const& overwrite);
+};
+
 // Extracts objects from the form:
 // "path/to/a/file.root:path/to/object"
 template <class T>
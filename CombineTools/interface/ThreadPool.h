@@ -0,0 +1,75 @@
+#ifndef CombineTools_ThreadPool_h
+#define CombineTools_ThreadPool_h
+#include <atomic>
+#include <condition_variable>
+#include <exception>
+#include <functional>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+namespace ch {
+/**
+ * A fixed-size pool of worker threads for running independent tasks in
+ * parallel
+ *
+ * The threads are started on construction and wait for work until the pool
+ * is destroyed. Work is submitted with ParallelFor, which blocks until every
+ * task has finished. The calling thread also executes tasks, so a pool
+ * constructed with `n_threads` = 1 simply runs everything serially without
+ * starting any extra thread:
+ *
+ *     ch::ThreadPool pool(8);
+ *     std::vector<double> res(n);
+ *     pool.ParallelFor(n, [&](unsigned i) { res[i] = Compute(i); });
+ *
+ * @note ParallelFor must not be called from inside one of its own tasks
+ */
+class ThreadPool {
+ public:
+  /**
+   * Create a pool that runs tasks on `n_threads` threads in total, including
+   * the caller of ParallelFor. A value of zero is treated as one.
+   */
+  explicit ThreadPool(unsigned n_threads);
+  ~ThreadPool();
+
+  ThreadPool(ThreadPool const&) = delete;
+  ThreadPool& operator=(ThreadPool const&) = delete;
+
+  unsigned NumThreads() const { return workers_.size() + 1; }
+
+  /**
+   * Call `func(i)` for every `i` in [0, `n_tasks`), distributing the calls
+   * over the threads of the pool
+   *
+   * Tasks are handed out in increasing order of `i`, but may complete in any
+   * order. If a task throws, no further tasks are started and the first
+   * exception is rethrown once the running tasks have finished.
+   */
+  void ParallelFor(unsigned n_tasks, std::function<void(unsigned)> const& func);
+
+  /**
+   * The number of hardware threads, or one if this cannot be determined
+   */
+  static unsigned HardwareThreads();
+
+ private:
+  std::vector<std::thread> workers_;
+  std::mutex mutex_;
+  std::condition_variable start_cv_;
+  std::condition_variable done_cv_;
+  std::function<void(unsigned)> const* func_;
+  unsigned n_tasks_;
+  std::atomic<unsigned> next_;
+  unsigned active_;
+  unsigned long epoch_;
+  bool stop_;
+  std::exception_ptr error_;
+
+  void WorkerLoop();
+  void RunTasks();
+};
+}
+
+#endif
@@ -10,6 +10,7 @@
 #include "boost/lexical_cast.hpp"
 #include "boost/regex.hpp"
 #include "boost/filesystem.hpp"
+#include "boost/functional/hash.hpp"
 #include "TGraph.h"
 #include "RooFitResult.h"
 #include "RooArgSet.h"
@@ -55,6 +56,27 @@ bool MatchingProcess(T const& first, U const& second) {
   }
 }
 
+/**
+ * Hash of the properties compared by ch::MatchingProcess
+ *
+ * Any two objects for which MatchingProcess returns true will give the same
+ * hash value, so this can be used to build lookup tables of matching objects
+ * without comparing every pair.
+ */
+template<class T>
+std::size_t MatchingProcessHash(T const& obj) {
+  std::size_t seed = 0;
+  boost::hash_combine(seed, obj.bin());
+  boost::hash_combine(seed, obj.process());
+  boost::hash_combine(seed, obj.signal());
+  boost::hash_combine(seed, obj.analysis());
+  boost::hash_combine(seed, obj.era());
+  boost::hash_combine(seed, obj.channel());
+  boost::hash_combine(seed, obj.bin_id());
+  boost::hash_combine(seed, obj.mass());
+  return seed;
+}
+
 template<class T, class U>
 void SetProperties(T * first, U const* second) {
   first->set_bin(second->bin());
@@ -168,6 +190,14 @@ bool HasNegativeBins(TH1 const* h);
 
 void ZeroNegativeBins(TH1 *h);
 
+/**
+ * A 64-bit FNV-1a hash of `size` bytes, as a 16-digit hex string
+ *
+ * Unlike std::hash the result is the same on every platform and in every
+ * process, so it can be stored in files and compared between runs.
+ */
+std::string ContentHash(char const* data, std::size_t size);
+
 // ---------------------------------------------------------------------------
 // Tuple Printing
 // ---------------------------------------------------------------------------
@@ -130,6 +130,40 @@ def AddSyst(self, target, name, type, valmap):
         for proc in added_procs:
             print proc
 
+# Batched evaluation: values is an array of shape (n_points, len(params)),
+# returns a numpy array of n_points rates or (n_points, n_bins) bin contents
+
+
+def _AsParameterMatrix(params, values):
+    import numpy as np
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    if len(params) == 0:
+        # With no columns only the number of rows can be taken from values
+        return values.reshape(values.shape[0] if values.ndim > 0 else 1, 0)
+    return values.reshape(-1, len(params))
+
+
+def GetRates(self, params, values):
+    import numpy as np
+    values = _AsParameterMatrix(params, values)
+    if values.shape[1] == 0:
+        # Every point has the current parameter values
+        return np.full(values.shape[0], self.GetRate())
+    raw = self.__GetRates__(list(params), values)
+    return np.frombuffer(raw, dtype=np.float64)
+
+
+def GetShapes(self, params, values):
+    import numpy as np
+    values = _AsParameterMatrix(params, values)
+    if values.shape[1] == 0:
+        shape = self.GetShape()
+        row = [shape.GetBinContent(i) for i in xrange(1, shape.GetNbinsX() + 1)]
+        return np.tile(np.array(row, dtype=np.float64), (values.shape[0], 1))
+    raw = self.__GetShapes__(list(params), values)
+    res = np.frombuffer(raw, dtype=np.float64)
+    return res.reshape(values.shape[0], -1) if values.shape[0] > 0 else res.reshape(0, 0)
+
 # Now we turn these free functions into member functions
 # of the CombineHarvester class
 CombineHarvester.ParseDatacard = ParseDatacard
@@ -140,3 +174,5 @@ CombineHarvester.SetFromObs = SetFromObs
 CombineHarvester.SetFromProcs = SetFromProcs
 CombineHarvester.SetFromSysts = SetFromSysts
 CombineHarvester.AddSyst = AddSyst
+CombineHarvester.GetRates = GetRates
+CombineHarvester.GetShapes = GetShapes
@@ -1,7 +1,12 @@
+import math
 import os
+import socket
 import stat
+import subprocess
+import time
 from functools import partial
 from multiprocessing import Pool
+from CombineHarvester.CombineTools.combine.TaskDB import TaskDB, command_hash
 
 DRY_RUN = False
 
@@ -88,6 +93,116 @@ def run_command(dry_run, command, pre_cmd=''):
         print '[DRY-RUN]: ' + command
 
 
+class JobEstimate:
+    """
+    The relative cost of a queued command, used to order the jobs, and the
+    expected peak memory [MB] of the process it starts
+    """
+    def __init__(self, cost, memory=0., label=None):
+        self.cost = cost
+        self.memory = memory
+        self.label = label
+
+
+def run_command_stats(dry_run, command, pre_cmd=''):
+    """
+    As run_command, but returns the exit code, runtime [s] and peak memory
+    [MB] of the command
+    """
+    if command.startswith('combine'):
+        command = pre_cmd + command
+    if dry_run:
+        print '[DRY-RUN]: ' + command
+        return (None, None, None)
+    print '>> ' + command
+    start = time.time()
+    proc = subprocess.Popen(command, shell=True)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    return (proc.returncode, time.time() - start, usage.ru_maxrss / 1024.)
+
+
+def run_scheduled(dry_run, commands, estimates, max_jobs, memory_budget=None, pre_cmd='', stats=None):
+    """
+    Run commands in up to max_jobs processes at once, longest processing time
+    first: whenever a process slot is free the most costly remaining command
+    that fits into memory_budget [MB] is started. A command too large for
+    the budget is only started when nothing else is running. Commands
+    without an entry in the estimates dict are treated as having zero cost
+    and memory. A line is printed as each command starts and finishes.
+    Returns the exit codes in the order of commands. If a stats dict is
+    given, it is filled with the runtime [s] and peak memory [MB] of each
+    command, keyed by position.
+    """
+    def estimate(i):
+        return estimates.get(commands[i], JobEstimate(0.))
+    pending = sorted(range(len(commands)), key=lambda i: -estimate(i).cost)
+    codes = [None] * len(commands)
+    if dry_run:
+        for i in pending:
+            codes[i] = run_command(dry_run, commands[i], pre_cmd)
+        return codes
+    running = {}
+    used = 0.
+    t_begin = time.time()
+    while pending or running:
+        while pending and len(running) < max_jobs:
+            fits = [i for i in pending if memory_budget is None or
+                    used + estimate(i).memory <= memory_budget]
+            if not fits and running:
+                break
+            i = fits[0] if fits else pending[0]
+            pending.remove(i)
+            est = estimate(i)
+            if memory_budget is not None and est.memory > memory_budget:
+                print '>> Estimated memory %.0f MB exceeds the budget of %.0f MB' % (est.memory, memory_budget)
+            command = commands[i]
+            if command.startswith('combine'):
+                command = pre_cmd + command
+            print '>> [%i running, %i pending] ' % (len(running) + 1, len(pending)) + command
+            proc = subprocess.Popen(command, shell=True)
+            running[proc.pid] = (i, time.time(), proc)
+            used += est.memory
+        pid, status, usage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        i, t_start, proc = running.pop(pid)
+        used -= estimate(i).memory
+        codes[i] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        # Already reaped, so subprocess must not wait for it again
+        proc.returncode = codes[i]
+        if stats is not None:
+            stats[i] = (time.time() - t_start, usage.ru_maxrss / 1024.)
+        n_done = len([x for x in codes if x is not None])
+        print '>> [%i/%i] %s in %.1fs (exit code %i): %s' % (
+            n_done, len(commands), 'finished' if codes[i] == 0 else 'FAILED',
+            time.time() - t_start, codes[i], estimate(i).label or commands[i])
+    print '>> Ran %i jobs in %.1fs' % (len(commands), time.time() - t_begin)
+    return codes
+
+
+def estimate_runtime(command):
+    """
+    A rough relative runtime of a combine command: the number of grid points
+    for a --firstPoint/--lastPoint slice, times the number of toys for -t N,
+    and 1 otherwise
+    """
+    args = command.split()
+    def value(names):
+        for name in names:
+            if name in args and args.index(name) + 1 < len(args):
+                return args[args.index(name) + 1]
+        return None
+    res = 1.
+    first, last = value(['--firstPoint']), value(['--lastPoint'])
+    if first is not None and last is not None and first.isdigit() and last.isdigit():
+        res *= max(1, int(last) - int(first) + 1)
+    toys = value(['-t', '--toys'])
+    if toys is not None and toys.isdigit() and int(toys) > 0:
+        res *= int(toys)
+    return res
+
+
 class CombineToolBase:
     description = 'Base class that passes through all arguments to combine and handles job creation and submission'
     requires_root = False
@@ -101,6 +216,7 @@ class CombineToolBase:
         self.prefix_file = ''
         self.parallel = 1
         self.merge = 1
+        self.merge_strategy = 'position'
         self.task_name = 'combine_task'
         self.dry_run = False
         self.bopts = ''  # batch submission options
@@ -108,10 +224,16 @@ class CombineToolBase:
         self.custom_crab_post = None
         self.pre_cmd = ''
         self.crab_files = []
+        self.memory_budget = None
+        # Optional JobEstimate for each command in job_queue
+        self.job_estimates = {}
+        self.worker_pool = None
+        self.task_db_path = None
+        self.task_db = None
 
     def attach_job_args(self, group):
         group.add_argument('--job-mode', default=self.job_mode, choices=[
-                           'interactive', 'script', 'lxbatch', 'SGE', 'slurm', 'condor', 'crab3'], help='Task execution mode')
+                           'interactive', 'workers', 'script', 'lxbatch', 'SGE', 'slurm', 'condor', 'crab3'], help='Task execution mode. The workers mode runs the jobs in --parallel long-lived worker processes that are kept for the whole task. MultiDimFit --algo impact and --algo grid commands on a workspace, with the options the workers support, are run inside the workers instead of as a new combine process, loading each workspace once per worker')
         group.add_argument('--job-dir', default=self.job_dir,
                            help='Path to directory containing job scripts and logs')
         group.add_argument('--prefix-file', default=self.prefix_file,
@@ -120,8 +242,18 @@ class CombineToolBase:
                            help='Task name, used for job script and log filenames for batch system tasks')
         group.add_argument('--parallel', type=int, default=self.parallel,
                            help='Number of jobs to run in parallel [only affects interactive job-mode]')
+        group.add_argument('--memory-budget', type=float, default=self.memory_budget,
+                           help='Total memory [MB] that jobs running at once may use, according to the estimate of each job where the method provides one. Jobs are also started most costly first. [only affects interactive job-mode]')
         group.add_argument('--merge', type=int, default=self.merge,
                            help='Number of jobs to run in a single script [only affects batch submission]')
+        group.add_argument('--merge-strategy', default=self.merge_strategy, choices=['position', 'workspace'],
+                           help='How --merge groups the jobs: "position" takes consecutive jobs from the queue, "workspace" only puts jobs using the same -d workspace in a script, and balances the scripts by estimated runtime [only affects batch submission]')
+        group.add_argument('--task-db', default=self.task_db_path,
+                           help='SQLite file recording the status, exit code, runtime and peak memory of each command. Commands run in batch job scripts report back through a journal file next to it, which must be reachable from the batch nodes [not supported for crab3]')
+        group.add_argument('--resubmit-failed', action='store_true',
+                           help='Only run the commands that are not recorded as successful with an existing output in the --task-db')
+        group.add_argument('--task-status', action='store_true',
+                           help='Print the status of the commands of this task from the --task-db instead of running them')
         group.add_argument('--dry-run', action='store_true',
                            help='Print commands to the screen but do not run them')
         group.add_argument('--sub-opts', default=self.bopts,
@@ -153,6 +285,8 @@ class CombineToolBase:
         self.task_name = self.args.task_name
         self.parallel = self.args.parallel
         self.merge = self.args.merge
+        self.merge_strategy = self.args.merge_strategy
+        self.memory_budget = self.args.memory_budget
         self.dry_run = self.args.dry_run
         self.passthru.extend(unknown)
         self.bopts = self.args.sub_opts
@@ -162,6 +296,13 @@ class CombineToolBase:
         self.crab_files = self.args.crab_extra_files
         self.pre_cmd = self.args.pre_cmd
         self.custom_crab_post = self.args.custom_crab_post
+        self.task_db_path = self.args.task_db
+        self.resubmit_failed = self.args.resubmit_failed
+        self.task_status = self.args.task_status
+        if self.task_db_path is not None:
+            self.task_db = TaskDB(self.task_db_path)
+        elif self.resubmit_failed or self.task_status:
+            raise RuntimeError('--resubmit-failed and --task-status require --task-db')
 
     def put_back_arg(self, arg_name, target_name):
         if hasattr(self.args, arg_name):
@@ -190,8 +331,8 @@ class CombineToolBase:
                 log_part = '\n'
                 if do_log: log_part = ' 2>&1 | %s ' % tee + logname + log_part
                 if command.startswith('combine') or command.startswith('pushd'):
-                    text_file.write(
-                        self.pre_cmd + 'eval ' + command + log_part)
+                    text_file.write(self.journal_line(
+                        command, self.pre_cmd + 'eval ' + command + log_part))
                 else:
                     text_file.write(command)
         st = os.stat(fname)
@@ -215,11 +356,119 @@ class CombineToolBase:
                 assert idx != -1 and idx < len(cmd_list)
                 return cmd_list[idx + 1]
         raise RuntimeError('The workspace argument must be specified explicity with -d or --datacard')
+    def journal_line(self, command, line):
+        """The script line for command, reporting to the task database journal if there is one"""
+        if self.task_db is None:
+            return line
+        return self.task_db.journal_wrap(command, line)
+
+    def merged_jobs(self):
+        """
+        Split the job queue into the lists of commands to run in each batch
+        job script, following --merge and --merge-strategy
+        """
+        if self.merge_strategy == 'position':
+            return [self.job_queue[j:j + self.merge] for j in range(0, len(self.job_queue), self.merge)]
+        def runtime(cmd):
+            est = self.job_estimates.get(cmd)
+            return est.cost if est is not None else estimate_runtime(cmd)
+        position = {}
+        for i, cmd in enumerate(self.job_queue):
+            position.setdefault(cmd, i)
+        by_wsp = {}
+        wsp_order = []
+        for cmd in self.job_queue:
+            try:
+                wsp = self.extract_workspace_arg(cmd.split())
+            except RuntimeError:
+                wsp = None
+            if wsp not in by_wsp:
+                by_wsp[wsp] = []
+                wsp_order.append(wsp)
+            by_wsp[wsp].append(cmd)
+        # Each script gets about as much work as 'merge' jobs of median
+        # runtime. The commands for each workspace are spread over just
+        # enough scripts, always adding the next longest command to the
+        # script with the least work so far
+        runtimes = sorted([runtime(cmd) for cmd in self.job_queue])
+        target = self.merge * runtimes[len(runtimes) / 2] if runtimes else 0.
+        res = []
+        for wsp in wsp_order:
+            cmds = sorted(by_wsp[wsp], key=runtime, reverse=True)
+            total = sum([runtime(cmd) for cmd in cmds])
+            n_scripts = max(1, min(len(cmds), int(math.ceil(total / target - 1E-9)) if target > 0 else len(cmds)))
+            scripts = [[] for i in range(n_scripts)]
+            loads = [0.] * n_scripts
+            for cmd in cmds:
+                i = loads.index(min(loads))
+                scripts[i].append(cmd)
+                loads[i] += runtime(cmd)
+            # Keep the queue order within each script
+            for script in scripts:
+                script.sort(key=lambda cmd: position[cmd])
+            if len(by_wsp) > 1 or wsp is not None:
+                print '>> Workspace %s: %i jobs in %i scripts' % (wsp, len(cmds), n_scripts)
+            res.extend(scripts)
+        return res
+
     def flush_queue(self):
+        if self.task_db is not None:
+            if self.task_status:
+                self.task_db.summary(self.job_queue)
+                del self.job_queue[:]
+                self.job_estimates.clear()
+                return
+            if self.resubmit_failed:
+                n_total = len(self.job_queue)
+                self.job_queue[:] = [cmd for cmd in self.job_queue if self.task_db.needs_run(cmd)]
+                print '>> Running %i of %i commands that have not succeeded' % (len(self.job_queue), n_total)
+            if not self.dry_run:
+                self.task_db.record_submitted(self.task_name, self.job_queue)
+        # Exit code, runtime and peak memory of the commands run here
+        local_results = {}
         if self.job_mode == 'interactive':
-            pool = Pool(processes=self.parallel)
-            result = pool.map(
-                partial(run_command, self.dry_run, pre_cmd=self.pre_cmd), self.job_queue)
+            if self.job_estimates or self.memory_budget is not None:
+                stats = {}
+                result = run_scheduled(
+                    self.dry_run, self.job_queue, self.job_estimates, self.parallel,
+                    self.memory_budget, self.pre_cmd, stats)
+                for i in stats:
+                    local_results[i] = (result[i],) + stats[i]
+            elif self.task_db is not None:
+                pool = Pool(processes=self.parallel)
+                result = pool.map(
+                    partial(run_command_stats, self.dry_run, pre_cmd=self.pre_cmd), self.job_queue)
+                local_results = dict(enumerate(result))
+            else:
+                pool = Pool(processes=self.parallel)
+                result = pool.map(
+                    partial(run_command, self.dry_run, pre_cmd=self.pre_cmd), self.job_queue)
+        if self.job_mode == 'workers':
+            # MultiDimFit impact and grid fits run inside the workers, using
+            # a workspace and NLL that each worker loads only once. With
+            # --pre-cmd the commands are kept, as the prefix must wrap them.
+            jobs = list(self.job_queue)
+            if self.pre_cmd == '':
+                from CombineHarvester.CombineTools.combine.WorkerFits import command_task
+                jobs = [command_task(cmd) or cmd for cmd in jobs]
+            if self.worker_pool is None and not self.dry_run:
+                from CombineHarvester.CombineTools.combine.Workers import WorkerPool
+                self.worker_pool = WorkerPool(self.parallel, self.requires_root or jobs != self.job_queue)
+            if self.dry_run:
+                for job in jobs:
+                    print '[DRY-RUN]: ' + str(job)
+            else:
+                stats = {}
+                result = self.worker_pool.run(
+                    jobs, pre_cmd=self.pre_cmd, estimates=self.job_estimates, stats=stats)
+                for i in stats:
+                    local_results[i] = (result[i][0],) + stats[i]
+        if self.task_db is not None and not self.dry_run:
+            host = socket.gethostname()
+            for i, (code, runtime, peak_memory) in local_results.iteritems():
+                self.task_db.record_result(
+                    command_hash(self.job_queue[i]), code, runtime, peak_memory, host, commit=False)
+            self.task_db.conn.commit()
         script_list = []
         if self.job_mode in ['script', 'lxbatch', 'SGE', 'slurm']:
             if self.prefix_file != '':
@@ -235,7 +484,7 @@ class CombineToolBase:
                 })
                 job_prefix_file.close()
         if self.job_mode in ['script', 'lxbatch', 'SGE']:
-            for i, j in enumerate(range(0, len(self.job_queue), self.merge)):
+            for i, commands in enumerate(self.merged_jobs()):
                 script_name = 'job_%s_%i.sh' % (self.task_name, i)
                 # each job is given a slice from the list of combine commands of length 'merge'
                 # we also keep track of the files that were created in case submission to a
@@ -245,7 +494,7 @@ class CombineToolBase:
                     os.makedirs(self.job_dir)
                   script_name = os.path.join(self.job_dir,script_name)
                 self.create_job_script(
-                    self.job_queue[j:j + self.merge], script_name, self.job_mode == 'script')
+                    commands, script_name, self.job_mode == 'script')
                 script_list.append(script_name)
         if self.job_mode == 'lxbatch':
             for script in script_list:
@@ -266,10 +515,10 @@ class CombineToolBase:
             commands = []
             jobs = 0
             # each job is given a slice from the list of combine commands of length 'merge'
-            for j in range(0, len(self.job_queue), self.merge):
+            for group in self.merged_jobs():
                 jobs += 1
                 commands += ["if [ ${SLURM_ARRAY_TASK_ID} -eq %i ]; then\n" % jobs,
-                        ]+["  %s\n" % ln for ln in self.job_queue[j:j + self.merge]]+["fi\n"]
+                        ]+[self.journal_line(ln, '  %s\n' % ln) for ln in group]+["fi\n"]
             self.create_job_script(commands, script_name, self.job_mode == "script")
             full_script = os.path.abspath(script_name)
             logname = full_script.replace('.sh', '_%A_%a.log')
@@ -282,12 +531,12 @@ class CombineToolBase:
             outscript.write(JOB_PREFIX)
             jobs = 0
             wsp_files = set()
-            for i, j in enumerate(range(0, len(self.job_queue), self.merge)):
+            for group in self.merged_jobs():
                 outscript.write('\nif [ $1 -eq %i ]; then\n' % jobs)
                 jobs += 1
-                for line in self.job_queue[j:j + self.merge]:
+                for line in group:
                     newline = self.pre_cmd + line
-                    outscript.write('  ' + newline + '\n')
+                    outscript.write(self.journal_line(line, '  ' + newline + '\n'))
                 outscript.write('fi')
             outscript.close()
             st = os.stat(outscriptname)
@@ -316,10 +565,10 @@ class CombineToolBase:
             wsp_files = set()
             for extra in self.crab_files:
                 wsp_files.add(extra)
-            for i, j in enumerate(range(0, len(self.job_queue), self.merge)):
+            for group in self.merged_jobs():
                 jobs += 1
                 outscript.write('\nif [ $1 -eq %i ]; then\n' % jobs)
-                for line in self.job_queue[j:j + self.merge]:
+                for line in group:
                     newline = line
                     if line.startswith('combine'): newline = self.pre_cmd + line.replace('combine', './combine', 1)
                     wsp = str(self.extract_workspace_arg(newline.split()))
@@ -358,3 +607,4 @@ class CombineToolBase:
                 except HTTPException, hte:
                     print hte.headers
         del self.job_queue[:]
+        self.job_estimates.clear()
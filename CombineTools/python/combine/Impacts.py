@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import argparse
+import os
 import sys
 import re
 import json
@@ -51,9 +53,28 @@ class Impacts(CombineToolBase):
             listed as nuisance parameters""")
         group.add_argument('--output', '-o', help="""write output json to a
             file""")
-        group.add_argument('--approx', default=None, choices=['hesse', 'robust'],
-            help="""Calculate impacts using the covariance matrix instead""")
+        group.add_argument('--approx', default=None, choices=['hesse', 'robust', 'hybrid'],
+            help="""Calculate impacts using the covariance matrix instead. With
+            hybrid the parameters are ranked by their covariance matrix impact
+            and exact fits are run for the highest ranked ones, see
+            --exact-top and --exact-threshold. Run --doFits twice in this mode:
+            first for the covariance matrix fit, then for the exact fits""")
+        group.add_argument('--exact-top', type=int, default=30, help="""With
+            --approx hybrid, run exact fits for this many of the parameters
+            with the largest impacts. Combined with the parameters selected by
+            --exact-threshold if that is also given, use --exact-top 0 to
+            select by the threshold alone""")
+        group.add_argument('--exact-threshold', type=float, default=None, help="""With
+            --approx hybrid, also run exact fits for every parameter with an
+            approximate impact larger than this fraction of the uncertainty of
+            any POI, in addition to the --exact-top parameters""")
         group.add_argument('--noInitialFit', action='store_true', default=False, help="""Do not look for results from the initial Fit""")
+        group.add_argument('--in-process', action='store_true', help="""Run
+            the initial fit and all the parameter fits in this process instead
+            of as combine jobs, loading the workspace and building the NLL only
+            once. The fits are shared between --parallel forked processes.
+            Replaces --doInitialFit and --doFits, the output is written
+            straight away""")
         
 
     def run_method(self):
@@ -76,6 +97,12 @@ class Impacts(CombineToolBase):
             self.args.setPhysicsModelParameters = self.args.setParameters
         pass_str = ' '.join(passthru)
 
+        if self.args.in_process:
+            if self.args.approx is not None or self.args.noInitialFit:
+                print 'Error: --in-process can\'t be used with --approx or --noInitialFit'
+                sys.exit(1)
+            engine_opts = self.in_process_options(passthru)
+
         paramList = []
         if self.args.redefineSignalPOIs is not None:
             poiList = self.args.redefineSignalPOIs.split(',')
@@ -84,7 +111,11 @@ class Impacts(CombineToolBase):
         print 'Have POIs: ' + str(poiList)
         poistr = ','.join(poiList)
 
-        if self.args.approx == 'hesse' and self.args.doFits:
+        approxFile = 'multidimfit_approxFit_%(name)s.root' % {'name': name}
+        if self.args.approx == 'hybrid' and self.args.doFits and os.path.isfile(approxFile):
+            # Go on to run the exact fits for the highest ranked parameters
+            pass
+        elif self.args.approx in ['hesse', 'hybrid'] and self.args.doFits:
             self.job_queue.append(
                 'combine -M MultiDimFit -n _approxFit_%(name)s --algo none --redefineSignalPOIs %(poistr)s --floatOtherPOIs 1 --saveInactivePOI 1 --saveFitResult %(pass_str)s' % {
                     'name': name,
@@ -109,7 +140,7 @@ class Impacts(CombineToolBase):
         if self.args.doInitialFit and self.args.approx is not None:
             print 'No --initialFit needed with --approx, use --output directly'
             sys.exit(0)
-        if self.args.doInitialFit:
+        if self.args.doInitialFit and not self.args.in_process:
             if self.args.splitInitial:
                 for poi in poiList:
                     self.job_queue.append(
@@ -129,22 +160,34 @@ class Impacts(CombineToolBase):
             self.flush_queue()
             sys.exit(0)
 
+        if self.args.in_process:
+            from CombineHarvester.CombineTools.combine.ImpactsEngine import ImpactsEngine, run_impacts
+            engine = ImpactsEngine(ws, poiList, mass=mh, setPars=self.args.setPhysicsModelParameters, **engine_opts)
+            initialRes = engine.initial_fit()
+
+        # Read the covariance matrix fit, which is needed for the parameter
+        # impacts whether or not the POI results are used
+        if self.args.approx in ['hesse', 'hybrid']:
+            fResult = ROOT.TFile(approxFile)
+            rfr = fResult.Get('fit_mdf')
+            fResult.Close()
+            if rfr == None:
+                print 'Error: no fit result found in %s, run with --doFits first' % approxFile
+                sys.exit(1)
+        elif self.args.approx == 'robust':
+            fResult = ROOT.TFile('robustHesse_approxFit_%(name)s.root' % {'name': name})
+            floatParams = fResult.Get('floatParsFinal')
+            rfr = fResult.Get('h_correlation')
+            rfr.SetDirectory(0)
+            fResult.Close()
+
         # Read the initial fit results
-        if not self.args.noInitialFit:
+        if not self.args.noInitialFit and not self.args.in_process:
             initialRes = {}
-            if self.args.approx is not None:
-                if self.args.approx == 'hesse':
-                    fResult = ROOT.TFile('multidimfit_approxFit_%(name)s.root' % {'name': name})
-                    rfr = fResult.Get('fit_mdf')
-                    fResult.Close()
-                    initialRes = utils.get_roofitresult(rfr, poiList, poiList)
-                elif self.args.approx == 'robust':
-                    fResult = ROOT.TFile('robustHesse_approxFit_%(name)s.root' % {'name': name})
-                    floatParams = fResult.Get('floatParsFinal')
-                    rfr = fResult.Get('h_correlation')
-                    rfr.SetDirectory(0)
-                    fResult.Close()
-                    initialRes = utils.get_robusthesse(floatParams, rfr, poiList, poiList)
+            if self.args.approx in ['hesse', 'hybrid']:
+                initialRes = utils.get_roofitresult(rfr, poiList, poiList)
+            elif self.args.approx == 'robust':
+                initialRes = utils.get_robusthesse(floatParams, rfr, poiList, poiList)
             elif self.args.splitInitial:
                 for poi in poiList:
                     initialRes.update(utils.get_singles_results(
@@ -181,7 +224,7 @@ class Impacts(CombineToolBase):
 
         print 'Have parameters: ' + str(len(paramList))
 
-        prefit = utils.prefit_from_workspace(ws, 'w', paramList, self.args.setPhysicsModelParameters)
+        prefit = utils.prefit_from_workspace(ws, 'w', paramList, self.args.setPhysicsModelParameters, processes=self.parallel)
         res = {}
         if not self.args.noInitialFit:
             res["POIs"] = []
@@ -190,25 +233,60 @@ class Impacts(CombineToolBase):
             for poi in poiList:
                 res["POIs"].append({"name": poi, "fit": initialRes[poi][poi]})
 
+        # The parameters that get exact fits
+        exactList = paramList
+        if self.args.approx == 'hybrid':
+            approxRes = {}
+            for param in paramList:
+                approxRes[param] = utils.get_roofitresult(rfr, [param], poiList + [param])
+                if approxRes[param] is None:
+                    sys.exit(1)
+            poiErrors = dict([(poi, rfr.floatParsFinal().find(poi).getError()) for poi in poiList])
+            exactList = self.rank_exact(approxRes, poiList, poiErrors)
+            nTop = min(len(paramList), max(0, self.args.exact_top))
+            print 'Running exact fits for %i of %i parameters (%i from --exact-top, %i more from --exact-threshold)' % (
+                len(exactList), len(paramList), nTop, len(exactList) - nTop)
+        elif self.args.approx is not None:
+            exactList = []
+
+        paramFitRes = {}
+        if self.args.in_process:
+            paramFitRes = run_impacts(engine, paramList, self.parallel)
+        elif not self.args.doFits and len(exactList) > 0:
+            # Harvest all the parameter fits in one go
+            paramFitRes = utils.get_impact_results(dict([(param,
+                'higgsCombine_paramFit_%s_%s.MultiDimFit.mH%s.root' % (name, param, mh)) for param in exactList]), poiList)
+
         missing = []
+        notExact = []
         for param in paramList:
             pres = {'name': param}
             pres.update(prefit[param])
             # print 'Doing param ' + str(counter) + ': ' + param
-            if self.args.doFits:
+            if self.args.doFits and not self.args.in_process:
+                if param not in exactList:
+                    continue
                 self.job_queue.append(
                     'combine -M MultiDimFit -n _paramFit_%(name)s_%(param)s --algo impact --redefineSignalPOIs %(poistr)s -P %(param)s --floatOtherPOIs 1 --saveInactivePOI 1 %(pass_str)s' % vars())
             else:
-                if self.args.approx == 'hesse':
+                if self.args.approx is None:
+                    paramScanRes = paramFitRes if param in paramFitRes else None
+                elif self.args.approx == 'hybrid':
+                    if param in paramFitRes:
+                        paramScanRes = paramFitRes
+                        pres['method'] = 'default'
+                    else:
+                        if param in exactList:
+                            notExact.append(param)
+                        paramScanRes = approxRes[param]
+                        pres['method'] = 'hesse'
+                elif self.args.approx == 'hesse':
                     paramScanRes = utils.get_roofitresult(rfr, [param], poiList + [param])
                 elif self.args.approx == 'robust':
                     if floatParams.find(param):
                         paramScanRes = utils.get_robusthesse(floatParams, rfr, [param], poiList + [param])
                     else:
                         paramScanRes = None
-                else:
-                    paramScanRes = utils.get_singles_results(
-                        'higgsCombine_paramFit_%(name)s_%(param)s.MultiDimFit.mH%(mh)s.root' % vars(), [param], poiList + [param])
                 if paramScanRes is None:
                     missing.append(param)
                     continue
@@ -223,6 +301,8 @@ class Impacts(CombineToolBase):
                 res['method'] = 'hesse'
         elif self.args.approx == 'robust':
                 res['method'] = 'robust'
+        elif self.args.approx == 'hybrid':
+                res['method'] = 'hybrid'
         else:
                 res['method'] = 'default'
         jsondata = json.dumps(
@@ -233,6 +313,58 @@ class Impacts(CombineToolBase):
                 out_file.write(jsondata)
         if len(missing) > 0:
             print 'Missing inputs: ' + ','.join(missing)
+        if len(notExact) > 0:
+            print 'Missing exact fits, using the approximation for: ' + ','.join(notExact)
+
+    def rank_exact(self, approxRes, pois, poiErrors):
+        """
+        The parameters to run exact fits for in the hybrid mode, given the
+        covariance matrix results: the union of the --exact-top parameters
+        with the largest impact relative to the uncertainty of a POI and of
+        those with a relative impact above --exact-threshold. With
+        --exact-top 0 only the threshold is used.
+        """
+        def rel_impact(param):
+            res = 0.
+            for poi in pois:
+                lo, best, hi = approxRes[param][param][poi]
+                if poiErrors[poi] > 0.:
+                    res = max(res, abs(hi - best) / poiErrors[poi])
+            return res
+        ranked = sorted(approxRes.keys(), key=rel_impact, reverse=True)
+        res = ranked[:max(0, self.args.exact_top)]
+        if self.args.exact_threshold is not None:
+            res.extend([x for x in ranked[len(res):] if rel_impact(x) > self.args.exact_threshold])
+        return res
+
+    def in_process_options(self, passthru):
+        """
+        The ImpactsEngine options for the combine options in passthru. Exits
+        if there are any that --in-process doesn't support.
+        """
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('-m', '--mass')
+        parser.add_argument('-d', '--datacard')
+        parser.add_argument('--setParameters')
+        parser.add_argument('--setPhysicsModelParameters')
+        parser.add_argument('-D', '--dataset', default='data_obs')
+        parser.add_argument('--freezeParameters')
+        parser.add_argument('--setParameterRanges')
+        parser.add_argument('--cminDefaultMinimizerStrategy', type=int, default=1)
+        parser.add_argument('--cminDefaultMinimizerTolerance', type=float, default=0.1)
+        parser.add_argument('--cminDefaultMinimizerType', default='Minuit2')
+        known, unknown = parser.parse_known_args(passthru)
+        if len(unknown) > 0:
+            print 'Error: options not supported with --in-process: ' + ' '.join(unknown)
+            sys.exit(1)
+        return {
+            'dataset': known.dataset,
+            'freezePars': known.freezeParameters,
+            'parRanges': known.setParameterRanges,
+            'strategy': known.cminDefaultMinimizerStrategy,
+            'tolerance': known.cminDefaultMinimizerTolerance,
+            'minimizer': known.cminDefaultMinimizerType
+        }
 
     def all_free_parameters(self, file, wsp, mc, pois):
         res = []
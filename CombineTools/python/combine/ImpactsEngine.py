@@ -0,0 +1,255 @@
+import os
+import traceback
+from multiprocessing import Pool
+
+import ROOT
+from CombineHarvester.CombineTools.combine.Workers import get_workspace
+
+try:
+    from HiggsAnalysis.CombinedLimit.RooAddPdfFixer import FixAll
+except ImportError:
+    def FixAll(workspace): pass
+
+# The engine used by the forked worker processes, which inherit it from the
+# parent copy-on-write
+_ENGINE = None
+# The parameter state of each workspace as it was read from the file
+_FILE_STATES = {}
+
+
+def workspace_state(ws):
+    """
+    The value, range and constant flag of every variable and the index and
+    constant flag of every category in ws
+    """
+    res = {}
+    for coll in [ws.allVars(), ws.allCats()]:
+        it = coll.createIterator()
+        var = it.Next()
+        while var:
+            if var.IsA().InheritsFrom(ROOT.RooRealVar.Class()):
+                res[var.GetName()] = (var.getVal(), (var.getMin(), var.getMax()), var.isConstant())
+            else:
+                res[var.GetName()] = (var.getIndex(), None, var.isConstant())
+            var = it.Next()
+    return res
+
+
+def set_workspace_state(ws, state):
+    """Restore a state of ws returned by workspace_state"""
+    for name, (val, rng, const) in state.iteritems():
+        if rng is None:
+            var = ws.cat(name)
+            var.setIndex(val)
+        else:
+            var = ws.var(name)
+            var.setRange(rng[0], rng[1])
+            var.setVal(val)
+        var.setConstant(const)
+
+
+class ImpactsEngine:
+    """
+    Nuisance parameter impacts computed inside one process
+
+    The workspace is loaded and the NLL built once. After the global fit the
+    values of all the parameters are saved as a snapshot, and each impact
+    starts from this snapshot: the +/-1 sigma crossings of the parameter are
+    found with Minos, then the parameter is fixed at each crossing and the
+    other parameters are refitted, as in combine's MultiDimFit --algo impact.
+
+    The results use the same format as utils.get_singles_results, i.e.
+    {param: {param: [lo, best, hi], POI: [at lo, best, at hi]}}.
+
+    The workspace is obtained from Workers.get_workspace, so it is shared by
+    all the engines for the same file in a process. Each engine is set up
+    from the state the workspace had in the file, whatever the other
+    engines changed, and activate() must be called before using an engine
+    after another one has used the workspace. If pois is None the POIs of
+    the ModelConfig are used.
+    """
+    def __init__(self, filename, pois, wsname='w', mc='ModelConfig', dataset='data_obs',
+                 mass=None, setPars=None, freezePars=None, parRanges=None,
+                 strategy=1, tolerance=0.1, minimizer='Minuit2'):
+        ROOT.gSystem.Load('libHiggsAnalysisCombinedLimit')
+        ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
+        self.ws = get_workspace(filename, wsname)
+        ws_key = (os.path.abspath(filename), wsname)
+        if ws_key in _FILE_STATES:
+            set_workspace_state(self.ws, _FILE_STATES[ws_key])
+        else:
+            _FILE_STATES[ws_key] = workspace_state(self.ws)
+        FixAll(self.ws)
+        self.mc = self.ws.genobj(mc)
+        self.data = self.ws.data(dataset)
+        if self.data == None:
+            raise RuntimeError('Dataset %s not found in %s' % (dataset, filename))
+        if pois is None:
+            pois = []
+            it = self.mc.GetParametersOfInterest().createIterator()
+            var = it.Next()
+            while var:
+                pois.append(var.GetName())
+                var = it.Next()
+        self.pois = pois
+        self.strategy = strategy
+        self.tolerance = tolerance
+        self.minimizer = minimizer
+
+        if mass is not None and self.ws.var('MH') != None:
+            self.ws.var('MH').setVal(float(mass))
+        all_params = self.ws.allVars()
+        all_params.add(self.ws.allCats())
+        if parRanges is not None:
+            for x in parRanges.split(':'):
+                par, vals = x.split('=')
+                lo, hi = vals.split(',')
+                self.ws.var(par).setRange(float(lo), float(hi))
+        if setPars is not None:
+            for par, val in [tuple(x.split('=')) for x in setPars.split(',')]:
+                tmp = all_params.find(par)
+                if tmp.IsA().InheritsFrom(ROOT.RooRealVar.Class()):
+                    tmp.setVal(float(val))
+                else:
+                    tmp.setIndex(int(val))
+        # Only the chosen POIs float, as with --redefineSignalPOIs
+        it = self.mc.GetParametersOfInterest().createIterator()
+        var = it.Next()
+        while var:
+            var.setConstant(var.GetName() not in pois)
+            var = it.Next()
+        for poi in pois:
+            self.ws.var(poi).setConstant(False)
+        if freezePars is not None:
+            for par in freezePars.split(','):
+                all_params.find(par).setConstant(True)
+
+        # For combine workspaces this gives combine's own cached NLL
+        constrain = ROOT.RooArgSet(self.mc.GetNuisanceParameters())
+        self.nll = self.mc.GetPdf().createNLL(
+            self.data, ROOT.RooFit.Constrain(constrain),
+            ROOT.RooFit.Extended(self.mc.GetPdf().canBeExtended()))
+        self.params = self.nll.getParameters(self.data.get())
+        self.snapshot = self.params.snapshot()
+        # The ranges and constant flags this engine needs, to be restored by
+        # activate()
+        self.state = workspace_state(self.ws)
+        self.nll_best = None
+
+    def minimize(self, minos=None):
+        """Minimize the NLL, then run Minos for the list of parameters minos if given"""
+        minim = ROOT.RooMinimizer(self.nll)
+        minim.setStrategy(self.strategy)
+        minim.setEps(self.tolerance)
+        minim.setPrintLevel(-1)
+        minim.setVerbose(False)
+        status = minim.minimize(self.minimizer, 'migrad')
+        if minos:
+            minos_vars = ROOT.RooArgSet()
+            for x in minos:
+                minos_vars.add(self.ws.var(x))
+            minim.minos(minos_vars)
+        return status
+
+    def restore(self):
+        self.params.assignValueOnly(self.snapshot)
+
+    def activate(self):
+        """Restore the parameter values, ranges and which parameters float"""
+        set_workspace_state(self.ws, self.state)
+        self.restore()
+
+    def initial_fit(self, minos=True):
+        """
+        The global fit, which is kept as the starting point of each impact.
+        Returns the crossings of each POI, found with Minos unless minos is
+        False, in the format of utils.get_singles_results.
+        """
+        status = self.minimize(self.pois if minos else None)
+        if status != 0:
+            print '>> Warning, the initial fit returned status %i' % status
+        self.nll_best = self.nll.getVal()
+        self.snapshot = self.params.snapshot()
+        res = {}
+        for poi in self.pois:
+            var = self.ws.var(poi)
+            res[poi] = {poi: [var.getVal() + var.getErrorLo(), var.getVal(), var.getVal() + var.getErrorHi()]}
+        return res
+
+    def impact(self, param):
+        """The crossings of param and the POI values at each one"""
+        self.restore()
+        var = self.ws.var(param)
+        self.minimize([param])
+        best = var.getVal()
+        crossings = [best + var.getErrorLo(), best + var.getErrorHi()]
+        res = {param: [crossings[0], best, crossings[1]]}
+        for poi in self.pois:
+            res[poi] = [None, self.snapshot.getRealValue(poi), None]
+        for i, x in zip([0, 2], crossings):
+            self.restore()
+            var.setVal(x)
+            var.setConstant(True)
+            self.minimize()
+            var.setConstant(False)
+            for poi in self.pois:
+                res[poi][i] = self.ws.var(poi).getVal()
+        self.restore()
+        return {param: res}
+
+    def scan(self, points):
+        """
+        Fix the scanned parameters at each of the points, given as dicts
+        {param: value}, and minimise the NLL with respect to the others, as
+        in MultiDimFit --algo grid. The parameters can be POIs or nuisance
+        parameters. Returns a dict of the value of every POI, of every scanned
+        parameter and of deltaNLL, relative to the initial fit, for each point.
+        """
+        res = []
+        for point in points:
+            self.restore()
+            constant = {}
+            for param, val in point.iteritems():
+                var = self.ws.var(param)
+                constant[param] = var.isConstant()
+                var.setVal(val)
+                var.setConstant(True)
+            self.minimize()
+            names = self.pois + [x for x in point if x not in self.pois]
+            row = dict([(x, self.ws.var(x).getVal()) for x in names])
+            row['deltaNLL'] = self.nll.getVal() - self.nll_best
+            res.append(row)
+            for param, const in constant.iteritems():
+                self.ws.var(param).setConstant(const)
+        self.restore()
+        return res
+
+
+def _impact(param):
+    try:
+        return _ENGINE.impact(param)
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+def run_impacts(engine, params, processes=1):
+    """
+    The impacts of a list of params, in a dict keyed by param. The fits are
+    run in processes forked workers when this is more than one. Parameters
+    whose fits failed are left out.
+    """
+    global _ENGINE
+    _ENGINE = engine
+    if processes > 1:
+        pool = Pool(processes=processes)
+        results = pool.map(_impact, params, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_impact, params)
+    res = {}
+    for param, result in zip(params, results):
+        if result is not None:
+            res.update(result)
+    return res
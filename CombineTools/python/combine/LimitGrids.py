@@ -14,12 +14,44 @@ import CombineHarvester.CombineTools.combine.utils as utils
 from CombineHarvester.CombineTools.combine.CombineToolBase import CombineToolBase
 import CombineHarvester.CombineTools.plotting as plot
 
+def grid_key(x):
+  """A grid coordinate as a float that is the same whichever way the value was formatted or computed"""
+  return float('%.10g' % float(x))
+
+def file_stamp(filename):
+  """The size and modification time of a file, used to tell if it has changed since it was last read"""
+  st = os.stat(filename)
+  return [st.st_size, st.st_mtime]
+
+def merged_stamp(filename):
+  """The file_stamp of a toy output, or of the zip file it is in"""
+  return file_stamp(filename.split('#')[0])
+
+def write_status(statfile, status):
+  """Write a status json file, via a temporary file so that an interrupted write leaves the old one intact"""
+  tmp_file = '%s.%i' % (statfile, os.getpid())
+  with open(tmp_file, 'w') as outfile:
+    json.dump(status, outfile)
+  os.rename(tmp_file, statfile)
+
+def bilinear(cell, values, contour, pt):
+  """Bilinear interpolation of the CLs of a contour at pt from the corners of a cell, or None if a corner has no value"""
+  x0, x1, y0, y1 = cell
+  if any([contour not in values[c] for c in [(x0, y0), (x1, y0), (x0, y1), (x1, y1)]]):
+    return None
+  tx = (pt[0] - x0) / (x1 - x0)
+  ty = (pt[1] - y0) / (y1 - y0)
+  return ((1. - tx) * (1. - ty) * values[(x0, y0)][contour] + tx * (1. - ty) * values[(x1, y0)][contour] +
+          (1. - tx) * ty * values[(x0, y1)][contour] + tx * ty * values[(x1, y1)][contour])
+
 class AsymptoticGrid(CombineToolBase):
   description = 'Calculate asymptotic limits on parameter grids'
   requires_root = True
 
   def __init__(self):
     CombineToolBase.__init__(self)
+    # The size, modification time and CLs values of each output file read so far
+    self.file_status = {}
 
   def attach_intercept_args(self, group):
     CombineToolBase.attach_intercept_args(self, group)
@@ -54,7 +86,11 @@ class AsymptoticGrid(CombineToolBase):
       else : blacklisted_points.extend(itertools.product(utils.split_vals(igrid[0]), utils.split_vals(igrid[1]), utils.split_vals(igrid[2])))
     POIs = cfg['POIs']
     opts = cfg['opts']
-    
+    statfile = cfg.get('statusfile', None)
+    if statfile and os.path.isfile(statfile):
+      with open(statfile) as stat_json:
+        self.file_status = json.load(stat_json)
+
     # remove problematic points (points with NaN values)
     points_to_remove = [];
     grids_to_remove = cfg.get('grids_to_remove', None)
@@ -77,65 +113,94 @@ class AsymptoticGrid(CombineToolBase):
     if hasattr(self.args, 'freezeParameters') and self.args.freezeParameters is not None:
         to_freeze.append(self.args.freezeParameters)
 
-    file_dict = { }
-    for p in points:
-      file_dict[p] = []
-
-    for f in glob.glob('higgsCombine.%s.*.%s.*.AsymptoticLimits.mH*.root' % (POIs[0], POIs[1])):
-      # print f
-      rgx = re.compile('higgsCombine\.%s\.(?P<p1>.*)\.%s\.(?P<p2>.*)\.AsymptoticLimits\.mH.*\.root' % (POIs[0], POIs[1]))
-      matches = rgx.search(f)
-      p = (matches.group('p1'), matches.group('p2'))
-      if p in file_dict:
-        file_dict[p].append(f)
-
-    for key,val in file_dict.iteritems():
-      name = '%s.%s.%s.%s' % (POIs[0], key[0], POIs[1], key[1])
-      print '>> Point %s' % name
-      if len(val) == 0:
-        print 'Going to run limit for point %s' % (key,)
-        set_arg = ','.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])] + to_set)
-        freeze_arg = ','.join(['%s,%s' % (POIs[0], POIs[1])] + to_freeze)
-        point_args = '-n .%s --setParameters %s --freezeParameters %s' % (name, set_arg, freeze_arg)
-        cmd = ' '.join(['combine -M AsymptoticLimits', opts, point_args] + self.passthru)
-        self.job_queue.append(cmd)
-
-    bail_out = len(self.job_queue) > 0
-    self.flush_queue()
-
-    if bail_out:
+    adaptive = cfg.get('adaptive', None)
+    if adaptive is not None:
+      cl = cfg.get('CL', 0.95)
+      contours = cfg.get('contours', ['obs', 'exp-2', 'exp-1', 'exp0', 'exp+1', 'exp+2'])
+      cells = []
+      for igrid in cfg['grids']:
+        if igrid[2] != '':
+          continue
+        xs = sorted(set([grid_key(x) for x in utils.split_vals(igrid[0])]))
+        ys = sorted(set([grid_key(y) for y in utils.split_vals(igrid[1])]))
+        cells.extend([(x0, x1, y0, y1) for x0, x1 in zip(xs[:-1], xs[1:]) for y0, y1 in zip(ys[:-1], ys[1:])])
+      excluded = set([(grid_key(x), grid_key(y)) for x, y in points_to_remove])
+      fixed = {}
+      for POI1, POI2, CLs in blacklisted_points:
+        fixed[(grid_key(POI1), grid_key(POI2))] = dict([(q, float(CLs)) for q in contours])
+
+    tried = set()
+    while True:
+      all_files = self.FindFiles(POIs)
+      if adaptive is not None:
+        # Key the results by value, as the coarse grid and the refined points
+        # may format the same number differently
+        names = {}
+        values = dict(fixed)
+        for key in points:
+          names[(grid_key(key[0]), grid_key(key[1]))] = key
+        for key, val in all_files.iteritems():
+          pt = (grid_key(key[0]), grid_key(key[1]))
+          names[pt] = key
+          if pt not in values:
+            values[pt] = self.ReadCLs(val)
+        reached, needed = self.RefineCells(
+            cells, values, excluded, contours, [1. - cl],
+            adaptive.get('max_depth', 3), adaptive.get('tolerance', 0.))
+        print '>> Adaptive grid: %i points in the refined grid, %i to run' % (len(reached), len(needed))
+        file_dict = {}
+        for pt in reached:
+          if pt in fixed:
+            continue
+          key = names.get(pt, ('%.10g' % pt[0], '%.10g' % pt[1]))
+          file_dict[key] = all_files.get(key, []) if pt not in needed else []
+      else:
+        file_dict = {}
+        for p in points:
+          file_dict[p] = all_files.get(p, [])
+
+      for key,val in file_dict.iteritems():
+        name = '%s.%s.%s.%s' % (POIs[0], key[0], POIs[1], key[1])
+        if adaptive is None:
+          print '>> Point %s' % name
+        if len(val) == 0:
+          print 'Going to run limit for point %s' % (key,)
+          set_arg = ','.join(['%s=%s,%s=%s' % (POIs[0], key[0], POIs[1], key[1])] + to_set)
+          freeze_arg = ','.join(['%s,%s' % (POIs[0], POIs[1])] + to_freeze)
+          point_args = '-n .%s --setParameters %s --freezeParameters %s' % (name, set_arg, freeze_arg)
+          cmd = ' '.join(['combine -M AsymptoticLimits', opts, point_args] + self.passthru)
+          self.job_queue.append(cmd)
+
+      if statfile:
+        write_status(statfile, self.file_status)
+      bail_out = len(self.job_queue) > 0
+      # Don't keep running jobs that fail to produce an output
+      repeated = any([cmd in tried for cmd in self.job_queue])
+      tried.update(self.job_queue)
+      self.flush_queue()
+
+      # Jobs run in this process can be collected straight away, so the
+      # adaptive refinement can go on to the next level
+      if (bail_out and adaptive is not None and not repeated and not self.dry_run
+          and self.job_mode in ['interactive', 'workers']):
+        continue
+      if bail_out:
         print '>> New jobs were created / run in this cycle, run the script again to collect the output'
         sys.exit(0)
+      break
 
     xvals = []
     yvals = []
     zvals_m2s = []; zvals_m1s = []; zvals_exp = []; zvals_p1s = []; zvals_p2s = []; zvals_obs = []
     for key,val in file_dict.iteritems():
-      for filename in val:
-        fin = ROOT.TFile(filename)
-        if fin.IsZombie(): continue
-        tree = fin.Get('limit')
-        for evt in tree:
-          if abs(evt.quantileExpected+1)<0.01:
-            xvals.append(float(key[0]))
-            yvals.append(float(key[1]))
-            #print 'At point %s have observed CLs = %f' % (key, evt.limit)
-            zvals_obs.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.025)<0.01:
-            #print 'At point %s have -2sigma CLs = %f' % (key, evt.limit)
-            zvals_m2s.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.16)<0.01:
-            #print 'At point %s have -1sigma CLs = %f' % (key, evt.limit)
-            zvals_m1s.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.5)<0.01:
-            #print 'At point %s have expected CLs = %f' % (key, evt.limit)
-            zvals_exp.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.84)<0.01:
-            #print 'At point %s have +1sigma CLs = %f' % (key, evt.limit)
-            zvals_p1s.append(float(evt.limit))
-          if abs(evt.quantileExpected-0.975)<0.01:
-            #print 'At point %s have +2sigma CLs = %f' % (key, evt.limit)
-            zvals_p2s.append(float(evt.limit))
+      cls = self.ReadCLs(val)
+      if 'obs' in cls:
+        xvals.append(float(key[0]))
+        yvals.append(float(key[1]))
+      for contour, zvals in [('obs', zvals_obs), ('exp-2', zvals_m2s), ('exp-1', zvals_m1s),
+                             ('exp0', zvals_exp), ('exp+1', zvals_p1s), ('exp+2', zvals_p2s)]:
+        if contour in cls:
+          zvals.append(cls[contour])
     for POI1, POI2, CLs in blacklisted_points:
       xvals.append(float(POI1))
       yvals.append(float(POI2))
@@ -163,11 +228,107 @@ class AsymptoticGrid(CombineToolBase):
     fout.WriteTObject(graph_p1s, 'exp+1')
     fout.WriteTObject(graph_p2s, 'exp+2')
     fout.WriteTObject(graph_obs, 'obs')
+    if statfile:
+      write_status(statfile, self.file_status)
     #fout.WriteTObject(hist)
     fout.Close()
     # Next step: open output files
     # Fill TGraph2D with CLs, CLs+b
 
+  def FindFiles(self, POIs):
+    """The output files of all the points that have been run, keyed by (POI1, POI2) string values"""
+    res = {}
+    rgx = re.compile('higgsCombine\.%s\.(?P<p1>.*)\.%s\.(?P<p2>.*)\.AsymptoticLimits\.mH.*\.root' % (POIs[0], POIs[1]))
+    for f in glob.glob('higgsCombine.%s.*.%s.*.AsymptoticLimits.mH*.root' % (POIs[0], POIs[1])):
+      matches = rgx.search(f)
+      p = (matches.group('p1'), matches.group('p2'))
+      res.setdefault(p, []).append(f)
+    return res
+
+  def ReadCLs(self, files):
+    """
+    The CLs of each quantile ('obs', 'exp0', 'exp-1' etc.) found in the files
+    of a point. Files that are in self.file_status with their current size
+    and modification time are not opened again.
+    """
+    quantiles = [('obs', -1.), ('exp-2', 0.025), ('exp-1', 0.16), ('exp0', 0.5), ('exp+1', 0.84), ('exp+2', 0.975)]
+    res = {}
+    for filename in files:
+      stamp = file_stamp(filename)
+      entry = self.file_status.get(filename)
+      if entry is not None and entry['stamp'] == stamp:
+        res.update(entry['cls'])
+        continue
+      cls = {}
+      fin = ROOT.TFile(filename)
+      if not fin.IsZombie():
+        tree = fin.Get('limit')
+        if tree != None:
+          # Read both branches in one pass rather than looping over the entries in python
+          tree.SetEstimate(tree.GetEntries() + 1)
+          n = tree.Draw('quantileExpected:limit', '', 'goff')
+          q_vals, limit_vals = tree.GetV1(), tree.GetV2()
+          for i in xrange(n):
+            for name, quantile in quantiles:
+              if abs(q_vals[i] - quantile) < 0.01:
+                cls[name] = limit_vals[i]
+      fin.Close()
+      self.file_status[filename] = {'stamp': stamp, 'cls': cls}
+      res.update(cls)
+    return res
+
+  def RefineCells(self, cells, values, excluded, contours, levels, max_depth, tolerance):
+    """
+    Find the points of an adaptive grid
+
+    Each cell (x0, x1, y0, y1) of the coarse grid is split into four, adding
+    the centre and the middle of each edge, if the CLs of one of the contours
+    at its corners lies on both sides of one of the levels. The new cells are
+    split in the same way, up to max_depth times. A cell is not split any
+    further once a bilinear interpolation of the cell it came from predicts
+    the CLs at its corners to within tolerance for each contour that
+    crosses, i.e. the contour in the cell has converged. Cells with a point
+    in excluded are not used.
+
+    values is a dict of the CLs of each contour, keyed by (x, y). Returns
+    the set of all the points of the grid and the set of those that are not
+    in values, which must be run before the cells they belong to can be
+    checked.
+    """
+    reached = set()
+    needed = set()
+    stack = [(cell, 0, None) for cell in cells]
+    while len(stack) > 0:
+      cell, depth, parent = stack.pop()
+      x0, x1, y0, y1 = cell
+      corners = [(x0, y0), (x1, y0), (x0, y1), (x1, y1)]
+      if any([c in excluded for c in corners]):
+        continue
+      reached.update(corners)
+      missing = [c for c in corners if c not in values]
+      if len(missing) > 0:
+        needed.update(missing)
+        continue
+      if depth >= max_depth:
+        continue
+      crossing = []
+      for c in contours:
+        vals = [values[pt].get(c) for pt in corners]
+        if None in vals: continue
+        if any([min(vals) < level <= max(vals) for level in levels]):
+          crossing.append(c)
+      if len(crossing) == 0:
+        continue
+      if parent is not None:
+        predicted = [(bilinear(parent, values, c, pt), values[pt][c]) for c in crossing for pt in corners]
+        if all([pred is not None and abs(pred - val) <= tolerance for pred, val in predicted]):
+          continue
+      xm = grid_key(0.5 * (x0 + x1))
+      ym = grid_key(0.5 * (y0 + y1))
+      for child in [(x0, xm, y0, ym), (xm, x1, y0, ym), (x0, xm, ym, y1), (xm, x1, ym, y1)]:
+        stack.append((child, depth + 1, cell))
+    return reached, needed
+
 class HybridNewGrid(CombineToolBase):
     description = 'Calculate toy-based limits on parameter grids'
     requires_root = True
@@ -187,9 +348,13 @@ class HybridNewGrid(CombineToolBase):
         group.add_argument('--output', action='store_true', help='Write CLs grids into an output file')
         group.add_argument('--from-asymptotic', default=None, help='JSON file which will be used to create a limit grid automatically')
 
-    def GetCombinedHypoTest(self, files):
-        if len(files) == 0: return None
-        results = []
+    def GetCombinedHypoTest(self, files, merged=None):
+        """
+        Merge the HypoTestResults in files into one, which is added to merged
+        instead if the result of an earlier call is given
+        """
+        if len(files) == 0: return merged
+        results = [] if merged is None else [merged]
         for file in files:
             found_res = False
             f = ROOT.TFile(file)
@@ -427,6 +592,9 @@ class HybridNewGrid(CombineToolBase):
         if statfile and os.path.isfile(statfile):
             with open(statfile) as stat_json:
                 stats = json.load(stat_json)
+        # The merged HypoTestResult of each point is kept next to the status
+        # file, so that only new output files have to be read and appended
+        cache = ROOT.TFile(statfile + '.root', 'UPDATE') if statfile else None
 
         # Can optionally copy output root files into a zip archive
         # If the user has specified a zipfile we will first
@@ -503,25 +671,54 @@ class HybridNewGrid(CombineToolBase):
             files =[]
 
 
+            # Files that have been checked before and haven't changed since
+            # don't have to be opened again
+            stamps = stats.get(status_key, {}).get('stamps', {})
+            def is_good(x):
+                if '#' in x:
+                    # Only good files are added to the zip file
+                    return True
+                return (x in stamps and stamps[x] == file_stamp(x)) or plot.TFileIsGood(x)
+
+            def is_unchanged(x):
+                return '#' in x or (x in stamps and stamps[x] == file_stamp(x))
+
             if status_key in stats:
                 status_files = stats[status_key]['files']
-                if set(all_files) == set(status_files):
+                if set(all_files) == set(status_files) and all([is_unchanged(x) for x in all_files]):
                     print 'For point %s, no files have been updated' % name
                     status_changed = False
                     files = all_files
                 else:
-                    files = [x for x in val.values() if plot.TFileIsGood(x)]
+                    files = [x for x in val.values() if is_good(x)]
                     if set(files) == set(status_files) and len(files) < len(all_files):
                         print 'For point %s, new files exist but they are not declared good' % name
                         status_changed = False
             else:
-                files = [x for x in val.values() if plot.TFileIsGood(x)]
+                files = [x for x in val.values() if is_good(x)]
 
             # Merge the HypoTestResult objects from each file into one
             res = None
             precomputed = None
             if status_key in stats and not status_changed and stats[status_key]["ntoys"] > 0 :
                 precomputed = stats[status_key]
+            elif cache is not None:
+                # Start from the merged result of the files already read, as
+                # long as none of them has been rewritten since
+                merged_stamps = stats.get(status_key, {}).get('merged', {})
+                if not isinstance(merged_stamps, dict):
+                    merged_stamps = {}
+                merged_files = merged_stamps.keys()
+                merged = cache.Get(name) if len(merged_files) > 0 else None
+                if (merged and set(merged_files).issubset(set(files)) and
+                        all([merged_stamps[x] == merged_stamp(x) for x in merged_files])):
+                    res = self.GetCombinedHypoTest([x for x in files if x not in merged_files], merged)
+                else:
+                    merged_files = []
+                    res = self.GetCombinedHypoTest(files)
+                if res is not None and set(files) != set(merged_files):
+                    cache.cd()
+                    cache.WriteTObject(res, name, 'Overwrite')
             else:
                 res = self.GetCombinedHypoTest(files)
 
@@ -542,8 +739,11 @@ class HybridNewGrid(CombineToolBase):
 
             stats[status_key] = {
                 'files': files,
-                'ntoys': point_res['ntoys']
+                'ntoys': point_res['ntoys'],
+                'stamps': dict([(x, file_stamp(x)) for x in files if '#' not in x])
             }
+            if cache is not None and (res is not None or precomputed is not None):
+                stats[status_key]['merged'] = dict([(x, merged_stamp(x)) for x in files])
             for cont in contours:
                 if cont in point_res:
                     stats[status_key][cont] = point_res[cont]
@@ -669,6 +869,9 @@ class HybridNewGrid(CombineToolBase):
                         ] + self.passthru))
                 self.flush_queue()
 
+        if cache is not None:
+            cache.Close()
+
         if statfile:
             with open(statfile, 'w') as stat_out:
                 stat_json = json.dumps(
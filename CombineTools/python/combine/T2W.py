@@ -4,7 +4,8 @@ import json
 import os
 from CombineHarvester.CombineTools.combine.opts import OPTS
 
-from CombineHarvester.CombineTools.combine.CombineToolBase import CombineToolBase
+from CombineHarvester.CombineTools.combine.CombineToolBase import CombineToolBase, JobEstimate
+from CombineHarvester.CombineTools.combine.WorkspaceCache import WorkspaceCache, t2w_output, card_inputs
 
 
 def isfloat(value):
@@ -15,6 +16,28 @@ def isfloat(value):
         return False
 
 
+def card_size(card):
+    """
+    Returns the number of (bin, process) columns and the number of lines
+    after the rate line, i.e. nuisance parameters and other directives, in
+    a datacard
+    """
+    n_columns = 0
+    n_lines = 0
+    after_rate = False
+    with open(card) as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 0 or words[0].startswith('#') or words[0].startswith('-'):
+                continue
+            if after_rate:
+                n_lines += 1
+            elif words[0] == 'rate':
+                n_columns = len(words) - 1
+                after_rate = True
+    return n_columns, n_lines
+
+
 class T2W(CombineToolBase):
     """
     combineTool.py -M T2W [-m MASS] [--cc [card.txt]] [card1.txt some/dir/125/card2.txt some/dir some/dir/125 ...]
@@ -35,13 +58,32 @@ class T2W(CombineToolBase):
            option is used then combine all of these cards first. As these
            cards could be in different directories the combined card and
            workspace will be created in the current directory.
+
+    With --ws-cache DIR each workspace is also stored in a cache directory,
+    keyed on a hash of the input cards, the files they refer to and the
+    arguments. A command whose key is already in the cache is not run, and
+    the stored workspace is copied (or with --ws-cache-link symlinked) to
+    where text2workspace.py would have written it.
+
+    In the interactive job mode the commands are run most costly first, with
+    the cost and memory of each estimated from the number of columns and
+    nuisance lines in the cards and the size of their shape files. The
+    --memory-budget option limits the estimated memory of the commands that
+    run at the same time.
     """
     description = 'Run text2workspace.py on multiple cards or directories'
     requires_root = False
     default_card = 'combined.txt'
+    # Rough model of the peak memory of text2workspace.py: a fixed overhead,
+    # a multiple of the size of the (compressed) shape files and an amount
+    # per datacard column and nuisance parameter
+    mem_base = 300.
+    mem_per_shape_mb = 5.
+    mem_per_entry = 0.0001
 
     def __init__(self):
         CombineToolBase.__init__(self)
+        self.cache = None
 
     def attach_intercept_args(self, group):
         CombineToolBase.attach_intercept_args(self, group)
@@ -64,13 +106,59 @@ class T2W(CombineToolBase):
             cards will be combined regardless of whether --cc is specified,
             but can still be used to set the name of the combined card that is
             created. """)
+        group.add_argument('--ws-cache', default=None, help=""" Directory
+            of a cache of workspaces, keyed on the input cards, the files
+            they refer to and the arguments. Workspaces found in the cache
+            are not rebuilt. """)
+        group.add_argument('--ws-cache-link', action='store_true', help="""
+            Symlink workspaces found in the cache instead of copying them """)
 
     def set_args(self, known, unknown):
         CombineToolBase.set_args(self, known, unknown)
+        if self.args.ws_cache is not None:
+            self.cache = WorkspaceCache(self.args.ws_cache, link=self.args.ws_cache_link)
+
+    def queue_t2w(self, dirname, card, passthru, cc_cmd, inputs):
+        """
+        Queue the text2workspace.py command for card in dirname, unless the
+        cache already contains the workspace built from the same inputs
+        """
+        proto = 'pushd %(DIR)s; %(CC)stext2workspace.py %(PASSTHRU)s %(CARD)s%(STORE)s; popd'
+        store = ''
+        if self.cache is not None:
+            mass = passthru[passthru.index('-m') + 1] if '-m' in passthru else None
+            output = t2w_output(card, passthru)
+            key = self.cache.key(inputs, [cc_cmd] + passthru, mass)
+            if self.cache.restore(key, os.path.join(dirname, output), self.dry_run):
+                print '>> Workspace cache hit for %s' % os.path.join(dirname, output)
+                return
+            print '>> Workspace cache miss for %s' % os.path.join(dirname, output)
+            store = ' && ' + self.cache.store_cmd(key, output)
+        cmd = proto % ({
+            'DIR': dirname,
+            'PASSTHRU': ' '.join(passthru),
+            'CARD': card,
+            'CC': cc_cmd + '; ' if cc_cmd else '',
+            'STORE': store
+            })
+        self.job_queue.append(cmd)
+        self.job_estimates[cmd] = self.estimate(os.path.join(dirname, card), inputs, passthru)
+
+    def estimate(self, label, inputs, passthru):
+        """Estimate the relative cost and peak memory of building a workspace from the input cards"""
+        mass = passthru[passthru.index('-m') + 1] if '-m' in passthru else None
+        entries = 0
+        shape_mb = 0.
+        for card in inputs:
+            n_columns, n_lines = card_size(card)
+            entries += n_columns * (1 + n_lines)
+            shape_mb += sum([os.path.getsize(x) for x in card_inputs(card, mass)]) / 1048576.
+        cost = entries + 1000. * shape_mb
+        memory = self.mem_base + self.mem_per_shape_mb * shape_mb + self.mem_per_entry * entries
+        return JobEstimate(cost, memory, label)
 
     def run_method(self):
         # The basic structure of each command - we'll fill in the blanks later
-        proto = 'pushd %(DIR)s; %(CC)stext2workspace.py %(PASSTHRU)s %(CARD)s; popd'
         proto_cc = 'combineCards.py %(CARDS)s &> %(COMBINED)s'
         cc_cards_post = []
         for arg in self.args.input:
@@ -99,13 +187,8 @@ class T2W(CombineToolBase):
                     passthru.extend(['-m', base])
                 elif self.args.mass is not None:
                     passthru.extend(['-m', self.args.mass])
-                cmd = proto % ({
-                    'DIR': arg,
-                    'PASSTHRU': ' '.join(passthru),
-                    'CARD': cardname,
-                    'CC': cc_cmd + '; '
-                    })
-                self.job_queue.append(cmd)
+                self.queue_t2w(arg, cardname, passthru, cc_cmd,
+                               [os.path.join(arg, file) for file in files])
             # Now do case (2) of a single datacard and --cc isn't specified
             elif self.args.cc is None:
                 dirname = os.path.dirname(arg)
@@ -117,13 +200,7 @@ class T2W(CombineToolBase):
                     passthru.extend(['-m', base])
                 elif self.args.mass is not None:
                     passthru.extend(['-m', self.args.mass])
-                cmd = proto % ({
-                    'DIR': dirname,
-                    'PASSTHRU': ' '.join(passthru),
-                    'CARD': os.path.basename(arg),
-                    'CC': ''
-                    })
-                self.job_queue.append(cmd)
+                self.queue_t2w(dirname, os.path.basename(arg), passthru, '', [arg])
             # Case (2) where --cc is specified
             else:
                 cc_cards_post.append(os.path.splitext(os.path.basename(arg))[0] + '=' + arg)
@@ -137,13 +214,12 @@ class T2W(CombineToolBase):
                 'CARDS': ' '.join(cc_cards_post),
                 'COMBINED': self.args.cc
                 })
-            cmd = proto % ({
-                'DIR': '.',
-                'PASSTHRU': ' '.join(passthru),
-                'CARD': self.args.cc,
-                'CC': cc_cmd + '; '
-                })
-            self.job_queue.append(cmd)
+            self.queue_t2w('.', self.args.cc, passthru, cc_cmd,
+                           [x.split('=', 1)[1] for x in cc_cards_post])
+        if self.cache is not None:
+            self.cache.report()
+            if not self.dry_run:
+                self.cache.save()
         self.flush_queue()
 
 
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    hash TEXT PRIMARY KEY,
+    task TEXT,
+    command TEXT,
+    output TEXT,
+    status TEXT,
+    exit_code INTEGER,
+    runtime REAL,
+    peak_memory REAL,
+    host TEXT,
+    attempts INTEGER DEFAULT 0,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def command_hash(command):
+    return hashlib.sha1(command).hexdigest()
+
+
+def combine_output(command):
+    """
+    Best guess of the higgsCombine*.root file a combine command writes,
+    following the combine naming scheme, or None for other commands
+    """
+    args = command.split()
+    if len(args) == 0 or args[0] != 'combine':
+        return None
+    def value(names, default):
+        for i, arg in enumerate(args[:-1]):
+            if arg in names:
+                return args[i + 1]
+        return default
+    name = value(['-n', '--name'], 'Test')
+    method = value(['-M', '--method'], 'AsymptoticLimits')
+    mass = value(['-m', '--mass'], '120')
+    try:
+        mass = '%g' % float(mass)
+    except ValueError:
+        pass
+    res = 'higgsCombine%s.%s.mH%s' % (name, method, mass)
+    if '-s' in args or '--seed' in args or '-t' in args or '--toys' in args:
+        res += '.%s' % value(['-s', '--seed'], '123456')
+    return res + '.root'
+
+
+class TaskDB:
+    """
+    A local SQLite record of the commands run by combineTool.py tasks
+
+    Every command is identified by the sha1 of its text, so running the same
+    task again finds the same entries. Each entry holds the task name, the
+    expected output file, the status ('submitted', 'done' or 'failed'), the
+    exit code, the runtime [s], the peak memory [MB] where it is known, the
+    host and the number of attempts.
+
+    Results of commands run inside batch job scripts are appended as json
+    lines to a journal file next to the database, as SQLite should not be
+    written from several hosts at once. The journal is read into the
+    database each time it is opened.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.journal = self.path + '.journal'
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.executescript(SCHEMA)
+        self.read_journal()
+
+    def read_journal(self):
+        if not os.path.isfile(self.journal):
+            return
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', ('journal_offset',)).fetchone()
+        offset = int(row[0]) if row else 0
+        if offset > os.path.getsize(self.journal):
+            offset = 0
+        with open(self.journal) as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                # Only take complete lines, a job may still be writing
+                if not line.endswith('\n'):
+                    break
+                offset += len(line)
+                try:
+                    res = json.loads(line)
+                except ValueError:
+                    continue
+                self.record_result(res['hash'], res['exit_code'], res.get('runtime'),
+                                   res.get('peak_memory'), res.get('host'), commit=False)
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('journal_offset', str(offset)))
+        self.conn.commit()
+
+    def record_submitted(self, task, commands):
+        now = time.time()
+        for command in commands:
+            h = command_hash(command)
+            self.conn.execute(
+                'INSERT OR IGNORE INTO jobs (hash, task, command, output) VALUES (?, ?, ?, ?)',
+                (h, task, command, combine_output(command)))
+            self.conn.execute(
+                """UPDATE jobs SET task = ?, status = 'submitted', exit_code = NULL,
+                   attempts = attempts + 1, updated = ? WHERE hash = ?""", (task, now, h))
+        self.conn.commit()
+
+    def record_result(self, h, exit_code, runtime=None, peak_memory=None, host=None, commit=True):
+        self.conn.execute(
+            """UPDATE jobs SET status = ?, exit_code = ?, runtime = ?, peak_memory = ?,
+               host = ?, updated = ? WHERE hash = ?""",
+            ('done' if exit_code == 0 else 'failed', exit_code, runtime, peak_memory,
+             host, time.time(), h))
+        if commit:
+            self.conn.commit()
+
+    def entry(self, command):
+        """The entry for command as a dict, or None if it isn't known"""
+        cur = self.conn.execute('SELECT * FROM jobs WHERE hash = ?', (command_hash(command),))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([x[0] for x in cur.description], row))
+
+    def needs_run(self, command):
+        """
+        True unless command is recorded as successful and its expected
+        output, if known, exists
+        """
+        entry = self.entry(command)
+        if entry is None or entry['status'] != 'done':
+            return True
+        return entry['output'] is not None and not os.path.isfile(entry['output'])
+
+    def journal_wrap(self, command, shell):
+        """
+        Shell code that runs shell, the script line for the queued command,
+        and appends its result to the journal, then exits the script with
+        the exit code of the command if it failed. pipefail is set where the
+        shell supports it so that the exit code isn't that of a tee to the log.
+        """
+        return ("CH_T0=$(date +%%s.%%N)\n"
+                "if (command set -o pipefail 2>/dev/null; %(CMD)s); then CH_CODE=0; else CH_CODE=$?; fi\n"
+                "echo \"{\\\"hash\\\": \\\"%(HASH)s\\\", \\\"exit_code\\\": $CH_CODE, "
+                "\\\"runtime\\\": $(awk \"BEGIN {print $(date +%%s.%%N) - $CH_T0}\"), "
+                "\\\"host\\\": \\\"$(hostname)\\\"}\" >> %(JOURNAL)s\n"
+                "[ $CH_CODE -eq 0 ] || exit $CH_CODE\n") % ({
+                    'CMD': shell.rstrip('\n'),
+                    'HASH': command_hash(command),
+                    'JOURNAL': self.journal
+                })
+
+    def summary(self, commands):
+        """Print the status of each of the commands and a total"""
+        counts = {}
+        total_runtime = 0.
+        peak = 0.
+        failed = []
+        for command in commands:
+            entry = self.entry(command)
+            status = 'unknown' if entry is None else entry['status']
+            if status == 'done' and self.needs_run(command):
+                status = 'output missing'
+            counts[status] = counts.get(status, 0) + 1
+            if entry is not None:
+                total_runtime += entry['runtime'] or 0.
+                peak = max(peak, entry['peak_memory'] or 0.)
+            if status in ['failed', 'output missing']:
+                failed.append((status, entry))
+        print '>> Task database %s: %i commands' % (self.path, len(commands))
+        for status in sorted(counts):
+            print '   %-16s %i' % (status, counts[status])
+        print '   Total runtime %.1fs, largest peak memory %.0f MB' % (total_runtime, peak)
+        for status, entry in failed:
+            print '   [%s, exit code %s, %i attempts] %s' % (
+                status, entry['exit_code'], entry['attempts'], entry['command'])
@@ -0,0 +1,229 @@
+"""
+MultiDimFit fits run inside the worker processes of --job-mode workers
+
+command_task converts a queued combine command line into a Task when it is
+a MultiDimFit impact or grid scan that can be run with an ImpactsEngine. In
+each worker the engines, and so the workspaces and NLLs, are created once
+and reused for every fit of the task. The output is written to the file
+combine itself would write, in the same format, so the results are read in
+the usual way. Other commands are left to run as before.
+"""
+
+import argparse
+import math
+import os
+import shlex
+from array import array
+
+from CombineHarvester.CombineTools.combine.TaskDB import combine_output
+from CombineHarvester.CombineTools.combine.Workers import Task
+
+# The engines created in this process, and the one that last set the state
+# of each workspace
+_ENGINES = {}
+_ACTIVE = {}
+
+
+def _parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-M', '--method')
+    parser.add_argument('--algo')
+    parser.add_argument('-d', '--datacard')
+    parser.add_argument('-m', '--mass', default='120')
+    parser.add_argument('-n', '--name', default='Test')
+    parser.add_argument('-P', '--parameters', action='append', default=[])
+    parser.add_argument('--redefineSignalPOIs')
+    parser.add_argument('--floatOtherPOIs', type=int, default=0)
+    parser.add_argument('--points', type=int, default=50)
+    parser.add_argument('--firstPoint', type=int, default=None)
+    parser.add_argument('--lastPoint', type=int, default=None)
+    parser.add_argument('--setParameters', '--setPhysicsModelParameters', dest='setParameters')
+    parser.add_argument('--setParameterRanges', '--setPhysicsModelParameterRanges', dest='setParameterRanges')
+    parser.add_argument('--freezeParameters')
+    parser.add_argument('-D', '--dataset', default='data_obs')
+    parser.add_argument('--cminDefaultMinimizerStrategy', type=int, default=1)
+    parser.add_argument('--cminDefaultMinimizerTolerance', type=float, default=0.1)
+    parser.add_argument('--cminDefaultMinimizerType', default='Minuit2')
+    return parser
+
+
+def _exact_options(parser, argv):
+    """
+    True if every option in argv is spelled exactly as one of the options of
+    parser. argparse would otherwise accept abbreviations, e.g. --P for
+    --parameters, which combine may interpret differently. The --opt=value
+    form is not accepted either, as combine_output would not see it.
+    """
+    options = parser._option_string_actions
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('-'):
+            if argv[i] not in options:
+                return False
+            if options[argv[i]].nargs is None:
+                i += 1
+        i += 1
+    return True
+
+
+def command_task(command):
+    """
+    A Task equivalent to the combine command line, or None if the command
+    uses anything the workers can't run themselves
+    """
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if len(argv) == 0 or argv[0] != 'combine' or any([x in argv for x in [';', '&&', '||', '|']]):
+        return None
+    parser = _parser()
+    if not _exact_options(parser, argv[1:]):
+        return None
+    try:
+        args, unknown = parser.parse_known_args(argv[1:])
+    except SystemExit:
+        return None
+    if len(unknown) > 0 or args.method != 'MultiDimFit' or args.datacard is None:
+        return None
+    if not args.datacard.endswith('.root'):
+        return None
+    pois = args.redefineSignalPOIs.split(',') if args.redefineSignalPOIs else None
+    opts = {
+        'mass': args.mass,
+        'setPars': args.setParameters,
+        'freezePars': args.freezeParameters,
+        'parRanges': args.setParameterRanges,
+        'dataset': args.dataset,
+        'strategy': args.cminDefaultMinimizerStrategy,
+        'tolerance': args.cminDefaultMinimizerTolerance,
+        'minimizer': args.cminDefaultMinimizerType
+    }
+    output = combine_output(command)
+    if args.algo == 'impact':
+        # The POIs must float for their impacts to be meaningful
+        if len(args.parameters) != 1 or args.floatOtherPOIs != 1 or pois is None:
+            return None
+        task = Task('CombineHarvester.CombineTools.combine.WorkerFits', 'impact_fit',
+                    args.datacard, pois, args.parameters[0], output, **opts)
+    elif args.algo == 'grid':
+        scanned = args.parameters if args.parameters else pois
+        if scanned is None or len(scanned) not in [1, 2] or args.points < 1:
+            return None
+        if pois is None or args.floatOtherPOIs != 1:
+            pois = scanned
+        first = args.firstPoint if args.firstPoint is not None else 0
+        last = args.lastPoint if args.lastPoint is not None else args.points - 1
+        task = Task('CombineHarvester.CombineTools.combine.WorkerFits', 'grid_fit',
+                    args.datacard, pois, scanned, args.points, first, last, output, **opts)
+    else:
+        return None
+    task.command = command
+    return task
+
+
+def get_engine(filename, pois, **opts):
+    """
+    The ImpactsEngine for the workspace in filename with these options,
+    after its initial fit. It is created the first time it is needed in this
+    process. The engines for the same file share its workspace, so the one
+    returned is activated if another engine used the workspace last.
+    """
+    from CombineHarvester.CombineTools.combine.ImpactsEngine import ImpactsEngine
+    key = (os.path.abspath(filename), tuple(pois) if pois else None, tuple(sorted(opts.items())))
+    ws_key = key[0]
+    if key not in _ENGINES:
+        engine = ImpactsEngine(filename, pois, **opts)
+        engine.initial_fit(minos=False)
+        _ENGINES[key] = engine
+        _ACTIVE[ws_key] = engine
+    engine = _ENGINES[key]
+    if _ACTIVE.get(ws_key) is not engine:
+        engine.activate()
+        _ACTIVE[ws_key] = engine
+    return engine
+
+
+def grid_points(ranges, points, first, last):
+    """
+    The points of a MultiDimFit --algo grid scan from first to last, given
+    the (min, max) range of each of the one or two scanned parameters,
+    following combine's numbering
+    """
+    res = []
+    if len(ranges) == 1:
+        (lo, hi), = ranges
+        for i in xrange(max(0, first), min(points, last + 1)):
+            res.append([lo + (i + 0.5) * (hi - lo) / points])
+    else:
+        (xlo, xhi), (ylo, yhi) = ranges
+        n = int(math.ceil(math.sqrt(points)))
+        for i in xrange(n):
+            for j in xrange(n):
+                ipoint = i * n + j
+                if ipoint < first or ipoint > last:
+                    continue
+                res.append([xlo + (i + 0.5) * (xhi - xlo) / n, ylo + (j + 0.5) * (yhi - ylo) / n])
+    return res
+
+
+def write_limit_tree(output, mass, columns, rows):
+    """
+    Write rows, each a dict of the values of columns plus quantileExpected,
+    to the limit tree of output in the combine format. The file is written
+    under a temporary name first, so that it only appears once complete.
+    """
+    import ROOT
+    tmp = output + '.tmp'
+    fout = ROOT.TFile(tmp, 'RECREATE')
+    tree = ROOT.TTree('limit', 'limit')
+    buffers = {}
+    for name, kind in [('limit', 'd'), ('limitErr', 'd'), ('mh', 'd'), ('syst', 'i'), ('iToy', 'i'),
+                       ('iSeed', 'i'), ('iChannel', 'i'), ('t_cpu', 'f'), ('t_real', 'f'),
+                       ('quantileExpected', 'f')] + [(col, 'f') for col in columns]:
+        buffers[name] = array(kind, [0])
+        tree.Branch(name, buffers[name], '%s/%s' % (name, {'d': 'D', 'i': 'I', 'f': 'F'}[kind]))
+    buffers['mh'][0] = float(mass)
+    buffers['iSeed'][0] = 123456
+    for row in rows:
+        for key, val in row.iteritems():
+            buffers[key][0] = val
+        tree.Fill()
+    fout.Write()
+    fout.Close()
+    os.rename(tmp, output)
+
+
+def impact_fit(filename, pois, param, output, **opts):
+    """The equivalent of MultiDimFit --algo impact -P param"""
+    engine = get_engine(filename, pois, **opts)
+    res = engine.impact(param)[param]
+    columns = engine.pois + [param] if param not in engine.pois else list(engine.pois)
+    rows = []
+    for i, quantile in zip([1, 0, 2], [-1., -0.32, 0.32]):
+        row = dict([(col, res[col][i]) for col in columns])
+        row['quantileExpected'] = quantile
+        row['deltaNLL'] = 0.
+        rows.append(row)
+    write_limit_tree(output, opts['mass'], columns + ['deltaNLL'], rows)
+    return len(rows)
+
+
+def grid_fit(filename, pois, scanned, points, first, last, output, **opts):
+    """
+    The equivalent of MultiDimFit --algo grid -P scanned --points points
+    --firstPoint first --lastPoint last. As in combine the initial fit is
+    the first entry.
+    """
+    import ROOT
+    engine = get_engine(filename, pois, **opts)
+    ranges = [(engine.ws.var(poi).getMin(), engine.ws.var(poi).getMax()) for poi in scanned]
+    scan = engine.scan([dict(zip(scanned, vals)) for vals in grid_points(ranges, points, first, last)])
+    columns = engine.pois + [x for x in scanned if x not in engine.pois]
+    best = dict([(col, engine.snapshot.getRealValue(col)) for col in columns])
+    best['deltaNLL'] = 0.
+    best['quantileExpected'] = 1.
+    for row in scan:
+        row['quantileExpected'] = ROOT.Math.chisquared_cdf_c(max(0., 2. * row['deltaNLL']), len(scanned))
+    write_limit_tree(output, opts['mass'], columns + ['deltaNLL'], [best] + scan)
+    return len(scan)
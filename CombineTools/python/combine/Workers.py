@@ -0,0 +1,176 @@
+import atexit
+import importlib
+import os
+import resource
+import select
+import subprocess
+import sys
+import time
+import traceback
+from multiprocessing import Process, Pipe
+
+# Workspaces loaded by get_workspace in this process
+_WORKSPACES = {}
+
+
+class Task:
+    """
+    A call of a module-level function to be made inside a worker process,
+    e.g. Task('CombineHarvester.CombineTools.combine.utils',
+    'prefit_from_workspace', 'ws.root', 'w', ['r']). Only the names are sent
+    to the worker, which imports the module the first time it is needed.
+    The return value of the function is passed back to the caller. command
+    can be set to the command line the Task replaces, which is then used to
+    label it and to look up its JobEstimate.
+    """
+    def __init__(self, module, function, *args, **kwargs):
+        self.module = module
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.command = None
+
+    def __str__(self):
+        if self.command is not None:
+            return '[task] ' + self.command
+        return '%s.%s%s' % (self.module, self.function, str(self.args))
+
+    def run(self):
+        func = getattr(importlib.import_module(self.module), self.function)
+        return func(*self.args, **self.kwargs)
+
+
+def get_workspace(filename, wsname='w'):
+    """
+    The RooWorkspace wsname from filename, which is only read the first time
+    it is requested in each process. Tasks that change the state of the
+    workspace, e.g. parameter values, must restore it before returning.
+    """
+    key = (os.path.abspath(filename), wsname)
+    if key not in _WORKSPACES:
+        import ROOT
+        wsfile = ROOT.TFile.Open(filename)
+        if not wsfile or wsfile.IsZombie():
+            raise RuntimeError('Unable to open %s' % filename)
+        ws = wsfile.Get(wsname)
+        if not ws:
+            raise RuntimeError('Workspace %s not found in %s' % (wsname, filename))
+        _WORKSPACES[key] = (wsfile, ws)
+    return _WORKSPACES[key][1]
+
+
+def _worker_main(conn, load_combine):
+    import ROOT
+    if load_combine:
+        ROOT.gSystem.Load('libHiggsAnalysisCombinedLimit')
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        index, job = msg
+        start = time.time()
+        result = None
+        # Peak memory [MB]: of the command itself, or of the worker for a Task
+        peak_memory = None
+        try:
+            if isinstance(job, Task):
+                result = job.run()
+                code = 0
+                peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+            else:
+                proc = subprocess.Popen(job, shell=True)
+                pid, status, usage = os.wait4(proc.pid, 0)
+                code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+                proc.returncode = code
+                peak_memory = usage.ru_maxrss / 1024.
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.send((index, code, result, time.time() - start, peak_memory))
+    conn.close()
+
+
+class WorkerPool:
+    """
+    A set of long-lived worker processes that run jobs sent over a pipe
+
+    ROOT, and optionally libHiggsAnalysisCombinedLimit, are loaded once when
+    each worker starts, and the workers stay alive between calls to run().
+    A job is either a shell command, which the worker runs with the shell,
+    or a Task, which is run inside the worker itself. Tasks can keep state
+    between jobs, such as the workspaces cached by get_workspace, so many
+    short fits avoid the start-up cost of a new process each time. See
+    WorkerFits for the Tasks that replace combine commands.
+    """
+    def __init__(self, n_workers, load_combine=True):
+        self.workers = []
+        for i in xrange(max(1, n_workers)):
+            parent_conn, child_conn = Pipe()
+            proc = Process(target=_worker_main, args=(child_conn, load_combine))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self.workers.append((proc, parent_conn))
+        atexit.register(self.close)
+
+    def run(self, jobs, dry_run=False, pre_cmd='', estimates=None, stats=None):
+        """
+        Run the list of jobs, most costly first if a dict of JobEstimate is
+        given, and return a list of (exit code, result) in the order of jobs.
+        If a stats dict is given, it is filled with the runtime [s] and peak
+        memory [MB] of each job, keyed by position.
+        """
+        def cost(i):
+            key = jobs[i].command if isinstance(jobs[i], Task) else jobs[i]
+            est = estimates.get(key) if estimates and key is not None else None
+            return est.cost if est is not None else 0.
+        pending = sorted(range(len(jobs)), key=lambda i: -cost(i))
+        res = [None] * len(jobs)
+        if dry_run:
+            for i in pending:
+                print '[DRY-RUN]: ' + str(jobs[i])
+            return res
+        idle = [conn for proc, conn in self.workers]
+        busy = {}
+        t_begin = time.time()
+        n_done = 0
+        while pending or busy:
+            while pending and idle:
+                i = pending.pop(0)
+                job = jobs[i]
+                if not isinstance(job, Task) and job.startswith('combine'):
+                    job = pre_cmd + job
+                print '>> [worker] ' + str(job)
+                sys.stdout.flush()
+                conn = idle.pop()
+                conn.send((i, job))
+                busy[conn.fileno()] = conn
+            ready, _, _ = select.select(busy.keys(), [], [])
+            for fd in ready:
+                conn = busy.pop(fd)
+                try:
+                    i, code, result, elapsed, peak_memory = conn.recv()
+                except EOFError:
+                    raise RuntimeError('A worker process exited unexpectedly')
+                idle.append(conn)
+                res[i] = (code, result)
+                if stats is not None:
+                    stats[i] = (elapsed, peak_memory)
+                n_done += 1
+                print '>> [%i/%i] %s in %.1fs (exit code %i): %s' % (
+                    n_done, len(jobs), 'finished' if code == 0 else 'FAILED',
+                    elapsed, code, str(jobs[i]))
+        print '>> Ran %i jobs in %.1fs with %i workers' % (len(jobs), time.time() - t_begin, len(self.workers))
+        return res
+
+    def close(self):
+        for proc, conn in self.workers:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for proc, conn in self.workers:
+            proc.join()
+        self.workers = []
@@ -0,0 +1,153 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+
+# Bump this to invalidate all existing cache entries if the way the keys are
+# built changes
+CACHE_VERSION = 1
+
+
+def t2w_output(card, args):
+    """The workspace file text2workspace.py will create for a card and list of arguments"""
+    for i, arg in enumerate(args):
+        if arg in ['-o', '--out'] and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith('--out='):
+            return arg[len('--out='):]
+    return re.sub('.txt$', '', card) + '.root'
+
+
+def card_inputs(card, mass=None):
+    """
+    The files a datacard refers to: the shape files in the shapes lines
+    and the workspace files of any rateParam or extArg lines. Any
+    placeholders in the file names other than $MASS are matched as
+    wildcards, so every file that could be used is included.
+    """
+    carddir = os.path.dirname(card)
+    files = set()
+    with open(card) as f:
+        for line in f:
+            words = line.split()
+            if len(words) < 3:
+                continue
+            names = []
+            if words[0] == 'shapes' and len(words) >= 4 and words[3] != 'FAKE':
+                names.append(words[3])
+            elif words[1] in ['rateParam', 'extArg']:
+                names.extend([x.split(':')[0] for x in words[2:] if '.root:' in x])
+            for name in names:
+                if mass is not None:
+                    name = name.replace('$MASS', mass)
+                name = os.path.join(carddir, name)
+                if '$' in name:
+                    files.update(glob.glob(re.sub(r'\$\w+', '*', name)))
+                elif os.path.isfile(name):
+                    files.add(name)
+    return sorted(files)
+
+
+class WorkspaceCache:
+    """
+    A content-addressed store of the workspaces made by text2workspace.py
+
+    Each workspace is stored in the cache directory as KEY.root, where KEY is
+    a hash of everything the workspace is built from: the text of each input
+    datacard, the contents of the shape and workspace files the cards refer
+    to, and the arguments for combineCards.py and text2workspace.py. The
+    hashes of the input files are remembered in an index in the cache
+    directory, together with their size and modification time, so that
+    unchanged files are only read once.
+
+    Changes that are not visible in these inputs, e.g. to the code of a
+    physics model, are not detected. Use a new cache directory in that case.
+    """
+    def __init__(self, path, link=False):
+        self.path = os.path.abspath(path)
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self.index_file = os.path.join(self.path, 'files.json')
+        self.index = {}
+        if os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file) as jsonfile:
+                    self.index = json.load(jsonfile)
+            except ValueError:
+                self.index = {}
+
+    def file_hash(self, filename):
+        """sha1 of the contents of a file, reusing the index when the file is unchanged"""
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        entry = self.index.get(filename)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        self.index[filename] = [st.st_size, st.st_mtime, h.hexdigest()]
+        return h.hexdigest()
+
+    def key(self, cards, args, mass=None):
+        """Hash of a list of input datacards and the list of command line arguments"""
+        h = hashlib.sha1()
+        h.update('version %i\n' % CACHE_VERSION)
+        h.update('args %s\n' % json.dumps(args))
+        for card in cards:
+            h.update('card %s\n' % self.file_hash(card))
+            for filename in card_inputs(card, mass):
+                h.update('input %s %s\n' % (os.path.basename(filename), self.file_hash(filename)))
+        return h.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, key + '.root')
+
+    def restore(self, key, output, dry_run=False):
+        """
+        Put the workspace stored for key at output if there is one, returning
+        False otherwise. The workspace is copied, or symlinked if this cache
+        was created with link=True.
+        """
+        entry = self.entry(key)
+        if not os.path.isfile(entry):
+            self.misses += 1
+            return False
+        self.hits += 1
+        if os.path.islink(output) and os.path.realpath(output) == entry:
+            return True
+        if dry_run:
+            print '[DRY-RUN]: reuse %s as %s' % (entry, output)
+            return True
+        if os.path.lexists(output):
+            os.remove(output)
+        if self.link:
+            os.symlink(entry, output)
+        else:
+            shutil.copy2(entry, output)
+        return True
+
+    def store_cmd(self, key, output):
+        """A shell command that copies output into the cache as the entry for key"""
+        entry = self.entry(key)
+        return 'mkdir -p %(DIR)s && cp -p %(OUT)s %(ENTRY)s.$$ && mv -f %(ENTRY)s.$$ %(ENTRY)s' % ({
+            'DIR': self.path,
+            'OUT': output,
+            'ENTRY': entry
+            })
+
+    def save(self):
+        """Write the index of input file hashes"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp_file = '%s.%i' % (self.index_file, os.getpid())
+        with open(tmp_file, 'w') as outfile:
+            json.dump(self.index, outfile)
+        os.rename(tmp_file, self.index_file)
+
+    def report(self):
+        print '>> Workspace cache %s: %i hit(s), %i miss(es)' % (self.path, self.hits, self.misses)
@@ -1,5 +1,8 @@
 import ROOT
+import math
+import os
 import re
+from multiprocessing import Pool
 
 try:
     from HiggsAnalysis.CombinedLimit.RooAddPdfFixer import FixAll
@@ -50,8 +53,110 @@ def list_from_workspace(file, workspace, set):
     return res
 
 
-def prefit_from_workspace(file, workspace, params, setPars=None):
-    """Given a list of params, return a dictionary of [-1sig, nominal, +1sig]"""
+def servers_of(arg):
+    """The servers of a RooAbsArg, in the order they were added"""
+    res = []
+    it = arg.serverIterator()
+    server = it.Next()
+    while server:
+        res.append(server)
+        server = it.Next()
+    return res
+
+
+def poisson_crossings(n):
+    """The means either side of n where -ln Poisson(n|mean) is 0.5 above its minimum"""
+    def dnll(m):
+        if n <= 0.:
+            return m - 0.5
+        return m - n * math.log(m) - (n - n * math.log(n)) - 0.5
+    def bisect(lo, hi):
+        for i in xrange(200):
+            mid = 0.5 * (lo + hi)
+            if (dnll(mid) > 0.) == (dnll(lo) > 0.):
+                lo = mid
+            else:
+                hi = mid
+        return 0.5 * (lo + hi)
+    if n <= 0.:
+        return [0., 0.5]
+    return [bisect(n * 1E-12, n), bisect(n, n + 10. * math.sqrt(n) + 10.)]
+
+
+def analytic_prefit(pdf, var, gobs):
+    """
+    The [-1sig, nominal, +1sig] of var from a RooGaussian, RooBifurGauss or
+    RooPoisson constraint pdf, computed directly from the pdf parameters. This
+    is the same interval Minos gives for the constraint on its own. Returns
+    None if the pdf isn't one of these or not a direct function of var and
+    gobs.
+    """
+    servers = servers_of(pdf)
+    names = [x.GetName() for x in servers]
+    pair = set(names[:2]) == set([var.GetName(), gobs.GetName()])
+    c = gobs.getVal()
+    res = None
+    if pdf.IsA().InheritsFrom(ROOT.RooGaussian.Class()) and len(servers) == 3 and pair:
+        sigma = servers[2].getVal()
+        res = [c - sigma, c, c + sigma]
+    elif pdf.IsA().InheritsFrom(ROOT.RooBifurGauss.Class()) and len(servers) == 4 and pair:
+        sigma_l, sigma_r = servers[2].getVal(), servers[3].getVal()
+        if names[0] == var.GetName():
+            res = [c - sigma_l, c, c + sigma_r]
+        else:
+            # As a function of the mean the two widths swap sides
+            res = [c - sigma_r, c, c + sigma_l]
+    elif (pdf.IsA().InheritsFrom(ROOT.RooPoisson.Class()) and len(servers) == 2 and
+          names == [gobs.GetName(), var.GetName()]):
+        lo, hi = poisson_crossings(c)
+        res = [lo, c, hi]
+    if res is not None:
+        # Minos doesn't go outside the parameter range either
+        res = [min(max(x, var.getMin()), var.getMax()) for x in res]
+    return res
+
+
+# The workspace used by the forked prefit processes
+_PREFIT_WS = None
+
+
+def numerical_prefit(p, ws=None):
+    """The [-1sig, nominal, +1sig] of a parameter from a fit of its constraint pdf"""
+    if ws is None:
+        ws = _PREFIT_WS
+    var = ws.var(p)
+    pdf = ws.pdf(p+'_Pdf')
+    # To get the errors we can just fit the pdf
+    # But don't do pdf.fitTo(globalObs), it forces integration of the
+    # range of the global observable. Instead we make a RooConstraintSum
+    # which is what RooFit creates by default when we have external constraints
+    nll = ROOT.RooConstraintSum('NLL', '', ROOT.RooArgSet(pdf), ROOT.RooArgSet(var))
+    minim = ROOT.RooMinimizer(nll)
+    minim.setEps(0.001)  # Might as well get some better precision...
+    minim.setErrorLevel(0.5) # Unlike for a RooNLLVar we must set this explicitly
+    minim.setPrintLevel(-1)
+    minim.setVerbose(False)
+    # Run the fit then run minos for the error
+    minim.minimize('Minuit2', 'migrad')
+    minim.minos(ROOT.RooArgSet(var))
+    # Should really have checked that these converged ok...
+    # var.Print()
+    # pdf.Print()
+    val = var.getVal()
+    errlo = -1 * var.getErrorLo()
+    errhi = +1 * var.getErrorHi()
+    return [val-errlo, val, val+errhi]
+
+
+def prefit_from_workspace(file, workspace, params, setPars=None, processes=1):
+    """
+    Given a list of params, return a dictionary of [-1sig, nominal, +1sig]
+
+    The intervals of parameters with a Gaussian, bifurcated Gaussian or
+    Poisson constraint are computed directly. Only other constraint pdfs are
+    fitted, in processes forked processes if this is more than one.
+    """
+    global _PREFIT_WS
     res = {}
     wsFile = ROOT.TFile(file)
     ws = wsFile.Get(workspace)
@@ -71,6 +176,7 @@ def prefit_from_workspace(file, workspace, params, setPars=None):
           print 'Setting index %s to %g' % (par, float(val))
           tmp.setIndex(int(val))
 
+    numerical = []
     for p in params:
         res[p] = {}
 
@@ -80,26 +186,11 @@ def prefit_from_workspace(file, workspace, params, setPars=None):
 
         # For pyROOT NULL test: "pdf != None" != "pdf is not None"
         if pdf != None and gobs != None:
-            # To get the errors we can just fit the pdf
-            # But don't do pdf.fitTo(globalObs), it forces integration of the
-            # range of the global observable. Instead we make a RooConstraintSum
-            # which is what RooFit creates by default when we have external constraints
-            nll = ROOT.RooConstraintSum('NLL', '', ROOT.RooArgSet(pdf), ROOT.RooArgSet(var))
-            minim = ROOT.RooMinimizer(nll)
-            minim.setEps(0.001)  # Might as well get some better precision...
-            minim.setErrorLevel(0.5) # Unlike for a RooNLLVar we must set this explicitly
-            minim.setPrintLevel(-1)
-            minim.setVerbose(False)
-            # Run the fit then run minos for the error
-            minim.minimize('Minuit2', 'migrad')
-            minim.minos(ROOT.RooArgSet(var))
-            # Should really have checked that these converged ok...
-            # var.Print()
-            # pdf.Print()
-            val = var.getVal()
-            errlo = -1 * var.getErrorLo()
-            errhi = +1 * var.getErrorHi()
-            res[p]['prefit'] = [val-errlo, val, val+errhi]
+            prefit = analytic_prefit(pdf, var, gobs)
+            if prefit is not None:
+                res[p]['prefit'] = prefit
+            else:
+                numerical.append(p)
             if pdf.IsA().InheritsFrom(ROOT.RooGaussian.Class()):
                 res[p]['type'] = 'Gaussian'
             elif pdf.IsA().InheritsFrom(ROOT.RooPoisson.Class()):
@@ -112,6 +203,20 @@ def prefit_from_workspace(file, workspace, params, setPars=None):
             res[p]['type'] = 'Unconstrained'
             res[p]['prefit'] = [var.getVal(), var.getVal(), var.getVal()]
         res[p]['groups'] = [x.replace('group_', '') for x in var.attributes() if x.startswith('group_')]
+
+    if len(numerical) > 0:
+        print 'Fitting the constraints of %i parameter(s)' % len(numerical)
+        if processes > 1 and len(numerical) > 1:
+            _PREFIT_WS = ws
+            pool = Pool(processes=processes)
+            prefits = pool.map(numerical_prefit, numerical, chunksize=1)
+            pool.close()
+            pool.join()
+            _PREFIT_WS = None
+        else:
+            prefits = [numerical_prefit(p, ws) for p in numerical]
+        for p, prefit in zip(numerical, prefits):
+            res[p]['prefit'] = prefit
     return res
 
 
@@ -135,6 +240,65 @@ def get_singles_results(file, scanned, columns):
     return res
 
 
+def tree_columns(tree, columns):
+    """Read columns from every entry of a TTree in one pass, returning a dict of numpy arrays"""
+    import numpy as np
+    res = {}
+    n = tree.GetEntries()
+    tree.SetEstimate(n + 1)
+    # TTree::Draw can't parse every branch name, e.g. ones containing '-'
+    if all([re.match(r'^\w+$', col) for col in columns]):
+        n = tree.Draw(':'.join(columns), '', 'goff')
+    else:
+        n = -1
+    if n >= 0:
+        for i, col in enumerate(columns):
+            buf = tree.GetVal(i)
+            if n == 0:
+                res[col] = np.zeros(0)
+                continue
+            if hasattr(buf, 'reshape'):
+                buf.reshape((n,))
+            else:
+                buf.SetSize(n)
+            res[col] = np.array(np.frombuffer(buf, dtype=np.float64, count=n))
+    else:
+        vals = [[] for col in columns]
+        for evt in tree:
+            for i, col in enumerate(columns):
+                vals[i].append(getattr(evt, col))
+        for i, col in enumerate(columns):
+            res[col] = np.array(vals[i], dtype=np.float64)
+    return res
+
+
+def get_impact_results(files, columns):
+    """
+    The results of a set of MultiDimFit --algo impact fits, one parameter per
+    file, given as a dict {param: file}. Equivalent to calling
+    get_singles_results(file, [param], columns + [param]) for each one, but
+    each tree is read only once, for all of its columns together. Parameters
+    whose file is missing or incomplete are left out.
+    """
+    res = {}
+    for param, filename in files.iteritems():
+        f = ROOT.TFile.Open(filename) if os.path.isfile(filename) else None
+        if f is None or f.IsZombie():
+            continue
+        t = f.Get("limit")
+        if t == None or t.GetEntries() < 3:
+            print 'File %s did not contain a sufficient number of entries, skipping' % filename
+            f.Close()
+            continue
+        cols = columns + [param] if param not in columns else list(columns)
+        vals = tree_columns(t, cols)
+        f.Close()
+        res[param] = {}
+        for col in cols:
+            res[param][col] = [float(vals[col][1]), float(vals[col][0]), float(vals[col][2])]
+    return res
+
+
 def get_roofitresult(rfr, params, others):
     res = {}
     if rfr.covQual() != 3:
@@ -154,6 +154,9 @@ for page in xrange(n):
     g_pulls = ROOT.TGraphAsymmErrors(n_params)
     g_impacts_hi = ROOT.TGraphAsymmErrors(n_params)
     g_impacts_lo = ROOT.TGraphAsymmErrors(n_params)
+    # In the hybrid method, the impacts that were only approximated
+    g_approx_hi = ROOT.TGraphAsymmErrors(n_params)
+    g_approx_lo = ROOT.TGraphAsymmErrors(n_params)
     g_check = ROOT.TGraphAsymmErrors()
     g_check_i = 0
 
@@ -211,6 +214,14 @@ for page in xrange(n):
         imp = pdata[p][POI]
         g_impacts_hi.SetPointError(i, 0, imp[2] - imp[1], 0.5, 0.5)
         g_impacts_lo.SetPointError(i, imp[1] - imp[0], 0, 0.5, 0.5)
+        g_approx_hi.SetPoint(i, 0, 9999.)
+        g_approx_lo.SetPoint(i, 0, 9999.)
+        if pdata[p].get('method') == 'hesse':
+            # Move this point to the approximate graphs
+            for g_from, g_to in [(g_impacts_hi, g_approx_hi), (g_impacts_lo, g_approx_lo)]:
+                g_to.SetPoint(i, 0, float(i) + 0.5)
+                g_to.SetPointError(i, g_from.GetErrorXlow(i), g_from.GetErrorXhigh(i), 0.5, 0.5)
+                g_from.SetPoint(i, 0, 9999.)
         max_impact = max(
             max_impact, abs(imp[1] - imp[0]), abs(imp[2] - imp[1]))
         col = colors.get(tp, 2)
@@ -298,13 +309,22 @@ for page in xrange(n):
     g_impacts_hi.Draw('2SAME')
     g_impacts_lo.SetFillColor(plot.CreateTransparentColor(lo_color[method], alpha))
     g_impacts_lo.Draw('2SAME')
+    hybrid = data.get('method') == 'hybrid'
+    if hybrid:
+        g_approx_hi.SetFillColor(plot.CreateTransparentColor(hi_color['hesse'], alpha))
+        g_approx_hi.Draw('2SAME')
+        g_approx_lo.SetFillColor(plot.CreateTransparentColor(lo_color['hesse'], alpha))
+        g_approx_lo.Draw('2SAME')
     pads[1].RedrawAxis()
 
-    legend = ROOT.TLegend(0.02, 0.02, 0.40, 0.06, '', 'NBNDC')
-    legend.SetNColumns(3)
+    legend = ROOT.TLegend(0.02, 0.02, 0.62 if hybrid else 0.40, 0.06, '', 'NBNDC')
+    legend.SetNColumns(5 if hybrid else 3)
     legend.AddEntry(g_pulls, 'Pull', 'LP')
     legend.AddEntry(g_impacts_hi, '+1#sigma Impact', 'F')
     legend.AddEntry(g_impacts_lo, '-1#sigma Impact', 'F')
+    if hybrid:
+        legend.AddEntry(g_approx_hi, '+1#sigma (approx.)', 'F')
+        legend.AddEntry(g_approx_lo, '-1#sigma (approx.)', 'F')
     legend.Draw()
 
     leg_width = pads[0].GetLeftMargin() - 0.01
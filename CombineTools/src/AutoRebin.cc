@@ -4,6 +4,7 @@
 #include <vector> 
 #include "boost/format.hpp"
 #include "boost/lexical_cast.hpp"
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
 
 namespace ch {
 
@@ -23,7 +24,7 @@ void AutoRebin::Rebin(CombineHarvester &src, CombineHarvester &dest) {
   for (auto bin : bins) {
     //Build histogram containing total of all backgrounds, avoid using
     //GetShapeWithUncertainty so that possible negative bins are retained
-    TH1F data_obs = src.cp().bin({bin}).GetObservedShape();
+    TH1F data_obs = src.partition(bin).GetObservedShape();
     TH1F total_bkg;
     if (data_obs.GetXaxis()->GetXbins()->GetArray()){
       total_bkg = TH1F("","",data_obs.GetNbinsX(), 
@@ -32,7 +33,7 @@ void AutoRebin::Rebin(CombineHarvester &src, CombineHarvester &dest) {
       total_bkg = TH1F("","",data_obs.GetNbinsX(),
                   data_obs.GetXaxis()->GetBinLowEdge(1),data_obs.GetXaxis()->GetBinLowEdge(data_obs.GetNbinsX()+1));
     }
-    src.cp().bin({bin}).backgrounds().ForEachProc([&](ch::Process *proc) {
+    src.partition(bin).backgrounds().ForEachProc([&](ch::Process *proc) {
         total_bkg.Add((proc->ClonedScaledShape()).get());
     });
       
@@ -93,7 +94,7 @@ void AutoRebin::Rebin(CombineHarvester &src, CombineHarvester &dest) {
       if(perform_rebin_) {
         std::cout << "[AutoRebin] Applying binning to all relevant distributions "
           "for analysis bin id " << bin << std::endl; 
-      dest.cp().bin({bin}).VariableRebin(new_bins); 
+      dest.partition(bin).cp().VariableRebin(new_bins);
       }
     } else std::cout << "[AutoRebin] Did not find any bins to merge for analysis "
         "bin id: " << bin << std::endl;
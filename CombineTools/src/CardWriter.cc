@@ -1,11 +1,67 @@
 #include "CombineHarvester/CombineTools/interface/CardWriter.h"
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+#include <cstdio>
+#include <deque>
+#include <functional>
 #include <iostream>
 #include <set>
 #include <string>
+#include <utility>
 #include <vector>
 #include "boost/format.hpp"
 #include "CombineHarvester/CombineTools/interface/Logging.h"
 #include "CombineHarvester/CombineTools/interface/Algorithm.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
+#include "CombineHarvester/CombineTools/interface/OutputManifest.h"
+
+namespace {
+// Calls func(i) for each i in [0, n) in a forked child process, with at most
+// n_workers children running at once, and returns the values of i for which
+// the child did not succeed
+std::vector<unsigned> ForkEach(unsigned n, unsigned n_workers,
+                               std::function<void(unsigned)> const& func) {
+  std::vector<unsigned> failed;
+  std::deque<std::pair<pid_t, unsigned>> running;
+  auto wait_oldest = [&]() {
+    int status = 0;
+    if (waitpid(running.front().first, &status, 0) < 0 ||
+        !WIFEXITED(status) || WEXITSTATUS(status) != 0) {
+      failed.push_back(running.front().second);
+    }
+    running.pop_front();
+  };
+  for (unsigned i = 0; i < n; ++i) {
+    if (running.size() >= n_workers) wait_oldest();
+    // Don't let the children repeat anything still waiting to be printed
+    std::cout.flush();
+    std::cerr.flush();
+    std::fflush(nullptr);
+    pid_t pid = fork();
+    if (pid < 0) {
+      while (running.size()) wait_oldest();
+      throw std::runtime_error(FNERROR("Unable to fork a worker process"));
+    }
+    if (pid == 0) {
+      int code = 0;
+      try {
+        func(i);
+      } catch (std::exception const& e) {
+        std::cerr << e.what() << "\n";
+        code = 1;
+      }
+      std::cout.flush();
+      std::cerr.flush();
+      std::fflush(nullptr);
+      _exit(code);
+    }
+    running.emplace_back(pid, i);
+  }
+  while (running.size()) wait_oldest();
+  return failed;
+}
+}
 
 namespace ch {
 
@@ -15,7 +71,9 @@ CardWriter::CardWriter(std::string const& text_pattern,
       root_pattern_(root_pattern),
       wildcard_masses_({"*"}),
       v_(0),
-      create_dirs_(true) {}
+      create_dirs_(true),
+      workers_(1),
+      incremental_(false) {}
 
 CardWriter& CardWriter::SetVerbosity(unsigned v) {
   v_ = v;
@@ -27,6 +85,15 @@ CardWriter& CardWriter::CreateDirectories(bool flag) {
   return *this;
 }
 
+CardWriter& CardWriter::SetWorkers(unsigned n_workers) {
+  workers_ = n_workers;
+  return *this;
+}
+
+CardWriter& CardWriter::SetIncremental(bool flag) {
+  incremental_ = flag;
+  return *this;
+}
 
 CardWriter& CardWriter::SetWildcardMasses(
     std::vector<std::string> const& masses) {
@@ -38,7 +105,7 @@ auto CardWriter::BuildMap(std::string const& pattern,
                           ch::CombineHarvester& cmb) const -> PatternMap {
   PatternMap f_map;
   // We first filter Objects having a mass value in the wildcard list
-  cmb.cp().mass(wildcard_masses_, false)
+  cmb.view().mass(wildcard_masses_, false)
     .ForEachObj([&](ch::Object const* obj) {
       // Build the fully-compiled key
       std::string key = Compile(pattern, obj);
@@ -56,8 +123,8 @@ auto CardWriter::BuildMap(std::string const& pattern,
       }
       f_map[key] = mappings;
     });
-  auto masses = cmb.cp().mass(wildcard_masses_, false).mass_set();
-  cmb.cp().mass(wildcard_masses_, true)
+  auto masses = cmb.view().mass(wildcard_masses_, false).mass_set();
+  cmb.view().mass(wildcard_masses_, true)
     .ForEachObj([&](ch::Object const* obj) {
       // Build the fully-compiled key
       std::string key = Compile(pattern, obj, true);
@@ -120,26 +187,26 @@ std::map<std::string, CombineHarvester> CardWriter::WriteCards(std::string const
   // equivalent to tens of seconds for a complex model. To avoid this we just
   // calculate once for each ch::Object and store the result in a map, which we
   // use as a look-up later.
-  std::map<Object const*, std::string> root_map;
+  std::unordered_map<Object const*, std::string> root_map;
+  std::unordered_map<Object const*, std::string> text_map;
   cmb.ForEachObj([&](ch::Object const* obj) {
       root_map[obj] = Compile(root_pattern_, obj);
-    });
-  std::map<Object const*, std::string> text_map;
-  cmb.ForEachObj([&](ch::Object const* obj) {
       text_map[obj] = Compile(text_pattern_, obj);
     });
 
-  std::map<std::string, CombineHarvester> datacards;
+  // Split the CH instance into the objects that will be written into each
+  // file, and then each of these into the objects for each text datacard
+  struct FileJob {
+    std::string file;
+    std::vector<std::pair<std::string, CombineHarvester>> cards;
+  };
+  std::vector<FileJob> jobs;
+  std::vector<CombineHarvester> f_cmbs = Partition(cmb, f_map, root_map);
+  unsigned i_file = 0;
   for (auto const& f : f_map) {
-    // Create each ROOT file (overwrite pre-existing)
-    FNLOGC(std::cout, v_ > 0) << "Creating file " << f.first << "\n";
-    TFile file(f.first.c_str(), "RECREATE");
-
-    // Filter CH instance to leave only the objects that will be written into
-    // this file
-    CombineHarvester f_cmb = cmb.cp().FilterAll([&](ch::Object const* obj) {
-      return !ch::contains(f.second, root_map.at(obj));
-    });
+    CombineHarvester & f_cmb = f_cmbs[i_file++];
+    jobs.push_back(FileJob());
+    jobs.back().file = f.first;
 
     // Call BuildMap again - this time to figure out which text datacards to
     // create
@@ -148,21 +215,91 @@ std::map<std::string, CombineHarvester> CardWriter::WriteCards(std::string const
     // Create dirs if we're allowed to
     if (create_dirs_) MakeDirs(d_map);
 
-    // Loop through each datacard
+    std::vector<CombineHarvester> d_cmbs = Partition(f_cmb, d_map, text_map);
+    unsigned i_card = 0;
     for (auto const& d : d_map) {
-      // Filter CH instance to leave only the objects that will be written into
-      // this text datacard
-      CombineHarvester d_cmb = f_cmb.cp().FilterAll([&](ch::Object const* obj) {
-        return !ch::contains(d.second, text_map.at(obj));
-      });
-      FNLOGC(std::cout, v_ > 0) << "Creating datacard " << d.first << "\n";
-      d_cmb.WriteDatacard(d.first, file);
-      datacards[d.first] = d_cmb;
+      jobs.back().cards.emplace_back(d.first, std::move(d_cmbs[i_card++]));
+    }
+  }
+
+  auto write_file = [&](unsigned i) {
+    if (incremental_) {
+      std::vector<std::pair<std::string, CombineHarvester *>> cards;
+      for (auto & card : jobs[i].cards) {
+        cards.emplace_back(card.first, &card.second);
+      }
+      auto written = WriteDatacardsIncremental(jobs[i].file, cards);
+      for (auto const& file : written) {
+        FNLOGC(std::cout, v_ > 0) << "Updated " << file << "\n";
+      }
+      FNLOGC(std::cout, v_ > 0)
+          << (cards.size() + 1 - written.size()) << "/" << (cards.size() + 1)
+          << " files unchanged for " << jobs[i].file << "\n";
+      return;
+    }
+    // Create each ROOT file (overwrite pre-existing)
+    FNLOGC(std::cout, v_ > 0) << "Creating file " << jobs[i].file << "\n";
+    TFile file(jobs[i].file.c_str(), "RECREATE");
+    for (auto & card : jobs[i].cards) {
+      FNLOGC(std::cout, v_ > 0) << "Creating datacard " << card.first << "\n";
+      card.second.WriteDatacard(card.first, file);
     }
   };
+  if (workers_ > 1 && jobs.size() > 1) {
+    auto failed = ForkEach(jobs.size(), workers_, write_file);
+    if (failed.size()) {
+      std::string files;
+      for (unsigned i : failed) files += "\n  " + jobs[i].file;
+      throw std::runtime_error(
+          FNERROR("Writing failed for the output files:" + files));
+    }
+  } else {
+    for (unsigned i = 0; i < jobs.size(); ++i) write_file(i);
+  }
+
+  std::map<std::string, CombineHarvester> datacards;
+  for (auto & job : jobs) {
+    for (auto & card : job.cards) datacards[card.first] = card.second;
+  }
   return datacards;
 }
 
+std::vector<CombineHarvester> CardWriter::Partition(
+    ch::CombineHarvester& cmb, PatternMap const& map,
+    std::unordered_map<Object const*, std::string> const& keys) const {
+  // An object goes into every entry of map whose set of patterns contains
+  // its compiled key, so invert the map to find these entries directly
+  std::unordered_map<std::string, std::vector<unsigned>> entries;
+  unsigned i_entry = 0;
+  for (auto const& it : map) {
+    for (auto const& pattern : it.second) entries[pattern].push_back(i_entry);
+    ++i_entry;
+  }
+  std::vector<std::vector<unsigned>> obs(map.size());
+  std::vector<std::vector<unsigned>> procs(map.size());
+  std::vector<std::vector<unsigned>> systs(map.size());
+  auto add = [&](std::vector<std::vector<unsigned>> & idx, unsigned i,
+                 ch::Object const* obj) {
+    auto it = entries.find(keys.at(obj));
+    if (it == entries.end()) return;
+    for (unsigned e : it->second) idx[e].push_back(i);
+  };
+  unsigned i_obs = 0;
+  cmb.ForEachObs([&](ch::Object const* obj) { add(obs, i_obs++, obj); });
+  unsigned i_proc = 0;
+  cmb.ForEachProc([&](ch::Object const* obj) { add(procs, i_proc++, obj); });
+  unsigned i_syst = 0;
+  cmb.ForEachSyst([&](ch::Object const* obj) { add(systs, i_syst++, obj); });
+  std::vector<CombineHarvester> res;
+  res.reserve(map.size());
+  for (unsigned e = 0; e < map.size(); ++e) {
+    res.push_back(CombineHarvesterView(cmb, std::move(obs[e]),
+                                       std::move(procs[e]),
+                                       std::move(systs[e])).cp());
+  }
+  return res;
+}
+
 std::string CardWriter::Compile(std::string pattern, ch::Object const* obj,
                                 bool skip_mass) const {
   #ifdef TIME_FUNCTIONS
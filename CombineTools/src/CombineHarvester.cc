@@ -10,10 +10,19 @@
 #include "CombineHarvester/CombineTools/interface/Parameter.h"
 #include "CombineHarvester/CombineTools/interface/Logging.h"
 #include "CombineHarvester/CombineTools/interface/TFileIO.h"
+#include "CombineHarvester/CombineTools/interface/TFileCache.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
 
 namespace ch {
 
-CombineHarvester::CombineHarvester() : verbosity_(0), log_(&(std::cout)) {
+CombineHarvester::CombineHarvester()
+    : verbosity_(0),
+      log_(&(std::cout)),
+      sampling_threads_(0),
+      sampling_seed_(0),
+      shape_prefetch_threads_(0),
+      shape_write_compression_(-1),
+      shape_write_buffer_size_(0) {
   // if (verbosity_ >= 3) {
     // log() << "[CombineHarvester] Constructor called: " << this << "\n";
   // }
@@ -24,6 +33,9 @@ CombineHarvester::CombineHarvester() : verbosity_(0), log_(&(std::cout)) {
   flags_["workspace-uuid-recycle"] = true;
   flags_["import-parameter-err"] = true;
   flags_["filters-use-regex"] = false;
+  flags_["cache-shape-files"] = false;
+  flags_["partition-by-bin"] = false;
+  flags_["incremental-write"] = false;
   // std::cout << "[CombineHarvester] Constructor called for " << this << "\n";
 }
 
@@ -44,20 +56,38 @@ void swap(CombineHarvester& first, CombineHarvester& second) {
   swap(first.flags_, second.flags_);
   swap(first.post_lines_, second.post_lines_);
   swap(first.log_, second.log_);
+  swap(first.sampling_threads_, second.sampling_threads_);
+  swap(first.sampling_seed_, second.sampling_seed_);
+  swap(first.shape_prefetch_threads_, second.shape_prefetch_threads_);
+  swap(first.shape_write_compression_, second.shape_write_compression_);
+  swap(first.shape_write_buffer_size_, second.shape_write_buffer_size_);
   swap(first.auto_stats_settings_, second.auto_stats_settings_);
+  // Each instance keeps its own proc_index_mutex_
+  swap(first.proc_index_, second.proc_index_);
+  swap(first.bin_partitions_, second.bin_partitions_);
 }
 
 CombineHarvester::CombineHarvester(CombineHarvester const& other)
-    : obs_(other.obs_),
-      procs_(other.procs_),
-      systs_(other.systs_),
+    : CombineHarvester(other, true) {}
+
+CombineHarvester::CombineHarvester(CombineHarvester const& other,
+                                   bool copy_entries)
+    : obs_(copy_entries ? other.obs_ : decltype(obs_)()),
+      procs_(copy_entries ? other.procs_ : decltype(procs_)()),
+      systs_(copy_entries ? other.systs_ : decltype(systs_)()),
       params_(other.params_),
       wspaces_(other.wspaces_),
       flags_(other.flags_),
       auto_stats_settings_(other.auto_stats_settings_),
       post_lines_(other.post_lines_),
       verbosity_(other.verbosity_),
-      log_(other.log_) {
+      log_(other.log_),
+      sampling_threads_(other.sampling_threads_),
+      sampling_seed_(other.sampling_seed_),
+      shape_prefetch_threads_(other.shape_prefetch_threads_),
+      shape_write_compression_(other.shape_write_compression_),
+      shape_write_buffer_size_(other.shape_write_buffer_size_),
+      bin_partitions_(copy_entries ? other.bin_partitions_ : nullptr) {
   // std::cout << "[CombineHarvester] Copy-constructor called " << &other
   //     << " -> " << this << "\n";
 }
@@ -94,6 +124,11 @@ CombineHarvester CombineHarvester::deep() {
   cpy.verbosity_ = verbosity_;
   cpy.post_lines_ = post_lines_;
   cpy.log_ = log_;
+  cpy.sampling_threads_ = sampling_threads_;
+  cpy.sampling_seed_ = sampling_seed_;
+  cpy.shape_prefetch_threads_ = shape_prefetch_threads_;
+  cpy.shape_write_compression_ = shape_write_compression_;
+  cpy.shape_write_buffer_size_ = shape_write_buffer_size_;
 
   // Build a map of workspace object pointers
   std::map<RooAbsData const*, RooAbsData *> dat_map;
@@ -222,6 +257,10 @@ CombineHarvester CombineHarvester::cp() {
   return CombineHarvester(*this);
 }
 
+CombineHarvesterView CombineHarvester::view() {
+  return CombineHarvesterView(*this);
+}
+
 CombineHarvester & CombineHarvester::PrintAll() {
   return PrintObs().PrintProcs().PrintSysts().PrintParams();
 }
@@ -315,7 +354,8 @@ void CombineHarvester::LoadShapes(Observation* entry,
     if (verbosity_ >= 2) LOGLINE(log(), "Mapping type in TH1");
     // Pre-condition #3
     // GetClonedTH1 will throw if this fails
-    std::unique_ptr<TH1> h = GetClonedTH1(mapping.file.get(), mapping.pattern);
+    std::unique_ptr<TH1> h =
+        TFileCache::Instance().GetClonedTH1(mapping.file.get(), mapping.pattern);
     // Post-conditions #1 and #2
     entry->set_shape(std::move(h), true);
   } else if (mapping.IsData()) {
@@ -399,7 +439,8 @@ void CombineHarvester::LoadShapes(Process* entry,
     if (verbosity_ >= 2) LOGLINE(log(), "Mapping type is TH1");
     // Pre-condition #3
     // GetClonedTH1 will throw if this fails
-    std::unique_ptr<TH1> h = GetClonedTH1(mapping.file.get(), mapping.pattern);
+    std::unique_ptr<TH1> h =
+        TFileCache::Instance().GetClonedTH1(mapping.file.get(), mapping.pattern);
 
     if (flags_.at("check-negative-bins-on-import")) {
       if (HasNegativeBins(h.get())) {
@@ -542,9 +583,12 @@ void CombineHarvester::LoadShapes(Systematic* entry,
   boost::replace_all(p_s_lo, "$SYSTEMATIC", entry->name() + "Down");
   if (mapping.IsHist()) {
     if (verbosity_ >= 2) LOGLINE(log(), "Mapping type is TH1");
-    std::unique_ptr<TH1> h = GetClonedTH1(mapping.file.get(), mapping.pattern);
-    std::unique_ptr<TH1> h_u = GetClonedTH1(mapping.file.get(), p_s_hi);
-    std::unique_ptr<TH1> h_d = GetClonedTH1(mapping.file.get(), p_s_lo);
+    std::unique_ptr<TH1> h =
+        TFileCache::Instance().GetClonedTH1(mapping.file.get(), mapping.pattern);
+    std::unique_ptr<TH1> h_u =
+        TFileCache::Instance().GetClonedTH1(mapping.file.get(), p_s_hi);
+    std::unique_ptr<TH1> h_d =
+        TFileCache::Instance().GetClonedTH1(mapping.file.get(), p_s_lo);
 
     if (flags_.at("check-negative-bins-on-import")) {
       if (HasNegativeBins(h.get())) {
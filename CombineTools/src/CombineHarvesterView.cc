@@ -0,0 +1,218 @@
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
+#include <functional>
+#include <numeric>
+#include <set>
+#include <string>
+#include <utility>
+#include <vector>
+
+namespace ch {
+
+CombineHarvesterView::CombineHarvesterView(CombineHarvester & cb)
+    : cb_(&cb),
+      obs_idx_(cb.obs_.size()),
+      procs_idx_(cb.procs_.size()),
+      systs_idx_(cb.systs_.size()) {
+  std::iota(obs_idx_.begin(), obs_idx_.end(), 0);
+  std::iota(procs_idx_.begin(), procs_idx_.end(), 0);
+  std::iota(systs_idx_.begin(), systs_idx_.end(), 0);
+}
+
+CombineHarvesterView::CombineHarvesterView(CombineHarvester & cb,
+                                           std::vector<unsigned> obs_idx,
+                                           std::vector<unsigned> procs_idx,
+                                           std::vector<unsigned> systs_idx)
+    : cb_(&cb),
+      obs_idx_(std::move(obs_idx)),
+      procs_idx_(std::move(procs_idx)),
+      systs_idx_(std::move(systs_idx)) {}
+
+CombineHarvester CombineHarvesterView::cp() const {
+  CombineHarvester res(*cb_, false);
+  res.obs_.reserve(obs_idx_.size());
+  for (unsigned i : obs_idx_) res.obs_.push_back(cb_->obs_[i]);
+  res.procs_.reserve(procs_idx_.size());
+  for (unsigned i : procs_idx_) res.procs_.push_back(cb_->procs_[i]);
+  res.systs_.reserve(systs_idx_.size());
+  for (unsigned i : systs_idx_) res.systs_.push_back(cb_->systs_[i]);
+  return res;
+}
+
+CombineHarvesterView& CombineHarvesterView::bin(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(obs_idx_, cb_->obs_, vec, std::mem_fn(&Observation::bin), cond);
+  FilterIndex(procs_idx_, cb_->procs_, vec, std::mem_fn(&Process::bin), cond);
+  FilterIndex(systs_idx_, cb_->systs_, vec, std::mem_fn(&Systematic::bin),
+              cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::bin_id(
+    std::vector<int> const& vec, bool cond) {
+  // Never a regex match, as for CombineHarvester::bin_id
+  auto const& obs = cb_->obs_;
+  auto const& procs = cb_->procs_;
+  auto const& systs = cb_->systs_;
+  FilterContaining(obs_idx_, vec,
+                   [&](unsigned i) { return obs[i]->bin_id(); }, cond);
+  FilterContaining(procs_idx_, vec,
+                   [&](unsigned i) { return procs[i]->bin_id(); }, cond);
+  FilterContaining(systs_idx_, vec,
+                   [&](unsigned i) { return systs[i]->bin_id(); }, cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::process(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(procs_idx_, cb_->procs_, vec, std::mem_fn(&Process::process),
+              cond);
+  FilterIndex(systs_idx_, cb_->systs_, vec, std::mem_fn(&Systematic::process),
+              cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::process_rgx(
+    std::vector<std::string> const& vec, bool cond) {
+  auto const& procs = cb_->procs_;
+  auto const& systs = cb_->systs_;
+  FilterContainingRgx(procs_idx_, vec,
+                      [&](unsigned i) { return procs[i]->process(); }, cond);
+  FilterContainingRgx(systs_idx_, vec,
+                      [&](unsigned i) { return systs[i]->process(); }, cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::analysis(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(obs_idx_, cb_->obs_, vec, std::mem_fn(&Observation::analysis),
+              cond);
+  FilterIndex(procs_idx_, cb_->procs_, vec, std::mem_fn(&Process::analysis),
+              cond);
+  FilterIndex(systs_idx_, cb_->systs_, vec,
+              std::mem_fn(&Systematic::analysis), cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::era(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(obs_idx_, cb_->obs_, vec, std::mem_fn(&Observation::era), cond);
+  FilterIndex(procs_idx_, cb_->procs_, vec, std::mem_fn(&Process::era), cond);
+  FilterIndex(systs_idx_, cb_->systs_, vec, std::mem_fn(&Systematic::era),
+              cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::channel(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(obs_idx_, cb_->obs_, vec, std::mem_fn(&Observation::channel),
+              cond);
+  FilterIndex(procs_idx_, cb_->procs_, vec, std::mem_fn(&Process::channel),
+              cond);
+  FilterIndex(systs_idx_, cb_->systs_, vec, std::mem_fn(&Systematic::channel),
+              cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::mass(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(obs_idx_, cb_->obs_, vec, std::mem_fn(&Observation::mass),
+              cond);
+  FilterIndex(procs_idx_, cb_->procs_, vec, std::mem_fn(&Process::mass),
+              cond);
+  FilterIndex(systs_idx_, cb_->systs_, vec, std::mem_fn(&Systematic::mass),
+              cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::attr(
+    std::vector<std::string> const& vec, std::string attr_label, bool cond) {
+  auto get = [&](Object const& obj) { return obj.attribute(attr_label); };
+  FilterIndex(obs_idx_, cb_->obs_, vec, get, cond);
+  FilterIndex(procs_idx_, cb_->procs_, vec, get, cond);
+  FilterIndex(systs_idx_, cb_->systs_, vec, get, cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::syst_name(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(systs_idx_, cb_->systs_, vec, std::mem_fn(&Systematic::name),
+              cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::syst_type(
+    std::vector<std::string> const& vec, bool cond) {
+  FilterIndex(systs_idx_, cb_->systs_, vec, std::mem_fn(&Systematic::type),
+              cond);
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::signals() {
+  FilterProcs([](Process const* proc) { return !proc->signal(); });
+  FilterSysts([](Systematic const* sys) { return !sys->signal(); });
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::backgrounds() {
+  FilterProcs([](Process const* proc) { return proc->signal(); });
+  FilterSysts([](Systematic const* sys) { return sys->signal(); });
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::histograms() {
+  FilterObs([](Observation const* obs) { return obs->shape() == nullptr; });
+  FilterProcs([](Process const* proc) { return proc->shape() == nullptr; });
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::pdfs() {
+  FilterProcs([](Process const* proc) { return proc->pdf() == nullptr; });
+  return *this;
+}
+
+CombineHarvesterView& CombineHarvesterView::data() {
+  FilterObs([](Observation const* obs) { return obs->data() == nullptr; });
+  return *this;
+}
+
+std::set<std::string> CombineHarvesterView::bin_set() const {
+  return SetFromAll(std::mem_fn(&Object::bin));
+}
+
+std::set<int> CombineHarvesterView::bin_id_set() const {
+  return SetFromAll(std::mem_fn(&Object::bin_id));
+}
+
+std::set<std::string> CombineHarvesterView::process_set() const {
+  std::set<std::string> result =
+      SetFromProcs(std::mem_fn(&Process::process));
+  std::set<std::string> result2 =
+      SetFromSysts(std::mem_fn(&Systematic::process));
+  result.insert(result2.begin(), result2.end());
+  return result;
+}
+
+std::set<std::string> CombineHarvesterView::analysis_set() const {
+  return SetFromAll(std::mem_fn(&Object::analysis));
+}
+
+std::set<std::string> CombineHarvesterView::era_set() const {
+  return SetFromAll(std::mem_fn(&Object::era));
+}
+
+std::set<std::string> CombineHarvesterView::channel_set() const {
+  return SetFromAll(std::mem_fn(&Object::channel));
+}
+
+std::set<std::string> CombineHarvesterView::mass_set() const {
+  return SetFromAll(std::mem_fn(&Object::mass));
+}
+
+std::set<std::string> CombineHarvesterView::syst_name_set() const {
+  return SetFromSysts(std::mem_fn(&Systematic::name));
+}
+
+std::set<std::string> CombineHarvesterView::syst_type_set() const {
+  return SetFromSysts(std::mem_fn(&Systematic::type));
+}
+}
@@ -57,6 +57,10 @@ void CombineHarvester::AddProcesses(
       unsigned(channel.size()),
       unsigned(bin.size())};
   auto comb = ch::GenerateCombinations(lengths);
+  std::lock_guard<std::mutex> lock(proc_index_mutex_);
+  // Whether the index still matches procs_ is only checked when it is used
+  bool index_current =
+      proc_index_ && proc_index_->generation == Object::Generation();
   for (auto const& c : comb) {
     for (unsigned i = 0; i < procs.size(); ++i) {
       auto proc = std::make_shared<Process>();
@@ -71,6 +75,7 @@ void CombineHarvester::AddProcesses(
       procs_.push_back(proc);
     }
   }
+  if (index_current) ExtendProcIndex();
 }
 
 void CombineHarvester::AddSystFromProc(Process const& proc,
@@ -92,8 +97,16 @@ void CombineHarvester::AddSystFromProc(Process const& proc,
   for( const auto it : attrs){
       boost::replace_all(subbed_name, "$ATTR("+it.first+")",proc.attribute(it.first));
   }
+  // Setting the properties of the new Systematic doesn't affect the Process
+  // index, so we can keep it valid
   auto sys = std::make_shared<Systematic>();
-  ch::SetProperties(sys.get(), &proc);
+  {
+    std::lock_guard<std::mutex> lock(proc_index_mutex_);
+    bool index_current =
+        proc_index_ && proc_index_->generation == Object::Generation();
+    ch::SetProperties(sys.get(), &proc);
+    if (index_current) proc_index_->generation = Object::Generation();
+  }
   sys->set_name(subbed_name);
   sys->set_type(type);
   if (type == "lnN" || type == "lnU") {
@@ -131,6 +144,7 @@ void CombineHarvester::AddSystFromProc(Process const& proc,
     params_.at(sys->name())->set_err_d(0.);
     params_.at(sys->name())->set_err_u(0.);
   }
+  // Object::Generation() has already been incremented by SetProperties
   systs_.push_back(sys);
 }
 
@@ -244,13 +258,21 @@ void CombineHarvester::MergeBinErrors(double bbb_threshold,
 
 void CombineHarvester::InsertObservation(ch::Observation const& obs) {
   obs_.push_back(std::make_shared<ch::Observation>(obs));
+  Object::IncrementGeneration();
 }
 
 void CombineHarvester::InsertProcess(ch::Process const& proc) {
+  std::lock_guard<std::mutex> lock(proc_index_mutex_);
+  // Whether the index still matches procs_ is only checked when it is used
+  bool index_current =
+      proc_index_ && proc_index_->generation == Object::Generation();
   procs_.push_back(std::make_shared<ch::Process>(proc));
+  Object::IncrementGeneration();
+  if (index_current) ExtendProcIndex();
 }
 
 void CombineHarvester::InsertSystematic(ch::Systematic const& sys) {
   systs_.push_back(std::make_shared<ch::Systematic>(sys));
+  Object::IncrementGeneration();
 }
 }
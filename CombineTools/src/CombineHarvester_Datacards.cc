@@ -9,6 +9,7 @@
 #include <fstream>
 #include <sstream>
 #include <fnmatch.h>
+#include <algorithm>
 #include "boost/lexical_cast.hpp"
 #include "boost/algorithm/string.hpp"
 #include "boost/format.hpp"
@@ -26,10 +27,101 @@
 #include "CombineHarvester/CombineTools/interface/MakeUnique.h"
 #include "CombineHarvester/CombineTools/interface/Utilities.h"
 #include "CombineHarvester/CombineTools/interface/TFileIO.h"
+#include "CombineHarvester/CombineTools/interface/TFileCache.h"
 #include "CombineHarvester/CombineTools/interface/Algorithm.h"
+#include "CombineHarvester/CombineTools/interface/DatacardTokens.h"
+#include "CombineHarvester/CombineTools/interface/OutputManifest.h"
 #include "CombineHarvester/CombineTools/interface/zstr.hpp"
 namespace ch {
 
+namespace {
+// boost::lexical_cast of a word without a temporary std::string
+template <typename T>
+T ParseAs(boost::string_ref word) {
+  return boost::lexical_cast<T>(word.data(), word.size());
+}
+}
+
+void CombineHarvester::SetShapePrefetchThreads(unsigned n_threads) {
+  shape_prefetch_threads_ = n_threads;
+}
+
+void CombineHarvester::SetShapeWriteSettings(int compression,
+                                             int buffer_size) {
+  shape_write_compression_ = compression;
+  shape_write_buffer_size_ = buffer_size;
+}
+
+void CombineHarvester::PrefetchShapes(
+    DatacardTokens const& words,
+    std::vector<HistMapping> const& mappings,
+    std::map<std::string, std::shared_ptr<TFile>> const& files,
+    std::string const& mass) {
+  // The bin and process names in the card are enough to narrow the
+  // placeholders in the mapping patterns down to the objects that will be
+  // loaded
+  std::set<std::string> bins;
+  std::set<std::string> procs;
+  for (auto const& line : words) {
+    if (line.keyword(0) == DatacardTokens::Keyword::bin) {
+      for (unsigned p = 1; p < line.size(); ++p) bins.insert(line.str(p));
+    } else if (line.keyword(0) == DatacardTokens::Keyword::process) {
+      for (unsigned p = 1; p < line.size(); ++p) procs.insert(line.str(p));
+    }
+  }
+  auto escape = [](std::string const& str) {
+    static const boost::regex special("[.^$|()\\[\\]{}*+?\\\\]");
+    return boost::regex_replace(str, special, "\\\\&",
+                                boost::match_default | boost::format_sed);
+  };
+  auto alternatives = [&](std::set<std::string> const& names) {
+    std::vector<std::string> escaped;
+    for (auto const& name : names) escaped.push_back(escape(name));
+    return "(?:" + boost::join(escaped, "|") + ")";
+  };
+  auto to_regex = [&](std::string const& pattern) {
+    std::string res = escape(pattern);
+    boost::replace_all(res, "\\$CHANNEL", alternatives(bins));
+    boost::replace_all(res, "\\$BIN", alternatives(bins));
+    boost::replace_all(res, "\\$PROCESS", alternatives(procs));
+    boost::replace_all(res, "\\$MASS", escape(mass));
+    boost::replace_all(res, "\\$SYSTEMATIC", ".*");
+    return boost::regex(res);
+  };
+
+  std::map<std::string, std::vector<boost::regex>> file_rgx;
+  for (auto const& mapping : mappings) {
+    if (mapping.is_fake || !mapping.IsHist() || !mapping.file) continue;
+    auto file_it = std::find_if(files.begin(), files.end(),
+        [&](std::pair<const std::string, std::shared_ptr<TFile>> const& file) {
+          return file.second == mapping.file;
+        });
+    if (file_it == files.end()) continue;
+    auto & rgx = file_rgx[file_it->first];
+    rgx.push_back(to_regex(mapping.pattern));
+    if (mapping.syst_pattern != "") {
+      rgx.push_back(to_regex(mapping.syst_pattern));
+    }
+  }
+  for (auto const& it : file_rgx) {
+    std::vector<std::string> objects;
+    for (auto const& key : TFileCache::Instance().ListTH1Keys(it.first)) {
+      for (auto const& rgx : it.second) {
+        if (boost::regex_match(key, rgx)) {
+          objects.push_back(key);
+          break;
+        }
+      }
+    }
+    if (verbosity_ >= 1) {
+      FNLOG(log()) << "Prefetching " << objects.size() << " objects from "
+                   << it.first << "\n";
+    }
+    TFileCache::Instance().Prefetch(it.first, objects,
+                                    shape_prefetch_threads_);
+  }
+}
+
 // Extract info from filename using parse rule like:
 // ".*{MASS}/{ANALYSIS}_{CHANNEL}_{BINID}_{ERA}.txt"
 int CombineHarvester::ParseDatacard(std::string const& filename,
@@ -59,30 +151,30 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
     int bin_id,
     std::string const& mass) {
   TH1::AddDirectory(kFALSE);
-  // Load the entire datacard into memory as a vector of strings
-  std::vector<std::string> lines = ch::ParseFileLines(filename);
-  // Loop through lines, trimming whitespace at the beginning or end
-  // then splitting each line into a vector of words (using any amount
-  // of whitespace as the separator).  We skip any line of zero length
-  // or which starts with a "#" or "-" character.
-  std::vector<std::vector<std::string>> words;
-  for (unsigned i = 0; i < lines.size(); ++i) {
-    boost::trim(lines[i]);
-    if (lines[i].size() == 0) continue;
-    if (lines[i].at(0) == '#' || lines[i].at(0) == '-') continue;
-    words.push_back(std::vector<std::string>());
-    boost::split(words.back(), lines[i], boost::is_any_of("\t "),
-        boost::token_compress_on);
-  }
+  // Load the entire datacard into memory and split each line into a
+  // vector of words (using any amount of whitespace as the separator).
+  // Lines of zero length or which start with a "#" or "-" character are
+  // skipped. The words are views into a single buffer.
+  DatacardTokens words(filename);
+  typedef DatacardTokens::Keyword Keyword;
 
   std::vector<HistMapping> hist_mapping;
   // std::map<std::string, RooAbsData*> data_map;
   std::map<std::string, std::shared_ptr<TFile>> file_store;
   std::map<std::string, std::shared_ptr<RooWorkspace>> ws_store;
+  // Prefetching reads the templates into the shared cache, so implies it
+  bool use_file_cache =
+      flags_.at("cache-shape-files") || shape_prefetch_threads_ > 0;
 
   bool start_nuisance_scan = false;
   unsigned r = 0;
 
+  // The bin, process name and signal flag of each column of the process
+  // lines, which are filled once the rate line has been found
+  std::vector<std::string> col_bin;
+  std::vector<std::string> col_proc;
+  std::vector<bool> col_signal;
+
   // We will allow cards that describe a single bin to have an "observation"
   // line without a "bin" line above it. We probably won't know the bin name
   // when we parse this line, so we'll store it here and fix it later
@@ -97,28 +189,32 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
   for (unsigned i = 0; i < words.size(); ++i) {
     // Ignore line if it only has one word
     if (words[i].size() <= 1) continue;
+    if (words[i].keyword(0) != Keyword::shapes) continue;
 
     // If the line begins "shapes" then we've
     // found process --> TH1 mapping information
-    if (boost::iequals(words[i][0], "shapes") && words[i].size() >= 5) {
+    if (words[i].size() >= 5) {
       hist_mapping.push_back(HistMapping());
       HistMapping &mapping = hist_mapping.back();
-      mapping.process = words[i][1];
-      mapping.category = words[i][2];
+      mapping.process = words[i].str(1);
+      mapping.category = words[i].str(2);
       // The root file path given in the datacard is relative to the datacard
       // path, so we join the path to the datacard with the path to the file
       std::string dc_path;
       std::size_t slash = filename.find_last_of('/');
       if (slash != filename.npos) {
-        dc_path = filename.substr(0, slash) + "/" + words[i][3];
+        dc_path = filename.substr(0, slash) + "/" + words[i].str(3);
       } else {
-        dc_path = words[i][3];
+        dc_path = words[i].str(3);
+      }
+      if (!file_store.count(dc_path)) {
+        file_store[dc_path] =
+            use_file_cache ? TFileCache::Instance().GetFile(dc_path)
+                           : std::make_shared<TFile>(dc_path.c_str());
       }
-      if (!file_store.count(dc_path))
-        file_store[dc_path] = std::make_shared<TFile>(dc_path.c_str());
       mapping.file = file_store.at(dc_path);
-      mapping.pattern = words[i][4];
-      if (words[i].size() > 5) mapping.syst_pattern = words[i][5];
+      mapping.pattern = words[i].str(4);
+      if (words[i].size() > 5) mapping.syst_pattern = words[i].str(5);
 
       if (mapping.IsPdf()) {
         std::string store_key =
@@ -152,19 +248,21 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
 
     // We can also have a "FAKE" shape directive
     // Must be four words long: shapes * * FAKE
-    if (boost::iequals(words[i][0], "shapes") && words[i].size() == 4 &&
-        boost::iequals(words[i][3], "FAKE")) {
+    if (words[i].size() == 4 && IEquals(words[i][3], "fake")) {
       hist_mapping.push_back(HistMapping());
       HistMapping &mapping = hist_mapping.back();
-      mapping.process = words[i][1];
-      mapping.category = words[i][2];
+      mapping.process = words[i].str(1);
+      mapping.category = words[i].str(2);
       mapping.is_fake = true;
     }
   }
 
+  if (shape_prefetch_threads_ > 0) {
+    PrefetchShapes(words, hist_mapping, file_store, mass);
+  }
+
   for (unsigned i = 0; i < words.size(); ++i) {
-    if (words[i].size() >= 3 &&
-        boost::iequals(words[i][1], "extArg")) {
+    if (words[i].size() >= 3 && words[i].keyword(1) == Keyword::extArg) {
       if (verbosity_ > 1) {
         FNLOG(log()) << "Processing extArg line:\n";
         for (auto const& str : words[i]) {
@@ -174,21 +272,21 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
       }
 
       bool has_range = words[i].size() == 4 && words[i][3][0] == '[';
-      std::string param_name = words[i][0];
+      std::string param_name = words[i].str(0);
       bool is_wsp_rateparam = false;
       try {
-        boost::lexical_cast<double>(words[i][2]);
+        ParseAs<double>(words[i][2]);
       } catch (boost::bad_lexical_cast &) {
         is_wsp_rateparam = true;
       }
       if ((!is_wsp_rateparam) && (words[i].size() == 3 || has_range)) {
         ch::Parameter* param = SetupRateParamVar(
-            param_name, boost::lexical_cast<double>(words[i][2]), true);
+            param_name, ParseAs<double>(words[i][2]), true);
         param->set_err_u(0.);
         param->set_err_d(0.);
         if (has_range) {
           std::vector<std::string> tokens;
-          boost::split(tokens, words[i][3], boost::is_any_of("[],"));
+          boost::split(tokens, words[i].str(3), boost::is_any_of("[],"));
           if (tokens.size() == 4) {
             param->set_range_d(boost::lexical_cast<double>(tokens[1]));
             param->set_range_u(boost::lexical_cast<double>(tokens[2]));
@@ -196,28 +294,33 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
           }
         }
       } else if (words[i].size() == 3 && is_wsp_rateparam) {
-        SetupRateParamWspObj(param_name, words[i][2], true);
+        SetupRateParamWspObj(param_name, words[i].str(2), true);
       }
     }
   }
 
+  // The systematic types that can appear on a nuisance line
+  std::vector<std::string> const syst_types = {"shape",   "shape?", "shapeN2",
+                                               "shapeU",  "lnN",    "lnU"};
+
   // Loop through the vector of word vectors
   for (unsigned i = 0; i < words.size(); ++i) {
+    DatacardTokens::Line const& line = words[i];
     // Ignore line if it only has one word
-    if (words[i].size() <= 1) continue;
+    if (line.size() <= 1) continue;
 
     // Want to check this line and the previous one, so need i >= 1.
     // If the first word on this line is "observation" and "bin" on
     // the previous line then we've found the entries for data, and
     // can add Observation objects
     if (i >= 1) {
-      if (  boost::iequals(words[i][0], "observation") &&
-            boost::iequals(words[i-1][0], "bin") &&
-            words[i].size() == words[i-1].size()) {
-        for (unsigned p = 1; p < words[i].size(); ++p) {
+      if (  line.keyword(0) == Keyword::observation &&
+            words[i-1].keyword(0) == Keyword::bin &&
+            line.size() == words[i-1].size()) {
+        for (unsigned p = 1; p < line.size(); ++p) {
           auto obs = std::make_shared<Observation>();
-          obs->set_bin(words[i-1][p]);
-          obs->set_rate(boost::lexical_cast<double>(words[i][p]));
+          obs->set_bin(words[i-1].str(p));
+          obs->set_rate(ParseAs<double>(line[p]));
           obs->set_analysis(analysis);
           obs->set_era(era);
           obs->set_channel(channel);
@@ -231,14 +334,14 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
       }
     }
 
-    if (boost::iequals(words[i][0], "observation") &&
-        !boost::iequals(words[i-1][0], "bin") &&
-        words[i].size() == 2 &&
+    if (line.keyword(0) == Keyword::observation &&
+        (i == 0 || words[i-1].keyword(0) != Keyword::bin) &&
+        line.size() == 2 &&
         single_obs.get() == nullptr) {
-      for (unsigned p = 1; p < words[i].size(); ++p) {
+      for (unsigned p = 1; p < line.size(); ++p) {
         single_obs = std::make_shared<Observation>();
         single_obs->set_bin("");
-        single_obs->set_rate(boost::lexical_cast<double>(words[i][p]));
+        single_obs->set_rate(ParseAs<double>(line[p]));
         single_obs->set_analysis(analysis);
         single_obs->set_era(era);
         single_obs->set_channel(channel);
@@ -254,27 +357,33 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
     // line that follows is a nuisance parameter
 
     if (i >= 3) {
-      if (  boost::iequals(words[i][0], "rate") &&
-            boost::iequals(words[i-1][0], "process") &&
-            boost::iequals(words[i-2][0], "process") &&
-            boost::iequals(words[i-3][0], "bin") &&
-            words[i].size() == words[i-1].size() &&
-            words[i].size() == words[i-2].size() &&
-            words[i].size() == words[i-3].size()) {
-        for (unsigned p = 1; p < words[i].size(); ++p) {
+      if (  line.keyword(0) == Keyword::rate &&
+            words[i-1].keyword(0) == Keyword::process &&
+            words[i-2].keyword(0) == Keyword::process &&
+            words[i-3].keyword(0) == Keyword::bin &&
+            line.size() == words[i-1].size() &&
+            line.size() == words[i-2].size() &&
+            line.size() == words[i-3].size()) {
+        col_bin.assign(1, "");
+        col_proc.assign(1, "");
+        col_signal.assign(1, false);
+        for (unsigned p = 1; p < line.size(); ++p) {
           auto proc = std::make_shared<Process>();
-          proc->set_bin(words[i-3][p]);
-          bin_names.insert(words[i-3][p]);
+          proc->set_bin(words[i-3].str(p));
+          bin_names.insert(proc->bin());
           try {
-            int process_id = boost::lexical_cast<int>(words[i-2][p]);
+            int process_id = ParseAs<int>(words[i-2][p]);
             proc->set_signal(process_id <= 0);
-            proc->set_process(words[i-1][p]);
+            proc->set_process(words[i-1].str(p));
           } catch(boost::bad_lexical_cast &) {
-            int process_id = boost::lexical_cast<int>(words[i-1][p]);
+            int process_id = ParseAs<int>(words[i-1][p]);
             proc->set_signal(process_id <= 0);
-            proc->set_process(words[i-2][p]);
+            proc->set_process(words[i-2].str(p));
           }
-          proc->set_rate(boost::lexical_cast<double>(words[i][p]));
+          col_bin.push_back(proc->bin());
+          col_proc.push_back(proc->process());
+          col_signal.push_back(proc->signal());
+          proc->set_rate(ParseAs<double>(line[p]));
           proc->set_analysis(analysis);
           proc->set_era(era);
           proc->set_channel(channel);
@@ -290,104 +399,94 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
       }
     }
 
-    if (start_nuisance_scan && words[i].size() >= 4) {
-      if (boost::iequals(words[i][1], "param")) {
-        std::string param_name = words[i][0];
-        if (!params_.count(param_name))
-          params_[param_name] = std::make_shared<Parameter>(Parameter());
-        Parameter * param = params_.at(param_name).get();
-        param->set_name(param_name);
-        param->set_val(boost::lexical_cast<double>(words[i][2]));
-        std::size_t slash_pos = words[i][3].find("/");
-        if (slash_pos != words[i][3].npos) {
-          param->set_err_d(
-            boost::lexical_cast<double>(words[i][3].substr(0, slash_pos)));
-          param->set_err_u(
-            boost::lexical_cast<double>(words[i][3].substr(slash_pos+1)));
-        } else {
-          param->set_err_u(+1.0 * boost::lexical_cast<double>(words[i][3]));
-          param->set_err_d(-1.0 * boost::lexical_cast<double>(words[i][3]));
-        }
-        if (words[i].size() >= 5) {
-          // We have a range
-          std::vector<std::string> tokens;
-          boost::split(tokens, words[i][4], boost::is_any_of("[],"));
-          if (tokens.size() == 4) {
-            param->set_range_d(boost::lexical_cast<double>(tokens[1]));
-            param->set_range_u(boost::lexical_cast<double>(tokens[2]));
-          }
+    if (!start_nuisance_scan) continue;
+
+    if (line.size() >= 4 && line.keyword(1) == Keyword::param) {
+      std::string param_name = line.str(0);
+      if (!params_.count(param_name))
+        params_[param_name] = std::make_shared<Parameter>(Parameter());
+      Parameter * param = params_.at(param_name).get();
+      param->set_name(param_name);
+      param->set_val(ParseAs<double>(line[2]));
+      std::size_t slash_pos = line[3].find('/');
+      if (slash_pos != line[3].npos) {
+        param->set_err_d(ParseAs<double>(line[3].substr(0, slash_pos)));
+        param->set_err_u(ParseAs<double>(line[3].substr(slash_pos+1)));
+      } else {
+        param->set_err_u(+1.0 * ParseAs<double>(line[3]));
+        param->set_err_d(-1.0 * ParseAs<double>(line[3]));
+      }
+      if (line.size() >= 5) {
+        // We have a range
+        std::vector<std::string> tokens;
+        boost::split(tokens, line.str(4), boost::is_any_of("[],"));
+        if (tokens.size() == 4) {
+          param->set_range_d(boost::lexical_cast<double>(tokens[1]));
+          param->set_range_u(boost::lexical_cast<double>(tokens[2]));
         }
-        continue;  // skip the rest of this now
       }
+      continue;  // skip the rest of this now
     }
 
-    if (start_nuisance_scan && words[i].size() >= 5 &&
-        boost::iequals(words[i][1], "rateParam")) {
+    if (line.size() >= 5 && line.keyword(1) == Keyword::rateParam) {
       if (verbosity_ > 1) {
         FNLOG(log()) << "Processing rateParam line:\n";
-        for (auto const& str : words[i]) {
+        for (auto const& str : line) {
           log() << str << "\t";
         }
         log() << "\n";
       }
 
-      bool has_range = words[i].size() == 6 && words[i][5][0] == '[';
-      std::string param_name = words[i][0];
+      bool has_range = line.size() == 6 && line[5][0] == '[';
+      std::string param_name = line.str(0);
       // If this is a free param may need to create a Parameter object
       // If the line has 5 words then it can either be a floating param
       // or one from a workspace. Otherwise if it has 6 then it's either
       // a floating param with a range or a formula
       bool is_wsp_rateparam = false;
       try {
-        boost::lexical_cast<double>(words[i][4]);
+        ParseAs<double>(line[4]);
       } catch (boost::bad_lexical_cast &) {
         is_wsp_rateparam = true;
       }
-      if ((!is_wsp_rateparam) && (words[i].size() == 5 || has_range)) {
+      if ((!is_wsp_rateparam) && (line.size() == 5 || has_range)) {
         ch::Parameter* param = SetupRateParamVar(
-            param_name, boost::lexical_cast<double>(words[i][4]));
+            param_name, ParseAs<double>(line[4]));
         param->set_err_u(0.);
         param->set_err_d(0.);
         if (has_range) {
           std::vector<std::string> tokens;
-          boost::split(tokens, words[i][5], boost::is_any_of("[],"));
+          boost::split(tokens, line.str(5), boost::is_any_of("[],"));
           if (tokens.size() == 4) {
             param->set_range_d(boost::lexical_cast<double>(tokens[1]));
             param->set_range_u(boost::lexical_cast<double>(tokens[2]));
-            FNLOGC(log(), verbosity_ > 1) << "Setting parameter range to " << words[i][5];
+            FNLOGC(log(), verbosity_ > 1) << "Setting parameter range to " << line[5];
           }
         }
-      } else if (words[i].size() == 6 && !has_range) {
-        SetupRateParamFunc(param_name, words[i][4], words[i][5]);
-      } else if (words[i].size() == 5 && is_wsp_rateparam) {
-        SetupRateParamWspObj(param_name, words[i][4]);
+      } else if (line.size() == 6 && !has_range) {
+        SetupRateParamFunc(param_name, line.str(4), line.str(5));
+      } else if (line.size() == 5 && is_wsp_rateparam) {
+        SetupRateParamWspObj(param_name, line.str(4));
       }
+      std::string bin_pattern = line.str(2);
+      std::string proc_pattern = line.str(3);
       for (unsigned p = 1; p < words[r].size(); ++p) {
         bool matches_bin = false;
         bool matches_proc = false;
-        int process_id;
-        std::string process;
-        std::string bin = words[r-3][p];
-        // Not great that we repeat this below
-        try {
-          process_id = boost::lexical_cast<int>(words[r-2][p]);
-          process = words[r-1][p];
-        } catch(boost::bad_lexical_cast &) {
-          process_id = boost::lexical_cast<int>(words[r-1][p]);
-          process = words[r-2][p];
-        }
+        std::string const& bin = col_bin[p];
+        std::string const& process = col_proc[p];
         // if (words[i][2] == "*" || words[i][2] == bin) {
-        if (words[i][2] == "*" || fnmatch(words[i][2].c_str(), bin.c_str(), 0) == 0) {
+        if (bin_pattern == "*" || fnmatch(bin_pattern.c_str(), bin.c_str(), 0) == 0) {
           matches_bin = true;
         }
         // if (words[i][3] == "*" || words[i][3] == process) {
-        if (words[i][3] == "*" || fnmatch(words[i][3].c_str(), process.c_str(), 0) == 0) {
+        if (proc_pattern == "*" || fnmatch(proc_pattern.c_str(), process.c_str(), 0) == 0) {
           matches_proc = true;
         }
         if (!matches_bin || !matches_proc) continue;
         auto sys = std::make_shared<Systematic>();
         sys->set_bin(bin);
-        sys->set_signal(process_id <= 0);
+        sys->set_signal(col_signal[p]);
         sys->set_process(process);
         sys->set_name(param_name);
         sys->set_type("rateParam");
@@ -401,80 +500,71 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
       continue;
     }
 
-    if (start_nuisance_scan && words[i].size() >= 4 &&
-        boost::iequals(words[i][1], "group")) {
-      if (!groups.count(words[i][0])) {
-        groups[words[i][0]] = std::set<std::string>();
-      }
-      for (unsigned ig = 3; ig < words[i].size(); ++ig) {
-        groups[words[i][0]].insert(words[i][ig]);
+    if (line.size() >= 4 && line.keyword(1) == Keyword::group) {
+      std::set<std::string> & group = groups[line.str(0)];
+      for (unsigned ig = 3; ig < line.size(); ++ig) {
+        group.insert(line.str(ig));
       }
       continue;
     }
 
-    if (start_nuisance_scan && words[i].size() >= 3 &&
-        boost::iequals(words[i][1], "autoMCStats")) {
+    if (line.size() >= 3 && line.keyword(1) == Keyword::autoMCStats) {
       std::vector<std::string> for_bins;
-      if (words[i][0] == "*") {
+      if (line[0] == "*") {
         for_bins = Set2Vec(bin_names);
       } else {
-        for_bins.push_back(words[i][0]);
+        for_bins.push_back(line.str(0));
       }
       for (auto const& bin : for_bins) {
-        double thresh = boost::lexical_cast<double>(words[i][2]);
-        if (words[i].size() == 3) {
+        double thresh = ParseAs<double>(line[2]);
+        if (line.size() == 3) {
           auto_stats_settings_[bin] = AutoMCStatsSettings(thresh);
-        } else if (words[i].size() == 4) {
-          auto_stats_settings_[bin] = AutoMCStatsSettings(thresh, boost::lexical_cast<int>(words[i][3]));
+        } else if (line.size() == 4) {
+          auto_stats_settings_[bin] = AutoMCStatsSettings(thresh, ParseAs<int>(line[3]));
         } else {
-          auto_stats_settings_[bin] = AutoMCStatsSettings(thresh, boost::lexical_cast<int>(words[i][3]), boost::lexical_cast<int>(words[i][4]));
+          auto_stats_settings_[bin] = AutoMCStatsSettings(thresh, ParseAs<int>(line[3]), ParseAs<int>(line[4]));
         }
       }
     }
 
-    if (start_nuisance_scan && words[i].size()-1 == words[r].size()) {
-      for (unsigned p = 2; p < words[i].size(); ++p) {
-        if (words[i][p] == "-") continue;
-        auto sys = std::make_shared<Systematic>();
-        sys->set_bin(words[r-3][p-1]);
-        try {
-          int process_id = boost::lexical_cast<int>(words[r-2][p-1]);
-          sys->set_signal(process_id <= 0);
-          sys->set_process(words[r-1][p-1]);
-        } catch(boost::bad_lexical_cast &) {
-          int process_id = boost::lexical_cast<int>(words[r-1][p-1]);
-          sys->set_signal(process_id <= 0);
-          sys->set_process(words[r-2][p-1]);
-        }
-        sys->set_name(words[i][0]);
-        std::string type = words[i][1];
-        if (!contains(std::vector<std::string>{"shape", "shape?", "shapeN2", "shapeU", "lnN", "lnU"},
-                      type)) {
-          throw std::runtime_error(
-              FNERROR("Systematic type " + type + " not supported"));
+    if (line.size()-1 == words[r].size()) {
+      std::string name = line.str(0);
+      std::string type = line.str(1);
+      bool type_checked = false;
+      for (unsigned p = 2; p < line.size(); ++p) {
+        if (line[p] == "-") continue;
+        if (!type_checked) {
+          if (!contains(syst_types, type)) {
+            throw std::runtime_error(
+                FNERROR("Systematic type " + type + " not supported"));
+          }
+          type_checked = true;
         }
-        sys->set_type(words[i][1]);
+        auto sys = std::make_shared<Systematic>();
+        sys->set_bin(col_bin[p-1]);
+        sys->set_signal(col_signal[p-1]);
+        sys->set_process(col_proc[p-1]);
+        sys->set_name(name);
+        sys->set_type(type);
         sys->set_analysis(analysis);
         sys->set_era(era);
         sys->set_channel(channel);
         sys->set_bin_id(bin_id);
         sys->set_mass(mass);
         sys->set_scale(1.0);
-        std::size_t slash_pos = words[i][p].find("/");
-        if (slash_pos != words[i][p].npos) {
+        std::size_t slash_pos = line[p].find('/');
+        if (slash_pos != line[p].npos) {
           // Assume asymmetric of form kDown/kUp
-          sys->set_value_d(
-            boost::lexical_cast<double>(words[i][p].substr(0, slash_pos)));
-          sys->set_value_u(
-            boost::lexical_cast<double>(words[i][p].substr(slash_pos+1)));
+          sys->set_value_d(ParseAs<double>(line[p].substr(0, slash_pos)));
+          sys->set_value_u(ParseAs<double>(line[p].substr(slash_pos+1)));
           sys->set_asymm(true);
         } else {
-          sys->set_value_u(boost::lexical_cast<double>(words[i][p]));
+          sys->set_value_u(ParseAs<double>(line[p]));
           sys->set_asymm(false);
         }
         if (sys->type() == "shape" || sys->type() == "shapeN2" ||
             sys->type() == "shapeU") {
-          sys->set_scale(boost::lexical_cast<double>(words[i][p]));
+          sys->set_scale(ParseAs<double>(line[p]));
           LoadShapes(sys.get(), hist_mapping);
         } else if (sys->type() == "shape?") {
           // This might fail, so we have to "try"
@@ -490,7 +580,7 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
             sys->set_type("lnN");
           } else {
             sys->set_type("shape");
-            sys->set_scale(boost::lexical_cast<double>(words[i][p]));
+            sys->set_scale(ParseAs<double>(line[p]));
           }
         }
         if (sys->type() == "shape" || sys->type() == "shapeN2" ||
@@ -527,6 +617,10 @@ int CombineHarvester::ParseDatacard(std::string const& filename,
 
 void CombineHarvester::WriteDatacard(std::string const& name,
                                      std::string const& root_file) {
+  if (GetFlag("incremental-write")) {
+    WriteDatacardsIncremental(root_file, {{name, this}});
+    return;
+  }
   TFile file(root_file.c_str(), "RECREATE");
   CombineHarvester::WriteDatacard(name, file);
   file.Close();
@@ -713,6 +807,33 @@ void CombineHarvester::FillHistMappings(std::vector<HistMapping> & mappings) {
 
 void CombineHarvester::WriteDatacard(std::string const& name,
                                      TFile& root_file) {
+  std::unique_ptr<std::ostream> txt_file_ptr = nullptr;
+
+  // Figure out if the datacard name ends with ".gz"
+  std::string zip_ext = ".gz";
+  bool has_zip_ext = (name.length() >= zip_ext.length() && name.compare(name.length() - zip_ext.length(), zip_ext.length(), zip_ext) == 0);
+
+  if (has_zip_ext) {
+    txt_file_ptr = std::make_unique<zstr::ofstream>(name);
+  } else {
+    txt_file_ptr = std::make_unique<std::ofstream>(name);
+  }
+  if (txt_file_ptr->fail()) {
+    throw std::runtime_error(FNERROR("Unable to create file: " + name));
+  }
+
+  // The templates and workspaces are collected and written together at the
+  // end
+  TFileBatchWriter writer(&root_file);
+  FormatDatacard(name, root_file.IsOpen() ? root_file.GetName() : "",
+                 *txt_file_ptr, writer);
+  writer.Write();
+}
+
+void CombineHarvester::FormatDatacard(std::string const& name,
+                                      std::string const& root_file,
+                                      std::ostream & txt_file,
+                                      TFileBatchWriter & hist_writer) {
   using boost::format;
 
   // First figure out if this is a counting-experiment only
@@ -732,28 +853,11 @@ void CombineHarvester::WriteDatacard(std::string const& name,
   }
 
   // Allow a non-open ROOT file if this is purely a counting experiment
-  if (!root_file.IsOpen() && !is_counting) {
-    throw std::runtime_error(FNERROR(
-        std::string("Output ROOT file is not open: ") + root_file.GetName()));
+  if (root_file.empty() && !is_counting) {
+    throw std::runtime_error(
+        FNERROR("No open output ROOT file for datacard: " + name));
   }
 
-  std::unique_ptr<std::ostream> txt_file_ptr = nullptr;
-
-  // Figure out if the datacard name ends with ".gz"
-  std::string zip_ext = ".gz";
-  bool has_zip_ext = (name.length() >= zip_ext.length() && name.compare(name.length() - zip_ext.length(), zip_ext.length(), zip_ext) == 0);
-
-  if (has_zip_ext) {
-    txt_file_ptr = std::make_unique<zstr::ofstream>(name);
-  } else {
-    txt_file_ptr = std::make_unique<std::ofstream>(name);
-  }
-  if (txt_file_ptr->fail()) {
-    throw std::runtime_error(FNERROR("Unable to create file: " + name));
-  }
-
-  std::ostream & txt_file = *txt_file_ptr;
-
   //txt_file << "# Datacard produced by CombineHarvester with git status: "
   //         << ch::GitVersion() << "\n";
 
@@ -838,7 +942,7 @@ void CombineHarvester::WriteDatacard(std::string const& name,
   }
 
   // The ROOT file mapping should be given as a relative path
-  std::string file_name = root_file.GetName();
+  std::string file_name = root_file;
   // Get the full path to the output root file
   // NOTE: was using canonical here instead of absolute, but not
   // supported in boost 1.47
@@ -882,10 +986,15 @@ void CombineHarvester::WriteDatacard(std::string const& name,
       if (ws_it.first == "_rateParams") continue; // don't write this one
       // Also skip any workspace that isn't needed for this card
       if (!used_wsps.count(ws_it.second->GetName())) continue;
-      ch::WriteToTFile(ws_it.second.get(), &root_file, ws_it.second->GetName());
+      hist_writer.Add(ws_it.second->GetName(), ws_it.second);
     }
   }
 
+  hist_writer.SetCompression(shape_write_compression_)
+      .SetBufferSize(shape_write_buffer_size_);
+  // The index of the mapping to use for each (bin, process)
+  std::map<std::pair<std::string, std::string>, int> mapping_cache;
+
   // Writing observations
   if (obs_.size() > 0) {
     txt_file << "bin          ";
@@ -896,8 +1005,8 @@ void CombineHarvester::WriteDatacard(std::string const& name,
         TH1::AddDirectory(false);
         std::unique_ptr<TH1> h((TH1*)(obs->shape()->Clone()));
         h->Scale(obs->rate());
-        WriteHistToFile(h.get(), &root_file, mappings, obs->bin(), "data_obs",
-                        obs->mass(), "", 0);
+        WriteHistToFile(std::move(h), hist_writer, mappings, mapping_cache,
+                        obs->bin(), "data_obs", obs->mass(), "", 0);
         TH1::AddDirectory(add_dir);
       }
     }
@@ -941,9 +1050,9 @@ void CombineHarvester::WriteDatacard(std::string const& name,
     if (proc->shape()) {
       bool add_dir = TH1::AddDirectoryStatus();
       TH1::AddDirectory(false);
-      std::unique_ptr<TH1> h = proc->ClonedScaledShape();
-      WriteHistToFile(h.get(), &root_file, mappings, proc->bin(),
-                      proc->process(), proc->mass(), "", 0);
+      WriteHistToFile(proc->ClonedScaledShape(), hist_writer, mappings,
+                      mapping_cache, proc->bin(), proc->process(),
+                      proc->mass(), "", 0);
       TH1::AddDirectory(add_dir);
     }
     txt_file << format("%-"+getProcLen(proc)+"s ") % proc->bin();
@@ -1044,17 +1153,19 @@ void CombineHarvester::WriteDatacard(std::string const& name,
           if (tp == "shapeN2") seen_shapeN2 = true;
           if (tp == "shapeU") seen_shapeU = true;
           line[p + 2] = (format("%g") % ptr->scale()).str();
-          if (ptr->shape_u() && ptr->shape_d()) {
+          if (ptr->has_shapes()) {
             bool add_dir = TH1::AddDirectoryStatus();
             TH1::AddDirectory(false);
             std::unique_ptr<TH1> h_d = ptr->ClonedShapeD();
             h_d->Scale(procs_[p]->rate() * ptr->value_d());
-            WriteHistToFile(h_d.get(), &root_file, mappings, ptr->bin(),
-                            ptr->process(), ptr->mass(), ptr->name(), 1);
+            WriteHistToFile(std::move(h_d), hist_writer, mappings,
+                            mapping_cache, ptr->bin(), ptr->process(),
+                            ptr->mass(), ptr->name(), 1);
             std::unique_ptr<TH1> h_u = ptr->ClonedShapeU();
             h_u->Scale(procs_[p]->rate() * ptr->value_u());
-            WriteHistToFile(h_u.get(), &root_file, mappings, ptr->bin(),
-                            ptr->process(), ptr->mass(), ptr->name(), 2);
+            WriteHistToFile(std::move(h_u), hist_writer, mappings,
+                            mapping_cache, ptr->bin(), ptr->process(),
+                            ptr->mass(), ptr->name(), 2);
             TH1::AddDirectory(add_dir);
             break;
           } else if ( (ptr->data_u() && ptr->data_d()) || (ptr->pdf_u() && ptr->pdf_d()) ) {
@@ -1292,30 +1403,41 @@ void CombineHarvester::WriteDatacard(std::string const& name,
 }
 
 void CombineHarvester::WriteHistToFile(
-    TH1 * hist,
-    TFile * file,
+    std::unique_ptr<TH1> hist,
+    TFileBatchWriter & writer,
     std::vector<HistMapping> const& mappings,
+    std::map<std::pair<std::string, std::string>, int> & mapping_cache,
     std::string const& bin,
     std::string const& process,
     std::string const& mass,
     std::string const& nuisance,
     unsigned type) {
-  StrPairVec attempts = this->GenerateShapeMapAttempts(process, bin);
-  for (unsigned a = 0; a < attempts.size(); ++a) {
-    for (unsigned m = 0; m < mappings.size(); ++m) {
-      if ((attempts[a].first == mappings[m].process) &&
-        (attempts[a].second == mappings[m].category)) {
-        std::string p = (type == 0 ?
-            mappings[m].pattern : mappings[m].syst_pattern);
-        boost::replace_all(p, "$CHANNEL", bin);
-        boost::replace_all(p, "$PROCESS", process);
-        boost::replace_all(p, "$MASS", mass);
-        if (type == 1) boost::replace_all(p, "$SYSTEMATIC", nuisance+"Down");
-        if (type == 2) boost::replace_all(p, "$SYSTEMATIC", nuisance+"Up");
-        WriteToTFile(hist, file, p);
-        return;
+  // The matching mapping only depends on the bin and process, so only look
+  // for it the first time
+  auto key = std::make_pair(bin, process);
+  auto cache_it = mapping_cache.find(key);
+  if (cache_it == mapping_cache.end()) {
+    int match = -1;
+    StrPairVec attempts = this->GenerateShapeMapAttempts(process, bin);
+    for (unsigned a = 0; a < attempts.size() && match < 0; ++a) {
+      for (unsigned m = 0; m < mappings.size(); ++m) {
+        if ((attempts[a].first == mappings[m].process) &&
+          (attempts[a].second == mappings[m].category)) {
+          match = m;
+          break;
+        }
       }
     }
+    cache_it = mapping_cache.emplace(key, match).first;
   }
+  if (cache_it->second < 0) return;
+  HistMapping const& mapping = mappings[cache_it->second];
+  std::string p = (type == 0 ? mapping.pattern : mapping.syst_pattern);
+  boost::replace_all(p, "$CHANNEL", bin);
+  boost::replace_all(p, "$PROCESS", process);
+  boost::replace_all(p, "$MASS", mass);
+  if (type == 1) boost::replace_all(p, "$SYSTEMATIC", nuisance+"Down");
+  if (type == 2) boost::replace_all(p, "$SYSTEMATIC", nuisance+"Up");
+  writer.Add(p, std::move(hist));
 }
 }
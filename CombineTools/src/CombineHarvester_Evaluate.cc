@@ -1,11 +1,14 @@
 #include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
 #include <vector>
 #include <map>
+#include <algorithm>
 #include <string>
 #include <iostream>
 #include <utility>
 #include <set>
 #include <fstream>
+#include <unordered_map>
+#include <random>
 #include "boost/lexical_cast.hpp"
 #include "boost/algorithm/string.hpp"
 #include "boost/range/algorithm_ext/erase.hpp"
@@ -14,6 +17,7 @@
 #include "TDirectory.h"
 #include "TH1.h"
 #include "TH2.h"
+#include "TDecompChol.h"
 #include "CombineHarvester/CombineTools/interface/Observation.h"
 #include "CombineHarvester/CombineTools/interface/Process.h"
 #include "CombineHarvester/CombineTools/interface/Systematic.h"
@@ -21,6 +25,8 @@
 #include "CombineHarvester/CombineTools/interface/MakeUnique.h"
 #include "CombineHarvester/CombineTools/interface/Utilities.h"
 #include "CombineHarvester/CombineTools/interface/Algorithm.h"
+#include "CombineHarvester/CombineTools/interface/EvaluationPlan.h"
+#include "CombineHarvester/CombineTools/interface/ThreadPool.h"
 
 // #include "TMath.h"
 // #include "boost/format.hpp"
@@ -31,16 +37,51 @@ namespace ch {
 
 CombineHarvester::ProcSystMap CombineHarvester::GenerateProcSystMap() {
   ProcSystMap lookup(procs_.size());
+  std::lock_guard<std::mutex> lock(proc_index_mutex_);
+  if (!ProcIndexIsCurrent()) {
+    proc_index_ = ch::make_unique<ProcIndex>();
+    proc_index_->generation = Object::Generation();
+  }
+  ExtendProcIndex();
   for (unsigned i = 0; i < systs_.size(); ++i) {
-    for (unsigned j = 0; j < procs_.size(); ++j) {
-      if (MatchingProcess(*(systs_[i]), *(procs_[j]))) {
-        lookup[j].push_back(systs_[i].get());
+    auto range =
+        proc_index_->positions.equal_range(MatchingProcessHash(*(systs_[i])));
+    for (auto it = range.first; it != range.second; ++it) {
+      if (MatchingProcess(*(systs_[i]), *(procs_[it->second]))) {
+        lookup[it->second].push_back(systs_[i].get());
       }
     }
   }
   return lookup;
 }
 
+bool CombineHarvester::ProcIndexIsCurrent() const {
+  if (!proc_index_ || proc_index_->generation != Object::Generation() ||
+      proc_index_->procs.size() > procs_.size()) {
+    return false;
+  }
+  return std::equal(proc_index_->procs.begin(), proc_index_->procs.end(),
+                    procs_.begin());
+}
+
+void CombineHarvester::ExtendProcIndex() {
+  // Only the objects appended since the index was last current can have
+  // been modified, so it's safe to mark it current again
+  unsigned first = proc_index_->procs.size();
+  if (first > procs_.size()) {
+    // Entries were removed, so the index will have to be rebuilt anyway
+    proc_index_.reset();
+    return;
+  }
+  proc_index_->procs.insert(proc_index_->procs.end(), procs_.begin() + first,
+                            procs_.end());
+  proc_index_->positions.reserve(procs_.size());
+  for (unsigned j = first; j < procs_.size(); ++j) {
+    proc_index_->positions.emplace(MatchingProcessHash(*(procs_[j])), j);
+  }
+  proc_index_->generation = Object::Generation();
+}
+
 double CombineHarvester::GetUncertainty() {
   auto lookup = GenerateProcSystMap();
   double err_sq = 0.0;
@@ -64,6 +105,22 @@ double CombineHarvester::GetUncertainty(RooFitResult const* fit,
 
 double CombineHarvester::GetUncertainty(RooFitResult const& fit,
                                         unsigned n_samples) {
+  if (EvaluationPlan::CanCompile(*this, true)) {
+    EvaluationPlan plan(*this, true);
+    double rate = plan.EvaluateRate(plan.CurrentValues(*this).data());
+    double err_sq = 0.0;
+    SampleFromFit(plan, fit, n_samples, 1, 1,
+        [&](double const* vals, double * out) {
+          out[0] = plan.EvaluateRate(vals);
+        },
+        [&](double const* rates, unsigned n_rows, unsigned, unsigned) {
+          for (unsigned r = 0; r < n_rows; ++r) {
+            err_sq += (rates[r] - rate) * (rates[r] - rate);
+          }
+        });
+    return std::sqrt(err_sq/double(n_samples));
+  }
+
   auto lookup = GenerateProcSystMap();
   double rate = GetRateInternal(lookup);
   double err_sq = 0.0;
@@ -137,6 +194,34 @@ TH1F CombineHarvester::GetShapeWithUncertainty(RooFitResult const& fit,
   for (int i = 1; i <= shape.GetNbinsX(); ++i) {
     shape.SetBinError(i, 0.0);
   }
+
+  if (EvaluationPlan::CanCompile(*this)) {
+    EvaluationPlan plan(*this);
+    unsigned nb = plan.NumBins();
+    if (int(nb) == shape.GetNbinsX()) {
+      std::vector<double> nominal(nb);
+      std::vector<double> err_sq(nb, 0.);
+      plan.EvaluateShape(plan.CurrentValues(*this).data(), nominal.data());
+      SampleFromFit(plan, fit, n_samples, nb, nb,
+          [&](double const* vals, double * out) {
+            plan.EvaluateShape(vals, out);
+          },
+          [&](double const* shapes, unsigned n_rows, unsigned first,
+              unsigned last) {
+            for (unsigned r = 0; r < n_rows; ++r) {
+              for (unsigned b = first; b < last; ++b) {
+                double err = shapes[std::size_t(r) * nb + b] - nominal[b];
+                err_sq[b] += err * err;
+              }
+            }
+          });
+      for (unsigned b = 0; b < nb; ++b) {
+        shape.SetBinError(b + 1, std::sqrt(err_sq[b] / double(n_samples)));
+      }
+      return shape;
+    }
+  }
+
   // Create a backup copy of the current parameter values
   auto backup = GetParameters();
 
@@ -178,74 +263,121 @@ TH1F CombineHarvester::GetShapeWithUncertainty(RooFitResult const& fit,
 
 TH2F CombineHarvester::GetRateCovariance(RooFitResult const& fit,
                                          unsigned n_samples) {
-  auto lookup = GenerateProcSystMap();
-
   unsigned n = procs_.size();
-  TH1F nom("nominal", "nominal", n, 0, n);
   TH2F res("covariance", "covariance", n, 0, n, n, 0, n);
 
-  std::vector<CombineHarvester> ch_procs;
   std::vector<std::string> labels;
   unsigned nbins = this->bin_set().size();
 
+  // Each entry of the matrix is the summed rate of all processes sharing the
+  // bin and process name of procs_[i]
+  std::map<std::pair<std::string, std::string>, std::vector<unsigned>> groups;
   for (unsigned i = 0; i < procs_.size(); ++i) {
-    ch_procs.push_back(
-        this->cp().bin({procs_[i]->bin()}).process({procs_[i]->process()}));
+    groups[std::make_pair(procs_[i]->bin(), procs_[i]->process())]
+        .push_back(i);
     if (nbins > 1) {
       labels.push_back(procs_[i]->bin() + "," + procs_[i]->process());
     } else {
       labels.push_back(procs_[i]->process());
     }
   }
-  for (unsigned i = 0; i < procs_.size(); ++i) {
-    nom.SetBinContent(i + 1, ch_procs[i].GetRate());
-  }
-  auto backup = GetParameters();
 
-  // Calling randomizePars() ensures that the RooArgList of sampled parameters
-  // is already created within the RooFitResult
-  RooArgList const& rands = fit.randomizePars();
+  std::vector<double> nom(n, 0.);
+  std::vector<double> cov(n * n, 0.);
 
-  // Now create two aligned vectors of the RooRealVar parameters and the
-  // corresponding ch::Parameter pointers
-  int n_pars = rands.getSize();
-  std::vector<RooRealVar const*> r_vec(n_pars, nullptr);
-  std::vector<ch::Parameter*> p_vec(n_pars, nullptr);
-  for (unsigned n = 0; n < p_vec.size(); ++n) {
-    r_vec[n] = dynamic_cast<RooRealVar const*>(rands.at(n));
-    p_vec[n] = GetParameter(r_vec[n]->GetName());
-  }
+  if (EvaluationPlan::CanCompile(*this, true)) {
+    EvaluationPlan plan(*this, true);
+    std::vector<std::vector<unsigned> const*> members(n);
+    for (unsigned i = 0; i < n; ++i) {
+      members[i] =
+          &groups[std::make_pair(procs_[i]->bin(), procs_[i]->process())];
+    }
+    auto group_rates = [&](double const* proc_rates, double * out) {
+      for (unsigned i = 0; i < n; ++i) {
+        out[i] = 0.;
+        for (unsigned j : *(members[i])) out[i] += proc_rates[j];
+      }
+    };
+    std::vector<double> proc_rates(n);
+    plan.EvaluateProcessRates(plan.CurrentValues(*this).data(),
+                              proc_rates.data());
+    group_rates(proc_rates.data(), nom.data());
+    // Only the upper triangle is accumulated, and mirrored afterwards
+    SampleFromFit(plan, fit, n_samples, n, n,
+        [&](double const* vals, double * out) {
+          std::vector<double> sample_rates(n);
+          plan.EvaluateProcessRates(vals, sample_rates.data());
+          group_rates(sample_rates.data(), out);
+        },
+        [&](double const* rates, unsigned n_rows, unsigned first,
+            unsigned last) {
+          for (unsigned r = 0; r < n_rows; ++r) {
+            double const* row = rates + std::size_t(r) * n;
+            for (unsigned i = first; i < last; ++i) {
+              double d_i = row[i] - nom[i];
+              for (unsigned j = i; j < n; ++j) {
+                cov[i * n + j] += d_i * (row[j] - nom[j]);
+              }
+            }
+          }
+        });
+    for (unsigned i = 0; i < n; ++i) {
+      for (unsigned j = 0; j < i; ++j) cov[i * n + j] = cov[j * n + i];
+    }
+  } else {
+    std::vector<CombineHarvester> ch_procs;
+    for (unsigned i = 0; i < procs_.size(); ++i) {
+      ch_procs.push_back(
+          this->cp().bin({procs_[i]->bin()}).process({procs_[i]->process()}));
+    }
+    for (unsigned i = 0; i < n; ++i) {
+      nom[i] = ch_procs[i].GetRate();
+    }
+    std::vector<double> rates(n, 0.);
+    auto backup = GetParameters();
 
-  // Main loop through n_samples
-  for (unsigned rnd = 0; rnd < n_samples; ++rnd) {
-    // Randomise and update values
-    fit.randomizePars();
-    for (int n = 0; n < n_pars; ++n) {
-      if (p_vec[n]) p_vec[n]->set_val(r_vec[n]->getVal());
+    // Calling randomizePars() ensures that the RooArgList of sampled
+    // parameters is already created within the RooFitResult
+    RooArgList const& rands = fit.randomizePars();
+
+    // Now create two aligned vectors of the RooRealVar parameters and the
+    // corresponding ch::Parameter pointers
+    int n_pars = rands.getSize();
+    std::vector<RooRealVar const*> r_vec(n_pars, nullptr);
+    std::vector<ch::Parameter*> p_vec(n_pars, nullptr);
+    for (unsigned n = 0; n < p_vec.size(); ++n) {
+      r_vec[n] = dynamic_cast<RooRealVar const*>(rands.at(n));
+      p_vec[n] = GetParameter(r_vec[n]->GetName());
     }
 
-    for (int i = 1; i <= nom.GetNbinsX(); ++i) {
-      for (int j = 1; j <= nom.GetNbinsX(); ++j) {
-        int x = j;
-        int y = nom.GetNbinsX() - (i - 1);
-        res.GetXaxis()->SetBinLabel(x, labels[j - 1].c_str());
-        res.GetYaxis()->SetBinLabel(y, labels[i - 1].c_str());
-        res.SetBinContent(
-            x, y, res.GetBinContent(x, y) +
-                      (ch_procs[i - 1].GetRate() - nom.GetBinContent(i)) *
-                      (ch_procs[j - 1].GetRate() - nom.GetBinContent(j)));
+    // Main loop through n_samples
+    for (unsigned rnd = 0; rnd < n_samples; ++rnd) {
+      // Randomise and update values
+      fit.randomizePars();
+      for (int n = 0; n < n_pars; ++n) {
+        if (p_vec[n]) p_vec[n]->set_val(r_vec[n]->getVal());
+      }
+      for (unsigned i = 0; i < n; ++i) {
+        rates[i] = ch_procs[i].GetRate();
+      }
+      for (unsigned i = 0; i < n; ++i) {
+        for (unsigned j = 0; j < n; ++j) {
+          cov[i * n + j] += (rates[i] - nom[i]) * (rates[j] - nom[j]);
+        }
       }
     }
+    this->UpdateParameters(backup);
   }
 
-  for (int i = 1; i <= nom.GetNbinsX(); ++i) {
-    for (int j = 1; j <= nom.GetNbinsX(); ++j) {
-      int x = j;
-      int y = nom.GetNbinsX() - (i - 1);
-      res.SetBinContent(x, y, res.GetBinContent(x, y) / double(n_samples));
+  for (unsigned i = 0; i < n; ++i) {
+    for (unsigned j = 0; j < n; ++j) {
+      int x = j + 1;
+      int y = n - i;
+      res.GetXaxis()->SetBinLabel(x, labels[j].c_str());
+      res.GetYaxis()->SetBinLabel(y, labels[i].c_str());
+      res.SetBinContent(x, y, cov[i * n + j] / double(n_samples));
     }
   }
-  this->UpdateParameters(backup);
   return res;
 }
 
@@ -269,6 +401,178 @@ TH2F CombineHarvester::GetRateCorrelation(RooFitResult const& fit,
   return res;
 }
 
+std::vector<double> CombineHarvester::GetRates(
+    std::vector<std::string> const& names, std::vector<double> const& vals) {
+  EvaluationPlan plan(*this, true);
+  std::vector<double> plan_vals = PlanValues(plan, names, vals);
+  unsigned n_points = vals.size() / names.size();
+  std::vector<double> res(n_points);
+  plan.EvaluateRates(plan_vals.data(), n_points, res.data());
+  return res;
+}
+
+std::vector<double> CombineHarvester::GetShapes(
+    std::vector<std::string> const& names, std::vector<double> const& vals) {
+  EvaluationPlan plan(*this);
+  std::vector<double> plan_vals = PlanValues(plan, names, vals);
+  unsigned n_points = vals.size() / names.size();
+  std::vector<double> res(std::size_t(n_points) * plan.NumBins());
+  plan.EvaluateShapes(plan_vals.data(), n_points, res.data());
+  return res;
+}
+
+std::vector<double> CombineHarvester::PlanValues(
+    EvaluationPlan const& plan, std::vector<std::string> const& names,
+    std::vector<double> const& vals) const {
+  if (names.empty() || vals.size() % names.size() != 0) {
+    throw std::runtime_error(FNERROR(
+        "Number of values (" + std::to_string(vals.size()) +
+        ") is not a multiple of the number of parameters (" +
+        std::to_string(names.size()) + ")"));
+  }
+  // Map each column onto the corresponding plan parameter, or -1 if the plan
+  // does not depend on it
+  std::vector<int> columns(names.size());
+  for (unsigned c = 0; c < names.size(); ++c) {
+    if (!GetParameter(names[c])) {
+      throw std::runtime_error(FNERROR("Parameter " + names[c] +
+                                       " not found in CombineHarvester instance"));
+    }
+    columns[c] = plan.ParameterIndex(names[c]);
+  }
+  std::vector<double> current = plan.CurrentValues(*this);
+  unsigned n_points = vals.size() / names.size();
+  std::vector<double> res;
+  res.reserve(std::size_t(n_points) * current.size());
+  for (unsigned i = 0; i < n_points; ++i) {
+    std::size_t row = res.size();
+    res.insert(res.end(), current.begin(), current.end());
+    for (unsigned c = 0; c < names.size(); ++c) {
+      if (columns[c] >= 0) {
+        res[row + columns[c]] = vals[std::size_t(i) * names.size() + c];
+      }
+    }
+  }
+  return res;
+}
+
+void CombineHarvester::SetSamplingThreads(unsigned n_threads,
+                                          unsigned long seed) {
+  sampling_threads_ = n_threads;
+  sampling_seed_ = seed;
+}
+
+void CombineHarvester::SampleFromFit(
+    EvaluationPlan const& plan, RooFitResult const& fit, unsigned n_samples,
+    unsigned width, unsigned n_out,
+    std::function<void(double const*, double *)> evaluate,
+    std::function<void(double const*, unsigned, unsigned, unsigned)> reduce)
+    const {
+  std::vector<double> current = plan.CurrentValues(*this);
+  unsigned n_plan = current.size();
+  bool parallel = sampling_threads_ > 0;
+  ThreadPool pool(parallel ? sampling_threads_ : 1);
+
+  // Calling randomizePars() ensures that the RooArgList of sampled parameters
+  // is already created within the RooFitResult. It is not needed when the
+  // samples are drawn here instead.
+  RooArgList const& rands =
+      parallel ? fit.floatParsFinal() : fit.randomizePars();
+
+  // Align the sampled RooRealVars with the plan parameters. As in
+  // ch::Parameter::set_val, frozen parameters keep their current value.
+  std::vector<RooRealVar const*> r_vec;
+  std::vector<unsigned> pos_vec;
+  std::vector<unsigned> idx_vec;
+  for (int n = 0; n < rands.getSize(); ++n) {
+    RooRealVar const* var = dynamic_cast<RooRealVar const*>(rands.at(n));
+    int idx = plan.ParameterIndex(var->GetName());
+    if (idx < 0 || GetParameter(var->GetName())->frozen()) continue;
+    r_vec.push_back(var);
+    pos_vec.push_back(n);
+    idx_vec.push_back(idx);
+  }
+
+  // In parallel mode each sample is x = mu + L z, where L is the Cholesky
+  // factor of the fit covariance matrix and z a vector of unit gaussians,
+  // which is what randomizePars() does. Only the rows of L for the sampled
+  // plan parameters are kept.
+  unsigned n_z = 0;
+  std::vector<double> mu;
+  std::vector<double> chol;
+  if (parallel && !r_vec.empty()) {
+    TDecompChol decomp(fit.covarianceMatrix());
+    if (!decomp.Decompose()) {
+      throw std::runtime_error(
+          FNERROR("Cholesky decomposition of the covariance matrix failed"));
+    }
+    TMatrixD const& upper = decomp.GetU();
+    n_z = *std::max_element(pos_vec.begin(), pos_vec.end()) + 1;
+    for (unsigned k = 0; k < r_vec.size(); ++k) {
+      mu.push_back(r_vec[k]->getVal());
+      for (unsigned j = 0; j < n_z; ++j) {
+        chol.push_back(j <= pos_vec[k] ? upper(j, pos_vec[k]) : 0.);
+      }
+    }
+  }
+
+  // Each sample gets its own random number stream, seeded from its index, so
+  // that the values do not depend on how the samples are divided between
+  // threads
+  auto draw = [&](unsigned sample, double * row, std::vector<double> & z) {
+    std::seed_seq seq{unsigned(sampling_seed_ & 0xFFFFFFFF),
+                      unsigned(sampling_seed_ >> 32), sample};
+    std::mt19937_64 rng(seq);
+    std::normal_distribution<double> gaus;
+    for (unsigned j = 0; j < n_z; ++j) z[j] = gaus(rng);
+    for (unsigned k = 0; k < r_vec.size(); ++k) {
+      double const* l_row = chol.data() + std::size_t(k) * n_z;
+      double x = mu[k];
+      for (unsigned j = 0; j < n_z; ++j) x += l_row[j] * z[j];
+      row[idx_vec[k]] = x;
+    }
+  };
+
+  // The samples are processed in rounds: first every sample of the round is
+  // drawn and evaluated, then the outputs are reduced, with each thread
+  // taking a separate range of output elements. Every element is therefore
+  // accumulated in sample order, and the result is the same for any number
+  // of threads.
+  const unsigned round_size = 1024;
+  const unsigned task_size = 16;
+  std::vector<double> vals;
+  std::vector<double> out;
+  for (unsigned first = 0; first < n_samples; first += round_size) {
+    unsigned n_rows = std::min(round_size, n_samples - first);
+    vals.resize(std::size_t(n_rows) * n_plan);
+    out.resize(std::size_t(n_rows) * width);
+    for (unsigned r = 0; r < n_rows; ++r) {
+      double * row = vals.data() + std::size_t(r) * n_plan;
+      std::copy(current.begin(), current.end(), row);
+      if (parallel) continue;
+      fit.randomizePars();
+      for (unsigned k = 0; k < r_vec.size(); ++k) {
+        row[idx_vec[k]] = r_vec[k]->getVal();
+      }
+    }
+    unsigned n_tasks = (n_rows + task_size - 1) / task_size;
+    pool.ParallelFor(n_tasks, [&](unsigned task) {
+      std::vector<double> z(n_z);
+      unsigned end = std::min(n_rows, (task + 1) * task_size);
+      for (unsigned r = task * task_size; r < end; ++r) {
+        double * row = vals.data() + std::size_t(r) * n_plan;
+        if (parallel) draw(first + r, row, z);
+        evaluate(row, out.data() + std::size_t(r) * width);
+      }
+    });
+    unsigned n_chunks = std::min(n_out, pool.NumThreads() * 4);
+    pool.ParallelFor(n_chunks, [&](unsigned chunk) {
+      reduce(out.data(), n_rows, std::size_t(n_out) * chunk / n_chunks,
+             std::size_t(n_out) * (chunk + 1) / n_chunks);
+    });
+  }
+}
+
 double CombineHarvester::GetRate() {
   auto lookup = GenerateProcSystMap();
   return GetRateInternal(lookup);
@@ -620,16 +924,21 @@ void CombineHarvester::VariableRebin(std::vector<double> bins) {
       obs_[i]->set_shape(std::move(copy2), true);
     }
   }
+  // If more than one Process matches a Systematic, the last one is used
+  std::unordered_map<Systematic const*, unsigned> syst_proc;
+  auto lookup = GenerateProcSystMap();
+  for (unsigned j = 0; j < lookup.size(); ++j) {
+    for (auto sys : lookup[j]) syst_proc[sys] = j;
+  }
   for (unsigned i = 0; i < systs_.size(); ++i) {
     TH1 const* proc_hist = nullptr;
     double prev_rate = 0.;
-    for (unsigned j = 0; j < procs_.size(); ++j) {
-      if (MatchingProcess(*(procs_[j]), *(systs_[i].get()))) {
-        proc_hist = scaled_procs[j].get();
-        prev_rate = prev_proc_rates[j];
-      }
+    auto match = syst_proc.find(systs_[i].get());
+    if (match != syst_proc.end()) {
+      proc_hist = scaled_procs[match->second].get();
+      prev_rate = prev_proc_rates[match->second];
     }
-    if (systs_[i]->shape_u() && systs_[i]->shape_d()) {
+    if (systs_[i]->has_shapes()) {
       // These hists will be normalised to unity
       std::unique_ptr<TH1> copy_u(systs_[i]->ClonedShapeU());
       std::unique_ptr<TH1> copy_d(systs_[i]->ClonedShapeD());
@@ -691,16 +1000,21 @@ void CombineHarvester::ZeroBins(double min, double max) {
       obs_[i]->set_shape(std::move(copy), true);
     }
   }
+  // If more than one Process matches a Systematic, the last one is used
+  std::unordered_map<Systematic const*, unsigned> syst_proc;
+  auto lookup = GenerateProcSystMap();
+  for (unsigned j = 0; j < lookup.size(); ++j) {
+    for (auto sys : lookup[j]) syst_proc[sys] = j;
+  }
   for (unsigned i = 0; i < systs_.size(); ++i) {
     TH1 const* proc_hist = nullptr;
     double prev_rate = 0.;
-    for (unsigned j = 0; j < procs_.size(); ++j) {
-      if (MatchingProcess(*(procs_[j]), *(systs_[i].get()))) {
-        proc_hist = scaled_procs[j].get();
-        prev_rate = prev_proc_rates[j];
-      }
+    auto match = syst_proc.find(systs_[i].get());
+    if (match != syst_proc.end()) {
+      proc_hist = scaled_procs[match->second].get();
+      prev_rate = prev_proc_rates[match->second];
     }
-    if (systs_[i]->shape_u() && systs_[i]->shape_d()) {
+    if (systs_[i]->has_shapes()) {
       // These hists will be normalised to unity
       std::unique_ptr<TH1> copy_u(systs_[i]->ClonedShapeU());
       std::unique_ptr<TH1> copy_d(systs_[i]->ClonedShapeD());
@@ -7,6 +7,7 @@
 #include "CombineHarvester/CombineTools/interface/Process.h"
 #include "CombineHarvester/CombineTools/interface/Systematic.h"
 #include "CombineHarvester/CombineTools/interface/Algorithm.h"
+#include "CombineHarvester/CombineTools/interface/FilterQuery.h"
 
 namespace ch {
 
@@ -187,6 +188,10 @@ CombineHarvester & CombineHarvester::data() {
   return *this;
 }
 
+FilterQuery CombineHarvester::query() {
+  return FilterQuery(*this);
+}
+
 std::set<std::string> CombineHarvester::bin_set() {
   std::set<std::string> result =
       this->SetFromObs(std::mem_fn(&ch::Observation::bin));
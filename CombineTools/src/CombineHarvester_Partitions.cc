@@ -0,0 +1,140 @@
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include <algorithm>
+#include <memory>
+#include <numeric>
+#include <string>
+#include <vector>
+#include "boost/regex.hpp"
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
+#include "CombineHarvester/CombineTools/interface/ThreadPool.h"
+
+namespace ch {
+
+std::shared_ptr<CombineHarvester::BinPartitions>
+CombineHarvester::BuildBinPartitions() const {
+  auto parts = std::make_shared<BinPartitions>();
+  parts->generation = Object::Generation();
+  parts->n_obs = obs_.size();
+  parts->n_procs = procs_.size();
+  parts->n_systs = systs_.size();
+
+  // Group the entries in a single pass, numbering the bins in order of
+  // appearance
+  std::vector<std::string> bins;
+  std::unordered_map<std::string, unsigned> index;
+  std::vector<std::vector<unsigned>> obs, procs, systs;
+  auto position = [&](std::string const& bin) {
+    auto it = index.find(bin);
+    if (it != index.end()) return it->second;
+    index.emplace(bin, unsigned(bins.size()));
+    bins.push_back(bin);
+    obs.emplace_back();
+    procs.emplace_back();
+    systs.emplace_back();
+    return unsigned(bins.size() - 1);
+  };
+  for (unsigned i = 0; i < obs_.size(); ++i) {
+    obs[position(obs_[i]->bin())].push_back(i);
+  }
+  for (unsigned i = 0; i < procs_.size(); ++i) {
+    procs[position(procs_[i]->bin())].push_back(i);
+  }
+  for (unsigned i = 0; i < systs_.size(); ++i) {
+    systs[position(systs_[i]->bin())].push_back(i);
+  }
+
+  // Then order them as in bin_set()
+  std::vector<unsigned> order(bins.size());
+  std::iota(order.begin(), order.end(), 0);
+  std::sort(order.begin(), order.end(), [&](unsigned a, unsigned b) {
+    return bins[a] < bins[b];
+  });
+  for (unsigned j : order) {
+    parts->index.emplace(bins[j], unsigned(parts->bins.size()));
+    parts->bins.push_back(std::move(bins[j]));
+    parts->obs.push_back(std::move(obs[j]));
+    parts->procs.push_back(std::move(procs[j]));
+    parts->systs.push_back(std::move(systs[j]));
+  }
+  return parts;
+}
+
+std::shared_ptr<CombineHarvester::BinPartitions const>
+CombineHarvester::GetBinPartitions() {
+  if (!GetFlag("partition-by-bin")) return BuildBinPartitions();
+  if (!bin_partitions_ ||
+      bin_partitions_->generation != Object::Generation() ||
+      bin_partitions_->n_obs != obs_.size() ||
+      bin_partitions_->n_procs != procs_.size() ||
+      bin_partitions_->n_systs != systs_.size()) {
+    bin_partitions_ = BuildBinPartitions();
+  }
+  return bin_partitions_;
+}
+
+std::vector<std::string> CombineHarvester::partition_bins() {
+  return GetBinPartitions()->bins;
+}
+
+CombineHarvesterView CombineHarvester::partition(std::string const& bin) {
+  // As for the bin() filter, with the filters-use-regex flag set the entries
+  // of every bin matching the regular expression are included
+  bool use_rgx = GetFlag("filters-use-regex");
+  boost::regex rgx;
+  if (use_rgx) rgx = boost::regex(bin);
+  auto matches = [&](std::string const& b) {
+    return use_rgx ? boost::regex_match(b, rgx) : b == bin;
+  };
+  if (!GetFlag("partition-by-bin")) {
+    // A single scan is cheaper than grouping every bin
+    std::vector<unsigned> obs, procs, systs;
+    for (unsigned i = 0; i < obs_.size(); ++i) {
+      if (matches(obs_[i]->bin())) obs.push_back(i);
+    }
+    for (unsigned i = 0; i < procs_.size(); ++i) {
+      if (matches(procs_[i]->bin())) procs.push_back(i);
+    }
+    for (unsigned i = 0; i < systs_.size(); ++i) {
+      if (matches(systs_[i]->bin())) systs.push_back(i);
+    }
+    return CombineHarvesterView(*this, std::move(obs), std::move(procs),
+                                std::move(systs));
+  }
+  auto parts = GetBinPartitions();
+  if (!use_rgx) {
+    auto it = parts->index.find(bin);
+    if (it == parts->index.end()) {
+      return CombineHarvesterView(*this, {}, {}, {});
+    }
+    return CombineHarvesterView(*this, parts->obs[it->second],
+                                parts->procs[it->second],
+                                parts->systs[it->second]);
+  }
+  // Merge the matching bins, keeping the entries in their original order
+  std::vector<unsigned> obs, procs, systs;
+  for (unsigned j = 0; j < parts->bins.size(); ++j) {
+    if (!matches(parts->bins[j])) continue;
+    obs.insert(obs.end(), parts->obs[j].begin(), parts->obs[j].end());
+    procs.insert(procs.end(), parts->procs[j].begin(), parts->procs[j].end());
+    systs.insert(systs.end(), parts->systs[j].begin(), parts->systs[j].end());
+  }
+  std::sort(obs.begin(), obs.end());
+  std::sort(procs.begin(), procs.end());
+  std::sort(systs.begin(), systs.end());
+  return CombineHarvesterView(*this, std::move(obs), std::move(procs),
+                              std::move(systs));
+}
+
+void CombineHarvester::ForEachPartition(
+    std::function<void(std::string const&, CombineHarvesterView &)> const&
+        func,
+    unsigned n_threads) {
+  auto parts = GetBinPartitions();
+  ThreadPool pool(n_threads);
+  pool.ParallelFor(parts->bins.size(), [&](unsigned j) {
+    CombineHarvesterView view(*this, parts->obs[j], parts->procs[j],
+                              parts->systs[j]);
+    func(parts->bins[j], view);
+  });
+}
+}
@@ -1,5 +1,7 @@
 #include "CombineHarvester/CombineTools/interface/CombineHarvester_Python.h"
 #include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/FilterQuery.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
 #include "CombineHarvester/CombineTools/interface/Observation.h"
 #include "CombineHarvester/CombineTools/interface/Parameter.h"
 #include "CombineHarvester/CombineTools/interface/CardWriter.h"
@@ -7,6 +9,8 @@
 #include "CombineHarvester/CombineTools/interface/AutoRebin.h"
 #include "CombineHarvester/CombineTools/interface/CopyTools.h"
 #include "CombineHarvester/CombineTools/interface/Utilities.h"
+#include "CombineHarvester/CombineTools/interface/Logging.h"
+#include "CombineHarvester/CombineTools/interface/TFileCache.h"
 #include "CombineHarvester/CombineTools/interface/ValidationTools.h"
 #include "CombineHarvester/CombineTools/interface/ParseCombineWorkspace.h"
 #include "boost/python.hpp"
@@ -25,6 +29,8 @@ using ch::CardWriter;
 using ch::BinByBinFactory;
 using ch::AutoRebin;
 using ch::Parameter;
+using ch::FilterQuery;
+using ch::CombineHarvesterView;
 
 void FilterAllPy(ch::CombineHarvester & cb, boost::python::object func) {
       auto lambda = [func](ch::Object *obj) -> bool {
@@ -82,6 +88,55 @@ void ForEachObjPy(ch::CombineHarvester & cb, boost::python::object func) {
   cb.ForEachObj(lambda);
 }
 
+void QueryForEachObsPy(ch::FilterQuery const& query,
+                       boost::python::object func) {
+  query.ForEachObs([func](ch::Observation *obs) { func(boost::ref(*obs)); });
+}
+
+void QueryForEachProcPy(ch::FilterQuery const& query,
+                        boost::python::object func) {
+  query.ForEachProc([func](ch::Process *proc) { func(boost::ref(*proc)); });
+}
+
+void QueryForEachSystPy(ch::FilterQuery const& query,
+                        boost::python::object func) {
+  query.ForEachSyst([func](ch::Systematic *sys) { func(boost::ref(*sys)); });
+}
+
+void QueryForEachObjPy(ch::FilterQuery const& query,
+                       boost::python::object func) {
+  query.ForEachObj([func](ch::Object *obj) { func(boost::ref(*obj)); });
+}
+
+void ViewForEachObsPy(ch::CombineHarvesterView const& view,
+                      boost::python::object func) {
+  view.ForEachObs([func](ch::Observation *obs) { func(boost::ref(*obs)); });
+}
+
+void ViewForEachProcPy(ch::CombineHarvesterView const& view,
+                       boost::python::object func) {
+  view.ForEachProc([func](ch::Process *proc) { func(boost::ref(*proc)); });
+}
+
+void ViewForEachSystPy(ch::CombineHarvesterView const& view,
+                       boost::python::object func) {
+  view.ForEachSyst([func](ch::Systematic *sys) { func(boost::ref(*sys)); });
+}
+
+void ViewForEachObjPy(ch::CombineHarvesterView const& view,
+                      boost::python::object func) {
+  view.ForEachObj([func](ch::Object *obj) { func(boost::ref(*obj)); });
+}
+
+// The python callable is always run serially, as it needs the GIL
+void ForEachPartitionPy(ch::CombineHarvester & cb,
+                        boost::python::object func) {
+  cb.ForEachPartition(
+      [func](std::string const& bin, ch::CombineHarvesterView & view) {
+        func(bin, boost::ref(view));
+      });
+}
+
 void CloneObsPy(ch::CombineHarvester& src, ch::CombineHarvester& dest,
                 boost::python::object func) {
   auto lambda = [func](ch::Observation *obs) {
@@ -160,6 +215,67 @@ TH1F (CombineHarvester::*Overload1_GetShapeWithUncertainty)(
 TH1F (CombineHarvester::*Overload2_GetShapeWithUncertainty)(
     RooFitResult const&, unsigned) = &CombineHarvester::GetShapeWithUncertainty;
 
+double (CombineHarvesterView::*Overload1_ViewGetUncertainty)(
+    void) const = &CombineHarvesterView::GetUncertainty;
+
+double (CombineHarvesterView::*Overload2_ViewGetUncertainty)(
+    RooFitResult const&, unsigned) const = &CombineHarvesterView::GetUncertainty;
+
+TH1F (CombineHarvesterView::*Overload1_ViewGetShapeWithUncertainty)(
+    void) const = &CombineHarvesterView::GetShapeWithUncertainty;
+
+TH1F (CombineHarvesterView::*Overload2_ViewGetShapeWithUncertainty)(
+    RooFitResult const&, unsigned) const =
+    &CombineHarvesterView::GetShapeWithUncertainty;
+
+// Copy a python object supporting the buffer protocol, e.g. a C-contiguous
+// numpy array of float64, into a vector of doubles
+std::vector<double> BufferToVector(py::object const& obj) {
+  Py_buffer view;
+  if (PyObject_GetBuffer(obj.ptr(), &view,
+                         PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0) {
+    py::throw_error_already_set();
+  }
+  std::string format = view.format ? view.format : "";
+  if (view.itemsize != sizeof(double) || format.empty() ||
+      format.back() != 'd') {
+    PyBuffer_Release(&view);
+    throw std::runtime_error(
+        FNERROR("Expected a contiguous buffer of float64 values"));
+  }
+  double const* begin = static_cast<double const*>(view.buf);
+  std::vector<double> res(begin, begin + view.len / sizeof(double));
+  PyBuffer_Release(&view);
+  return res;
+}
+
+// Return a vector of doubles as a bytearray, which the python wrapper turns
+// into a numpy array without copying it element by element
+py::object VectorToByteArray(std::vector<double> const& vec) {
+  return py::object(py::handle<>(PyByteArray_FromStringAndSize(
+      reinterpret_cast<char const*>(vec.data()), vec.size() * sizeof(double))));
+}
+
+py::object GetRatesPy(CombineHarvester & cb,
+                      std::vector<std::string> const& names,
+                      py::object const& vals) {
+  return VectorToByteArray(cb.GetRates(names, BufferToVector(vals)));
+}
+
+py::object GetShapesPy(CombineHarvester & cb,
+                       std::vector<std::string> const& names,
+                       py::object const& vals) {
+  return VectorToByteArray(cb.GetShapes(names, BufferToVector(vals)));
+}
+
+void ClearTFileCachePy() {
+  ch::TFileCache::Instance().Clear();
+}
+
+void SetTFileCacheMaxBytesPy(std::size_t max_bytes) {
+  ch::TFileCache::Instance().SetMaxBytes(max_bytes);
+}
+
 void (CombineHarvester::*Overload1_UpdateParameters)(
   RooFitResult const&) = &CombineHarvester::UpdateParameters;
 
@@ -212,6 +328,8 @@ BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(defaults_syst_name, syst_name, 1, 2)
 BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(defaults_syst_type, syst_type, 1, 2)
 BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(defaults_process_rgx, process_rgx, 1, 2)
 BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(defaults_SetAutoMCStats, SetAutoMCStats, 2, 4)
+BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(defaults_SetSamplingThreads, SetSamplingThreads, 1, 2)
+BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(defaults_SetShapeWriteSettings, SetShapeWriteSettings, 1, 2)
 
 BOOST_PYTHON_FUNCTION_OVERLOADS(defaults_MassesFromRange, ch::MassesFromRange, 1, 2)
 BOOST_PYTHON_FUNCTION_OVERLOADS(defaults_ValsFromRange, ch::ValsFromRange, 1, 2)
@@ -265,6 +383,8 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
       // Constructors, destructors and copying
       .def("cp", &CombineHarvester::cp)
       .def("deep", &CombineHarvester::deep)
+      .def("view", &CombineHarvester::view,
+          py::with_custodian_and_ward_postcall<0, 1>())
       .def("SetFlag", &CombineHarvester::SetFlag)
       .def("GetFlag", &CombineHarvester::GetFlag)
       // Logging and printing
@@ -286,6 +406,8 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
       .def("WriteDatacard", Overload1_WriteDatacard)
       .def("WriteDatacard", Overload2_WriteDatacard)
       .def("WriteDatacardWithFile", Overload3_WriteDatacard)
+      .def("SaveSnapshot", &CombineHarvester::SaveSnapshot)
+      .def("LoadSnapshot", &CombineHarvester::LoadSnapshot)
       // Filters
       .def("bin", &CombineHarvester::bin,
           defaults_bin()[py::return_internal_reference<>()])
@@ -325,6 +447,13 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
           py::return_internal_reference<>())
       .def("FilterSysts", FilterSystsPy,
           py::return_internal_reference<>())
+      .def("query", &CombineHarvester::query,
+          py::with_custodian_and_ward_postcall<0, 1>())
+      // Bin partitions
+      .def("partition_bins", &CombineHarvester::partition_bins)
+      .def("partition", &CombineHarvester::partition,
+          py::with_custodian_and_ward_postcall<0, 1>())
+      .def("ForEachPartition", ForEachPartitionPy)
       // Set producers
       .def("bin_set", &CombineHarvester::bin_set)
       .def("bin_id_set", &CombineHarvester::bin_id_set)
@@ -364,6 +493,13 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
       .def("GetShapeWithUncertainty", Overload2_GetShapeWithUncertainty)
       .def("GetRateCovariance", &CombineHarvester::GetRateCovariance)
       .def("GetRateCorrelation", &CombineHarvester::GetRateCorrelation)
+      .def("SetShapePrefetchThreads", &CombineHarvester::SetShapePrefetchThreads)
+      .def("SetShapeWriteSettings", &CombineHarvester::SetShapeWriteSettings,
+          defaults_SetShapeWriteSettings())
+      .def("SetSamplingThreads", &CombineHarvester::SetSamplingThreads,
+          defaults_SetSamplingThreads())
+      .def("__GetRates__", GetRatesPy)
+      .def("__GetShapes__", GetShapesPy)
       .def("GetObservedShape", &CombineHarvester::GetObservedShape)
       // Creation
       .def("__AddObservations__", &CombineHarvester::AddObservations)
@@ -473,6 +609,110 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
       .def("frozen", &Parameter::frozen)
     ;
 
+    py::class_<FilterQuery>("FilterQuery", py::no_init)
+      // Filters
+      .def("bin", &FilterQuery::bin,
+          defaults_bin()[py::return_internal_reference<>()])
+      .def("bin_id", &FilterQuery::bin_id,
+          defaults_bin_id()[py::return_internal_reference<>()])
+      .def("process", &FilterQuery::process,
+          defaults_process()[py::return_internal_reference<>()])
+      .def("analysis", &FilterQuery::analysis,
+          defaults_analysis()[py::return_internal_reference<>()])
+      .def("era", &FilterQuery::era,
+          defaults_era()[py::return_internal_reference<>()])
+      .def("channel", &FilterQuery::channel,
+          defaults_channel()[py::return_internal_reference<>()])
+      .def("mass", &FilterQuery::mass,
+          defaults_mass()[py::return_internal_reference<>()])
+      .def("syst_name", &FilterQuery::syst_name,
+          defaults_syst_name()[py::return_internal_reference<>()])
+      .def("syst_type", &FilterQuery::syst_type,
+          defaults_syst_type()[py::return_internal_reference<>()])
+      .def("process_rgx", &FilterQuery::process_rgx,
+          defaults_process_rgx()[py::return_internal_reference<>()])
+      .def("signals", &FilterQuery::signals,
+          py::return_internal_reference<>())
+      .def("backgrounds", &FilterQuery::backgrounds,
+          py::return_internal_reference<>())
+      .def("histograms", &FilterQuery::histograms,
+          py::return_internal_reference<>())
+      .def("pdfs", &FilterQuery::pdfs,
+          py::return_internal_reference<>())
+      .def("data", &FilterQuery::data,
+          py::return_internal_reference<>())
+      // Evaluation
+      .def("cp", &FilterQuery::cp)
+      .def("Apply", &FilterQuery::Apply,
+          py::return_internal_reference<>())
+      .def("ForEachObs", QueryForEachObsPy)
+      .def("ForEachProc", QueryForEachProcPy)
+      .def("ForEachSyst", QueryForEachSystPy)
+      .def("ForEachObj", QueryForEachObjPy)
+    ;
+
+    py::class_<CombineHarvesterView>("CombineHarvesterView", py::no_init)
+      .def("cp", &CombineHarvesterView::cp)
+      .def("NumObs", &CombineHarvesterView::NumObs)
+      .def("NumProcs", &CombineHarvesterView::NumProcs)
+      .def("NumSysts", &CombineHarvesterView::NumSysts)
+      // Filters
+      .def("bin", &CombineHarvesterView::bin,
+          defaults_bin()[py::return_internal_reference<>()])
+      .def("bin_id", &CombineHarvesterView::bin_id,
+          defaults_bin_id()[py::return_internal_reference<>()])
+      .def("process", &CombineHarvesterView::process,
+          defaults_process()[py::return_internal_reference<>()])
+      .def("analysis", &CombineHarvesterView::analysis,
+          defaults_analysis()[py::return_internal_reference<>()])
+      .def("era", &CombineHarvesterView::era,
+          defaults_era()[py::return_internal_reference<>()])
+      .def("channel", &CombineHarvesterView::channel,
+          defaults_channel()[py::return_internal_reference<>()])
+      .def("mass", &CombineHarvesterView::mass,
+          defaults_mass()[py::return_internal_reference<>()])
+      .def("syst_name", &CombineHarvesterView::syst_name,
+          defaults_syst_name()[py::return_internal_reference<>()])
+      .def("syst_type", &CombineHarvesterView::syst_type,
+          defaults_syst_type()[py::return_internal_reference<>()])
+      .def("process_rgx", &CombineHarvesterView::process_rgx,
+          defaults_process_rgx()[py::return_internal_reference<>()])
+      .def("signals", &CombineHarvesterView::signals,
+          py::return_internal_reference<>())
+      .def("backgrounds", &CombineHarvesterView::backgrounds,
+          py::return_internal_reference<>())
+      .def("histograms", &CombineHarvesterView::histograms,
+          py::return_internal_reference<>())
+      .def("pdfs", &CombineHarvesterView::pdfs,
+          py::return_internal_reference<>())
+      .def("data", &CombineHarvesterView::data,
+          py::return_internal_reference<>())
+      // Set producers
+      .def("bin_set", &CombineHarvesterView::bin_set)
+      .def("bin_id_set", &CombineHarvesterView::bin_id_set)
+      .def("process_set", &CombineHarvesterView::process_set)
+      .def("analysis_set", &CombineHarvesterView::analysis_set)
+      .def("era_set", &CombineHarvesterView::era_set)
+      .def("channel_set", &CombineHarvesterView::channel_set)
+      .def("mass_set", &CombineHarvesterView::mass_set)
+      .def("syst_name_set", &CombineHarvesterView::syst_name_set)
+      .def("syst_type_set", &CombineHarvesterView::syst_type_set)
+      // Iteration and evaluation
+      .def("ForEachObs", ViewForEachObsPy)
+      .def("ForEachProc", ViewForEachProcPy)
+      .def("ForEachSyst", ViewForEachSystPy)
+      .def("ForEachObj", ViewForEachObjPy)
+      .def("GetRate", &CombineHarvesterView::GetRate)
+      .def("GetObservedRate", &CombineHarvesterView::GetObservedRate)
+      .def("GetUncertainty", Overload1_ViewGetUncertainty)
+      .def("GetUncertainty", Overload2_ViewGetUncertainty)
+      .def("GetShape", &CombineHarvesterView::GetShape)
+      .def("GetObservedShape", &CombineHarvesterView::GetObservedShape)
+      .def("GetShapeWithUncertainty", Overload1_ViewGetShapeWithUncertainty)
+      .def("GetShapeWithUncertainty", Overload2_ViewGetShapeWithUncertainty)
+      .def("GetRateCovariance", &CombineHarvesterView::GetRateCovariance)
+    ;
+
     py::class_<CardWriter>("CardWriter", py::init<std::string, std::string>())
       .def("WriteCards", &CardWriter::WriteCards)
       .def("SetVerbosity", &CardWriter::SetVerbosity,
@@ -481,6 +721,10 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
            py::return_internal_reference<>())
       .def("SetWildcardMasses", &CardWriter::SetWildcardMasses,
            py::return_internal_reference<>())
+      .def("SetWorkers", &CardWriter::SetWorkers,
+           py::return_internal_reference<>())
+      .def("SetIncremental", &CardWriter::SetIncremental,
+           py::return_internal_reference<>())
     ;
 
     py::def("CloneObs", CloneObsPy);
@@ -488,6 +732,8 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
     py::def("CloneSysts", CloneSystsPy);
     py::def("CloneProcsAndSysts", CloneProcsAndSystsPy);
     py::def("SplitSyst", ch::SplitSyst);
+    py::def("ClearTFileCache", ClearTFileCachePy);
+    py::def("SetTFileCacheMaxBytes", SetTFileCacheMaxBytesPy);
 
     py::class_<BinByBinFactory>("BinByBinFactory")
       .def("MergeBinErrors", &BinByBinFactory::MergeBinErrors)
@@ -505,6 +751,10 @@ BOOST_PYTHON_MODULE(libCombineHarvesterCombineTools)
            py::return_internal_reference<>())
       .def("SetPoissonErrors", &BinByBinFactory::SetPoissonErrors,
            py::return_internal_reference<>())
+      .def("SetThreads", &BinByBinFactory::SetThreads,
+           py::return_internal_reference<>())
+      .def("SetSparseShapes", &BinByBinFactory::SetSparseShapes,
+           py::return_internal_reference<>())
     ;
     
     py::class_<AutoRebin>("AutoRebin")
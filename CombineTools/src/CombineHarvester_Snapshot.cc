@@ -0,0 +1,575 @@
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include <cstdint>
+#include <cstring>
+#include <fstream>
+#include <map>
+#include <memory>
+#include <string>
+#include <unordered_map>
+#include <vector>
+#include "TBufferFile.h"
+#include "TH1.h"
+#include "RooAbsArg.h"
+#include "RooAbsData.h"
+#include "RooAbsReal.h"
+#include "RooDataHist.h"
+#include "RooRealVar.h"
+#include "RooWorkspace.h"
+#include "CombineHarvester/CombineTools/interface/Observation.h"
+#include "CombineHarvester/CombineTools/interface/Process.h"
+#include "CombineHarvester/CombineTools/interface/Systematic.h"
+#include "CombineHarvester/CombineTools/interface/Parameter.h"
+#include "CombineHarvester/CombineTools/interface/Logging.h"
+
+// Snapshot file layout, all values in native byte order:
+//
+//   header:   char[8] magic, u32 version, u32 byte order mark
+//   strings:  u64 count, then per string u32 length + characters
+//   body:     workspaces, observations, processes, systematics, parameters,
+//             autoMCStats settings, extra datacard lines
+//
+// Strings in the body are u32 indices into the string table and RooFit
+// objects are referenced by (workspace, object) name pairs. Histograms are
+// stored inline, with their bin edges, contents and squared weights as
+// double arrays aligned to 8 bytes relative to the start of the file.
+namespace {
+char const kMagic[8] = {'C', 'H', 'S', 'N', 'A', 'P', '\0', '\0'};
+uint32_t const kVersion = 1;
+uint32_t const kByteOrderMark = 0x01020304;
+uint32_t const kNone = 0xFFFFFFFF;
+
+enum HistType : uint32_t { kNoHist = 0, kTH1F = 1, kTH1D = 2 };
+enum HistFlags : uint32_t { kVariableBins = 1, kSumw2 = 2 };
+
+typedef std::map<std::string, std::shared_ptr<RooWorkspace>> WorkspaceMap;
+
+class SnapshotWriter {
+ public:
+  template <typename T>
+  void Put(T const& val) {
+    PutBytes(reinterpret_cast<char const*>(&val), sizeof(T));
+  }
+
+  void PutBytes(char const* data, std::size_t n) {
+    body_.insert(body_.end(), data, data + n);
+  }
+
+  void PutArray(double const* data, std::size_t n) {
+    Align(&body_);
+    PutBytes(reinterpret_cast<char const*>(data), n * sizeof(double));
+  }
+
+  void PutString(std::string const& str) {
+    auto it = string_index_.find(str);
+    if (it == string_index_.end()) {
+      it = string_index_.emplace(str, uint32_t(strings_.size())).first;
+      strings_.push_back(str);
+    }
+    Put(it->second);
+  }
+
+  void Write(std::string const& filename) const {
+    std::vector<char> head(kMagic, kMagic + sizeof(kMagic));
+    Append(&head, kVersion);
+    Append(&head, kByteOrderMark);
+    Append(&head, uint64_t(strings_.size()));
+    for (auto const& str : strings_) {
+      Append(&head, uint32_t(str.size()));
+      head.insert(head.end(), str.begin(), str.end());
+    }
+    Align(&head);
+    std::ofstream file(filename, std::ios::binary | std::ios::trunc);
+    file.write(head.data(), head.size());
+    file.write(body_.data(), body_.size());
+    file.close();
+    if (!file) {
+      throw std::runtime_error(FNERROR("Unable to write file " + filename));
+    }
+  }
+
+ private:
+  // The header is padded to a multiple of 8 bytes, so aligning within the
+  // body also aligns within the file
+  std::vector<char> body_;
+  std::vector<std::string> strings_;
+  std::unordered_map<std::string, uint32_t> string_index_;
+
+  template <typename T>
+  static void Append(std::vector<char> *buf, T const& val) {
+    char const* p = reinterpret_cast<char const*>(&val);
+    buf->insert(buf->end(), p, p + sizeof(T));
+  }
+
+  static void Align(std::vector<char> *buf) {
+    buf->resize((buf->size() + 7) & ~std::size_t(7), '\0');
+  }
+};
+
+class SnapshotReader {
+ public:
+  explicit SnapshotReader(std::string const& filename)
+      : pos_(0) {
+    int fd = open(filename.c_str(), O_RDONLY);
+    if (fd < 0) {
+      throw std::runtime_error(FNERROR("Unable to open file " + filename));
+    }
+    struct stat st;
+    if (fstat(fd, &st) == 0 && st.st_size > 0) {
+      void *addr = mmap(nullptr, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+      if (addr != MAP_FAILED) {
+        map_.data = static_cast<char const*>(addr);
+        map_.size = st.st_size;
+      }
+    }
+    close(fd);
+    if (!map_.data) {
+      throw std::runtime_error(FNERROR("Unable to map file " + filename));
+    }
+    if (map_.size < sizeof(kMagic) ||
+        std::memcmp(map_.data, kMagic, sizeof(kMagic)) != 0) {
+      throw std::runtime_error(
+          FNERROR(filename + " is not a CombineHarvester snapshot"));
+    }
+    pos_ = sizeof(kMagic);
+    uint32_t version = Get<uint32_t>();
+    if (version != kVersion) {
+      throw std::runtime_error(FNERROR(
+          "Snapshot " + filename + " has version " + std::to_string(version) +
+          ", expected " + std::to_string(kVersion)));
+    }
+    if (Get<uint32_t>() != kByteOrderMark) {
+      throw std::runtime_error(
+          FNERROR("Snapshot " + filename + " was written with a different "
+                  "byte order"));
+    }
+    uint64_t n_strings = Get<uint64_t>();
+    strings_.reserve(n_strings);
+    for (uint64_t i = 0; i < n_strings; ++i) {
+      uint32_t len = Get<uint32_t>();
+      char const* chars = Take(len);
+      strings_.emplace_back(chars, len);
+    }
+  }
+
+  SnapshotReader(SnapshotReader const&) = delete;
+  SnapshotReader& operator=(SnapshotReader const&) = delete;
+
+  template <typename T>
+  T Get() {
+    T val;
+    std::memcpy(&val, Take(sizeof(T)), sizeof(T));
+    return val;
+  }
+
+  char const* GetBytes(std::size_t n) { return Take(n); }
+
+  // Points directly into the mapped file
+  double const* GetArray(std::size_t n) {
+    pos_ = (pos_ + 7) & ~std::size_t(7);
+    return reinterpret_cast<double const*>(Take(n * sizeof(double)));
+  }
+
+  std::string const& GetString() { return String(Get<uint32_t>()); }
+
+  std::string const& String(uint32_t idx) const {
+    if (idx >= strings_.size()) {
+      throw std::runtime_error(FNERROR("Invalid string index in snapshot"));
+    }
+    return strings_[idx];
+  }
+
+ private:
+  // Owns the mapping, so that it is also released if the constructor throws
+  struct Mapping {
+    char const* data = nullptr;
+    std::size_t size = 0;
+    Mapping() = default;
+    Mapping(Mapping const&) = delete;
+    Mapping& operator=(Mapping const&) = delete;
+    ~Mapping() {
+      if (data) munmap(const_cast<char*>(data), size);
+    }
+  };
+
+  Mapping map_;
+  std::size_t pos_;
+  std::vector<std::string> strings_;
+
+  char const* Take(std::size_t n) {
+    if (pos_ > map_.size || n > map_.size - pos_) {
+      throw std::runtime_error(FNERROR("Snapshot file is truncated"));
+    }
+    char const* res = map_.data + pos_;
+    pos_ += n;
+    return res;
+  }
+};
+
+void PutHist(SnapshotWriter& out, TH1 const* h) {
+  if (!h) {
+    out.Put(uint32_t(kNoHist));
+    return;
+  }
+  out.Put(uint32_t(h->InheritsFrom(TH1F::Class()) ? kTH1F : kTH1D));
+  out.PutString(h->GetName());
+  out.PutString(h->GetTitle());
+  int32_t n = h->GetNbinsX();
+  TArrayD const* edges = h->GetXaxis()->GetXbins();
+  uint32_t flags = 0;
+  if (edges->GetSize() > 0) flags |= kVariableBins;
+  if (h->GetSumw2N() > 0) flags |= kSumw2;
+  out.Put(n);
+  out.Put(flags);
+  out.Put(h->GetXaxis()->GetXmin());
+  out.Put(h->GetXaxis()->GetXmax());
+  out.Put(h->GetEntries());
+  if (flags & kVariableBins) out.PutArray(edges->GetArray(), n + 1);
+  std::vector<double> contents(n + 2);
+  for (int i = 0; i < n + 2; ++i) contents[i] = h->GetBinContent(i);
+  out.PutArray(contents.data(), contents.size());
+  if (flags & kSumw2) out.PutArray(h->GetSumw2()->GetArray(), n + 2);
+}
+
+std::unique_ptr<TH1> GetHist(SnapshotReader& in) {
+  uint32_t type = in.Get<uint32_t>();
+  if (type == kNoHist) return nullptr;
+  std::string const& name = in.GetString();
+  std::string const& title = in.GetString();
+  int32_t n = in.Get<int32_t>();
+  uint32_t flags = in.Get<uint32_t>();
+  double xmin = in.Get<double>();
+  double xmax = in.Get<double>();
+  double entries = in.Get<double>();
+  if (n < 1 || (type != kTH1F && type != kTH1D)) {
+    throw std::runtime_error(FNERROR("Invalid histogram in snapshot"));
+  }
+  std::unique_ptr<TH1> h;
+  if (flags & kVariableBins) {
+    double const* edges = in.GetArray(n + 1);
+    if (type == kTH1F) {
+      h.reset(new TH1F(name.c_str(), title.c_str(), n, edges));
+    } else {
+      h.reset(new TH1D(name.c_str(), title.c_str(), n, edges));
+    }
+  } else {
+    if (type == kTH1F) {
+      h.reset(new TH1F(name.c_str(), title.c_str(), n, xmin, xmax));
+    } else {
+      h.reset(new TH1D(name.c_str(), title.c_str(), n, xmin, xmax));
+    }
+  }
+  h->SetDirectory(nullptr);
+  double const* contents = in.GetArray(n + 2);
+  for (int i = 0; i < n + 2; ++i) h->SetBinContent(i, contents[i]);
+  if (flags & kSumw2) {
+    double const* sumw2 = in.GetArray(n + 2);
+    if (h->GetSumw2N() == 0) h->Sumw2();
+    h->GetSumw2()->Set(n + 2, sumw2);
+  }
+  h->SetEntries(entries);
+  return h;
+}
+
+void PutObject(SnapshotWriter& out, ch::Object const& obj) {
+  out.PutString(obj.bin());
+  out.PutString(obj.process());
+  out.PutString(obj.analysis());
+  out.PutString(obj.era());
+  out.PutString(obj.channel());
+  out.PutString(obj.mass());
+  out.Put(int32_t(obj.bin_id()));
+  out.Put(uint32_t(obj.signal()));
+  auto const& attrs = obj.all_attributes();
+  out.Put(uint32_t(attrs.size()));
+  for (auto const& attr : attrs) {
+    out.PutString(attr.first);
+    out.PutString(attr.second);
+  }
+}
+
+void GetObject(SnapshotReader& in, ch::Object* obj) {
+  obj->set_bin(in.GetString());
+  obj->set_process(in.GetString());
+  obj->set_analysis(in.GetString());
+  obj->set_era(in.GetString());
+  obj->set_channel(in.GetString());
+  obj->set_mass(in.GetString());
+  obj->set_bin_id(in.Get<int32_t>());
+  obj->set_signal(in.Get<uint32_t>() != 0);
+  std::map<std::string, std::string> attrs;
+  uint32_t n_attrs = in.Get<uint32_t>();
+  for (uint32_t i = 0; i < n_attrs; ++i) {
+    std::string const& label = in.GetString();
+    attrs[label] = in.GetString();
+  }
+  obj->set_all_attributes(attrs);
+}
+
+bool InWorkspace(RooWorkspace& ws, RooAbsArg const* obj) {
+  return ws.arg(obj->GetName()) == obj;
+}
+
+bool InWorkspace(RooWorkspace& ws, RooAbsData const* obj) {
+  return ws.data(obj->GetName()) == obj;
+}
+
+template <typename T>
+void PutRef(SnapshotWriter& out, WorkspaceMap const& wspaces, T const* obj) {
+  if (!obj) {
+    out.Put(kNone);
+    return;
+  }
+  for (auto const& it : wspaces) {
+    if (InWorkspace(*(it.second), obj)) {
+      out.Put(uint32_t(1));
+      out.PutString(it.first);
+      out.PutString(obj->GetName());
+      return;
+    }
+  }
+  throw std::runtime_error(
+      FNERROR(std::string("RooFit object ") + obj->GetName() +
+              " is not part of any workspace in this CombineHarvester "
+              "instance and cannot be saved in a snapshot"));
+}
+
+void FindInWorkspace(RooWorkspace& ws, std::string const& name,
+                     RooAbsReal** res) {
+  *res = ws.function(name.c_str());
+}
+
+void FindInWorkspace(RooWorkspace& ws, std::string const& name,
+                     RooRealVar** res) {
+  *res = ws.var(name.c_str());
+}
+
+void FindInWorkspace(RooWorkspace& ws, std::string const& name,
+                     RooAbsData** res) {
+  *res = ws.data(name.c_str());
+}
+
+void FindInWorkspace(RooWorkspace& ws, std::string const& name,
+                     RooDataHist** res) {
+  *res = dynamic_cast<RooDataHist*>(ws.data(name.c_str()));
+}
+
+template <typename T>
+T* GetRef(SnapshotReader& in, WorkspaceMap const& wspaces) {
+  if (in.Get<uint32_t>() == kNone) return nullptr;
+  std::string const& ws_name = in.GetString();
+  std::string const& name = in.GetString();
+  auto it = wspaces.find(ws_name);
+  T* res = nullptr;
+  if (it != wspaces.end()) FindInWorkspace(*(it->second), name, &res);
+  if (!res) {
+    throw std::runtime_error(FNERROR("Object " + name +
+                                     " not found in snapshot workspace " +
+                                     ws_name));
+  }
+  return res;
+}
+}
+
+namespace ch {
+
+void CombineHarvester::SaveSnapshot(std::string const& filename) {
+  SnapshotWriter out;
+
+  out.Put(uint64_t(wspaces_.size()));
+  for (auto const& it : wspaces_) {
+    TBufferFile buf(TBuffer::kWrite);
+    buf.WriteObjectAny(it.second.get(), RooWorkspace::Class());
+    out.PutString(it.first);
+    out.Put(uint64_t(buf.Length()));
+    out.PutBytes(buf.Buffer(), buf.Length());
+  }
+
+  out.Put(uint64_t(obs_.size()));
+  for (auto const& obs : obs_) {
+    PutObject(out, *obs);
+    out.Put(obs->rate_);
+    PutHist(out, obs->shape_.get());
+    PutRef(out, wspaces_, obs->data_);
+  }
+
+  out.Put(uint64_t(procs_.size()));
+  for (auto const& proc : procs_) {
+    PutObject(out, *proc);
+    out.Put(proc->rate_);
+    PutHist(out, proc->shape_.get());
+    PutRef(out, wspaces_, proc->pdf_);
+    PutRef(out, wspaces_, proc->data_);
+    PutRef(out, wspaces_, proc->norm_);
+    PutRef(out, wspaces_, proc->cached_obs_);
+  }
+
+  out.Put(uint64_t(systs_.size()));
+  for (auto const& sys : systs_) {
+    PutObject(out, *sys);
+    out.PutString(sys->name_);
+    out.PutString(sys->type_);
+    out.Put(sys->value_u_);
+    out.Put(sys->value_d_);
+    out.Put(sys->scale_);
+    out.Put(uint32_t(sys->asymm_));
+    if (sys->sparse_) {
+      // Stored in full, without keeping the templates in memory
+      PutHist(out, sys->ClonedShapeU().get());
+      PutHist(out, sys->ClonedShapeD().get());
+    } else {
+      PutHist(out, sys->shape_u_.get());
+      PutHist(out, sys->shape_d_.get());
+    }
+    PutRef(out, wspaces_, sys->pdf_u_);
+    PutRef(out, wspaces_, sys->pdf_d_);
+    PutRef(out, wspaces_, sys->data_u_);
+    PutRef(out, wspaces_, sys->data_d_);
+  }
+
+  out.Put(uint64_t(params_.size()));
+  for (auto const& it : params_) {
+    Parameter & par = *(it.second);
+    out.PutString(par.name());
+    out.Put(par.val());
+    out.Put(par.err_u());
+    out.Put(par.err_d());
+    out.Put(par.range_u());
+    out.Put(par.range_d());
+    out.Put(uint32_t(par.frozen()));
+    out.Put(uint32_t(par.groups().size()));
+    for (auto const& group : par.groups()) out.PutString(group);
+    out.Put(uint32_t(par.vars().size()));
+    for (auto var : par.vars()) PutRef(out, wspaces_, var);
+  }
+
+  out.Put(uint64_t(auto_stats_settings_.size()));
+  for (auto const& it : auto_stats_settings_) {
+    out.PutString(it.first);
+    out.Put(it.second.event_threshold);
+    out.Put(uint32_t(it.second.include_signal));
+    out.Put(int32_t(it.second.hist_mode));
+  }
+
+  out.Put(uint64_t(post_lines_.size()));
+  for (auto const& line : post_lines_) out.PutString(line);
+
+  out.Write(filename);
+}
+
+void CombineHarvester::LoadSnapshot(std::string const& filename) {
+  if (obs_.size() || procs_.size() || systs_.size() || params_.size() ||
+      wspaces_.size()) {
+    throw std::runtime_error(
+        FNERROR("A snapshot can only be loaded into an empty instance"));
+  }
+  SnapshotReader in(filename);
+  // Build the new state separately so that this instance is left unmodified
+  // if the file turns out to be invalid
+  CombineHarvester res = this->cp();
+
+  uint64_t n_wspaces = in.Get<uint64_t>();
+  for (uint64_t i = 0; i < n_wspaces; ++i) {
+    std::string const& name = in.GetString();
+    uint64_t len = in.Get<uint64_t>();
+    char const* bytes = in.GetBytes(len);
+    std::vector<char> copy(bytes, bytes + len);
+    TBufferFile buf(TBuffer::kRead, len, copy.data(), false);
+    std::shared_ptr<RooWorkspace> ws(static_cast<RooWorkspace*>(
+        buf.ReadObjectAny(RooWorkspace::Class())));
+    if (!ws) {
+      throw std::runtime_error(
+          FNERROR("Unable to read workspace " + name + " from snapshot"));
+    }
+    res.wspaces_[name] = ws;
+  }
+
+  uint64_t n_obs = in.Get<uint64_t>();
+  res.obs_.reserve(n_obs);
+  for (uint64_t i = 0; i < n_obs; ++i) {
+    auto obs = std::make_shared<Observation>();
+    GetObject(in, obs.get());
+    obs->rate_ = in.Get<double>();
+    obs->shape_ = GetHist(in);
+    obs->data_ = GetRef<RooAbsData>(in, res.wspaces_);
+    res.obs_.push_back(obs);
+  }
+
+  uint64_t n_procs = in.Get<uint64_t>();
+  res.procs_.reserve(n_procs);
+  for (uint64_t i = 0; i < n_procs; ++i) {
+    auto proc = std::make_shared<Process>();
+    GetObject(in, proc.get());
+    proc->rate_ = in.Get<double>();
+    proc->shape_ = GetHist(in);
+    proc->pdf_ = GetRef<RooAbsReal>(in, res.wspaces_);
+    proc->data_ = GetRef<RooAbsData>(in, res.wspaces_);
+    proc->norm_ = GetRef<RooAbsReal>(in, res.wspaces_);
+    proc->cached_obs_ = GetRef<RooRealVar>(in, res.wspaces_);
+    res.procs_.push_back(proc);
+  }
+
+  uint64_t n_systs = in.Get<uint64_t>();
+  res.systs_.reserve(n_systs);
+  for (uint64_t i = 0; i < n_systs; ++i) {
+    auto sys = std::make_shared<Systematic>();
+    GetObject(in, sys.get());
+    sys->name_ = in.GetString();
+    sys->type_ = in.GetString();
+    sys->value_u_ = in.Get<double>();
+    sys->value_d_ = in.Get<double>();
+    sys->scale_ = in.Get<double>();
+    sys->asymm_ = in.Get<uint32_t>() != 0;
+    sys->shape_u_ = GetHist(in);
+    sys->shape_d_ = GetHist(in);
+    sys->pdf_u_ = GetRef<RooAbsReal>(in, res.wspaces_);
+    sys->pdf_d_ = GetRef<RooAbsReal>(in, res.wspaces_);
+    sys->data_u_ = GetRef<RooDataHist>(in, res.wspaces_);
+    sys->data_d_ = GetRef<RooDataHist>(in, res.wspaces_);
+    res.systs_.push_back(sys);
+  }
+
+  uint64_t n_params = in.Get<uint64_t>();
+  for (uint64_t i = 0; i < n_params; ++i) {
+    auto par = std::make_shared<Parameter>();
+    par->set_name(in.GetString());
+    par->set_val(in.Get<double>());
+    par->set_err_u(in.Get<double>());
+    par->set_err_d(in.Get<double>());
+    par->set_range_u(in.Get<double>());
+    par->set_range_d(in.Get<double>());
+    par->set_frozen(in.Get<uint32_t>() != 0);
+    uint32_t n_groups = in.Get<uint32_t>();
+    for (uint32_t j = 0; j < n_groups; ++j) {
+      par->groups().insert(in.GetString());
+    }
+    // Attached after the value is set, as the workspace variables already
+    // hold the saved values
+    uint32_t n_vars = in.Get<uint32_t>();
+    for (uint32_t j = 0; j < n_vars; ++j) {
+      par->vars().push_back(GetRef<RooRealVar>(in, res.wspaces_));
+    }
+    res.params_[par->name()] = par;
+  }
+
+  uint64_t n_auto_stats = in.Get<uint64_t>();
+  for (uint64_t i = 0; i < n_auto_stats; ++i) {
+    std::string const& bin = in.GetString();
+    AutoMCStatsSettings settings;
+    settings.event_threshold = in.Get<double>();
+    settings.include_signal = in.Get<uint32_t>() != 0;
+    settings.hist_mode = in.Get<int32_t>();
+    res.auto_stats_settings_[bin] = settings;
+  }
+
+  uint64_t n_lines = in.Get<uint64_t>();
+  for (uint64_t i = 0; i < n_lines; ++i) {
+    res.post_lines_.push_back(in.GetString());
+  }
+
+  swap(*this, res);
+}
+}
@@ -0,0 +1,123 @@
+#include "CombineHarvester/CombineTools/interface/DatacardTokens.h"
+#include <cctype>
+#include <fstream>
+#include <iterator>
+#include <stdexcept>
+#include <string>
+#include <vector>
+#include "CombineHarvester/CombineTools/interface/Logging.h"
+#include "CombineHarvester/CombineTools/interface/zstr.hpp"
+
+namespace ch {
+
+bool IEquals(boost::string_ref word, boost::string_ref lower) {
+  if (word.size() != lower.size()) return false;
+  for (std::size_t i = 0; i < word.size(); ++i) {
+    if (std::tolower(static_cast<unsigned char>(word[i])) != lower[i]) {
+      return false;
+    }
+  }
+  return true;
+}
+
+DatacardTokens::Keyword DatacardTokens::Classify(boost::string_ref word) {
+  switch (word.size()) {
+    case 3:
+      if (IEquals(word, "bin")) return Keyword::bin;
+      break;
+    case 4:
+      if (IEquals(word, "rate")) return Keyword::rate;
+      break;
+    case 5:
+      if (IEquals(word, "param")) return Keyword::param;
+      if (IEquals(word, "group")) return Keyword::group;
+      break;
+    case 6:
+      if (IEquals(word, "shapes")) return Keyword::shapes;
+      if (IEquals(word, "extarg")) return Keyword::extArg;
+      break;
+    case 7:
+      if (IEquals(word, "process")) return Keyword::process;
+      break;
+    case 9:
+      if (IEquals(word, "rateparam")) return Keyword::rateParam;
+      break;
+    case 11:
+      if (IEquals(word, "observation")) return Keyword::observation;
+      if (IEquals(word, "automcstats")) return Keyword::autoMCStats;
+      break;
+  }
+  return Keyword::none;
+}
+
+DatacardTokens::DatacardTokens(std::string const& filename) {
+  std::ifstream file(filename.c_str(), std::ios::in | std::ios::binary);
+  if (!file.is_open()) {
+    throw std::runtime_error(
+        FNERROR("File " + filename + " could not be opened"));
+  }
+  std::string const zip_ext = ".gz";
+  bool has_zip_ext =
+      filename.length() >= zip_ext.length() &&
+      filename.compare(filename.length() - zip_ext.length(), zip_ext.length(),
+                       zip_ext) == 0;
+  if (has_zip_ext) {
+    zstr::istream unzip(file);
+    buffer_.assign(std::istreambuf_iterator<char>(unzip),
+                   std::istreambuf_iterator<char>());
+  } else {
+    file.seekg(0, std::ios::end);
+    std::streamoff size = file.tellg();
+    file.seekg(0, std::ios::beg);
+    if (size > 0) {
+      buffer_.resize(size);
+      file.read(&buffer_[0], size);
+    }
+  }
+  if (file.bad()) {
+    throw std::runtime_error(FNERROR("Error reading file " + filename));
+  }
+  Tokenize();
+}
+
+void DatacardTokens::Tokenize() {
+  // Each entry is the position of the first word of a line in words_ and
+  // the number of words. The Line objects can only point into words_ once
+  // it has stopped growing.
+  std::vector<std::pair<std::size_t, unsigned>> spans;
+  auto is_space = [](char c) {
+    return std::isspace(static_cast<unsigned char>(c)) != 0;
+  };
+  char const* data = buffer_.data();
+  std::size_t const size = buffer_.size();
+  std::size_t pos = 0;
+  while (pos < size) {
+    std::size_t eol = buffer_.find('\n', pos);
+    if (eol == std::string::npos) eol = size;
+    std::size_t begin = pos;
+    std::size_t end = eol;
+    pos = eol + 1;
+    while (begin < end && is_space(data[begin])) ++begin;
+    while (end > begin && is_space(data[end - 1])) --end;
+    if (begin == end || data[begin] == '#' || data[begin] == '-') continue;
+    spans.emplace_back(words_.size(), 0);
+    std::size_t i = begin;
+    while (i < end) {
+      std::size_t j = i;
+      while (j < end && data[j] != ' ' && data[j] != '\t') ++j;
+      words_.emplace_back(data + i, j - i);
+      ++spans.back().second;
+      while (j < end && (data[j] == ' ' || data[j] == '\t')) ++j;
+      i = j;
+    }
+  }
+  lines_.resize(spans.size());
+  for (unsigned l = 0; l < spans.size(); ++l) {
+    Line & line = lines_[l];
+    line.words_ = words_.data() + spans[l].first;
+    line.n_ = spans[l].second;
+    line.keys_[0] = Classify(line.words_[0]);
+    line.keys_[1] = line.n_ > 1 ? Classify(line.words_[1]) : Keyword::none;
+  }
+}
+}
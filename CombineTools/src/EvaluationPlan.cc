@@ -0,0 +1,289 @@
+#include "CombineHarvester/CombineTools/interface/EvaluationPlan.h"
+#include <algorithm>
+#include <cmath>
+#include <sstream>
+#include <string>
+#include <unordered_map>
+#include <vector>
+#include "CombineHarvester/CombineTools/interface/Logging.h"
+#include "CombineHarvester/CombineTools/interface/Utilities.h"
+
+namespace ch {
+
+EvaluationPlan::EvaluationPlan(CombineHarvester & cb, bool rate_only)
+    : n_bins_(0) {
+  std::vector<Process const*> procs;
+  cb.ForEachProc([&](Process *proc) {
+    if (!Supported(proc)) {
+      std::stringstream err;
+      err << "Only processes with a TH1 shape or a fixed rate can be "
+             "compiled into an EvaluationPlan:\n";
+      err << Process::PrintHeader << *proc;
+      throw std::runtime_error(FNERROR(err.str()));
+    }
+    procs.push_back(proc);
+  });
+
+  // Assign the Systematic entries to the matching processes
+  std::unordered_multimap<std::size_t, unsigned> index;
+  for (unsigned j = 0; j < procs.size(); ++j) {
+    index.emplace(MatchingProcessHash(*(procs[j])), j);
+  }
+  std::vector<std::vector<Systematic const*>> lookup(procs.size());
+  cb.ForEachSyst([&](Systematic *sys) {
+    if (sys->type() == "rateParam") return;  // not evaluated
+    auto range = index.equal_range(MatchingProcessHash(*sys));
+    for (auto it = range.first; it != range.second; ++it) {
+      if (MatchingProcess(*sys, *(procs[it->second]))) {
+        lookup[it->second].push_back(sys);
+      }
+    }
+  });
+
+  auto get_par = [&](std::string const& name) {
+    auto it = par_index_.find(name);
+    if (it != par_index_.end()) return it->second;
+    if (!cb.GetParameter(name)) {
+      throw std::runtime_error(FNERROR(
+          "Parameter " + name + " not found in CombineHarvester instance"));
+    }
+    par_names_.push_back(name);
+    par_index_[name] = par_names_.size() - 1;
+    return unsigned(par_names_.size() - 1);
+  };
+
+  bool axis_set = false;
+  for (unsigned j = 0; j < procs.size(); ++j) {
+    Process const* proc = procs[j];
+    ProcEntry entry;
+    entry.rate = proc->rate();
+    entry.has_shape = !rate_only && proc->shape() != nullptr;
+    entry.kappa_begin = kappas_.size();
+    entry.morph_begin = morphs_.size();
+    entry.nominal_offset = nominal_.size();
+    entry.coeff_offset = coeff_diff_.size();
+
+    if (entry.has_shape) {
+      if (!axis_set) {
+        axis_ = proc->ShapeAsTH1F();
+        axis_.Reset();
+        n_bins_ = axis_.GetNbinsX();
+        axis_set = true;
+      } else if (proc->shape()->GetNbinsX() != int(n_bins_)) {
+        throw std::runtime_error(
+            FNERROR("Process shapes have different numbers of bins"));
+      }
+      for (unsigned b = 1; b <= n_bins_; ++b) {
+        nominal_.push_back(proc->shape()->GetBinContent(b));
+      }
+    }
+
+    std::vector<Systematic const*> shape_systs;
+    for (auto sys : lookup[j]) {
+      Kappa kappa;
+      kappa.par = get_par(sys->name());
+      kappa.scale = sys->scale();
+      kappa.asymm = sys->asymm();
+      if (sys->asymm()) {
+        // Matches CombineHarvester::logKappaForX, which returns 1 when
+        // either kappa is zero
+        bool valid = sys->value_u() != 0. && sys->value_d() != 0.;
+        kappa.log_hi = valid ? std::log(sys->value_u()) : 0.;
+        kappa.log_lo = valid ? -std::log(sys->value_d()) : 0.;
+      } else {
+        kappa.log_hi = std::log(sys->value_u());
+        kappa.log_lo = 0.;
+      }
+      kappas_.push_back(kappa);
+
+      bool is_shape = sys->type() == "shape" || sys->type() == "shapeN2" ||
+                      sys->type() == "shapeU";
+      if (entry.has_shape && sys->asymm() && is_shape && sys->shape_u() &&
+          sys->shape_d()) {
+        if (sys->shape_u()->GetNbinsX() != int(n_bins_) ||
+            sys->shape_d()->GetNbinsX() != int(n_bins_)) {
+          throw std::runtime_error(FNERROR(
+              "Systematic " + sys->name() +
+              " has shapes with a different number of bins to the process"));
+        }
+        Morph morph;
+        morph.par = kappa.par;
+        morph.scale = sys->scale();
+        morph.linear = sys->type() != "shapeN2";
+        morphs_.push_back(morph);
+        shape_systs.push_back(sys);
+      }
+    }
+    entry.kappa_end = kappas_.size();
+    entry.morph_end = morphs_.size();
+
+    // Store the interpolation coefficients bin-major, so that evaluating a
+    // single bin reads a contiguous block
+    unsigned n_morph = shape_systs.size();
+    coeff_diff_.resize(coeff_diff_.size() + n_bins_ * n_morph);
+    coeff_sum_.resize(coeff_sum_.size() + n_bins_ * n_morph);
+    for (unsigned m = 0; m < n_morph; ++m) {
+      Systematic const* sys = shape_systs[m];
+      bool linear = morphs_[entry.morph_begin + m].linear;
+      for (unsigned b = 0; b < n_bins_; ++b) {
+        double n = proc->shape()->GetBinContent(b + 1);
+        double h = sys->shape_u()->GetBinContent(b + 1);
+        double l = sys->shape_d()->GetBinContent(b + 1);
+        unsigned idx = entry.coeff_offset + b * n_morph + m;
+        if (linear) {
+          coeff_diff_[idx] = 0.5 * (h - l);
+          coeff_sum_[idx] = 0.5 * (h + l - 2. * n);
+        } else {
+          h = (h > 0. && n > 0.) ? std::log(h / n) : 0.;
+          l = (l > 0. && n > 0.) ? std::log(l / n) : 0.;
+          coeff_diff_[idx] = 0.5 * (h - l);
+          coeff_sum_[idx] = 0.5 * (h + l);
+        }
+      }
+    }
+    procs_.push_back(entry);
+  }
+}
+
+bool EvaluationPlan::CanCompile(CombineHarvester & cb, bool rate_only) {
+  bool ok = true;
+  int n_bins = -1;
+  cb.ForEachProc([&](Process *proc) {
+    if (!Supported(proc)) ok = false;
+    if (rate_only || !proc->shape()) return;
+    if (n_bins < 0) n_bins = proc->shape()->GetNbinsX();
+    if (proc->shape()->GetNbinsX() != n_bins) ok = false;
+  });
+  if (!ok || rate_only || n_bins < 0) return ok;
+  cb.ForEachSyst([&](Systematic *sys) {
+    if (sys->shape_u() && sys->shape_u()->GetNbinsX() != n_bins) ok = false;
+    if (sys->shape_d() && sys->shape_d()->GetNbinsX() != n_bins) ok = false;
+  });
+  return ok;
+}
+
+int EvaluationPlan::ParameterIndex(std::string const& name) const {
+  auto it = par_index_.find(name);
+  return it != par_index_.end() ? int(it->second) : -1;
+}
+
+std::vector<double> EvaluationPlan::CurrentValues(
+    CombineHarvester const& cb) const {
+  std::vector<double> vals(par_names_.size());
+  for (unsigned i = 0; i < par_names_.size(); ++i) {
+    ch::Parameter const* par = cb.GetParameter(par_names_[i]);
+    if (!par) {
+      throw std::runtime_error(FNERROR("Parameter " + par_names_[i] +
+                                       " not found in CombineHarvester instance"));
+    }
+    vals[i] = par->val();
+  }
+  return vals;
+}
+
+double EvaluationPlan::LogKappa(ProcEntry const& proc,
+                                double const* vals) const {
+  double res = 0.;
+  for (unsigned k = proc.kappa_begin; k < proc.kappa_end; ++k) {
+    Kappa const& kappa = kappas_[k];
+    double x = vals[kappa.par] * kappa.scale;
+    if (!kappa.asymm) {
+      res += x * kappa.log_hi;
+    } else if (std::fabs(x) >= 0.5) {
+      res += x * (x >= 0 ? kappa.log_hi : kappa.log_lo);
+    } else {
+      // Same interpolation as CombineHarvester::logKappaForX
+      double avg = 0.5 * (kappa.log_hi + kappa.log_lo);
+      double halfdiff = 0.5 * (kappa.log_hi - kappa.log_lo);
+      double twox = x + x, twox2 = twox * twox;
+      double alpha = 0.125 * twox * (twox2 * (3 * twox2 - 10.) + 15.);
+      res += x * (avg + alpha * halfdiff);
+    }
+  }
+  return res;
+}
+
+double EvaluationPlan::EvaluateRate(double const* vals) const {
+  double rate = 0.;
+  for (auto const& proc : procs_) {
+    rate += proc.rate * std::exp(LogKappa(proc, vals));
+  }
+  return rate;
+}
+
+void EvaluationPlan::EvaluateShape(double const* vals, double * out) const {
+  std::fill(out, out + n_bins_, 0.);
+  for (auto const& proc : procs_) {
+    if (!proc.has_shape) continue;
+    double p_rate = proc.rate * std::exp(LogKappa(proc, vals));
+    unsigned n_morph = proc.morph_end - proc.morph_begin;
+    double const* nom = nominal_.data() + proc.nominal_offset;
+    double const* diff = coeff_diff_.data() + proc.coeff_offset;
+    double const* sum = coeff_sum_.data() + proc.coeff_offset;
+    for (unsigned b = 0; b < n_bins_; ++b) {
+      double val = nom[b];
+      for (unsigned m = 0; m < n_morph; ++m) {
+        Morph const& morph = morphs_[proc.morph_begin + m];
+        double x = vals[morph.par] * morph.scale;
+        double shift = x * (diff[b * n_morph + m] +
+                            sum[b * n_morph + m] * SmoothStep(x));
+        if (morph.linear) {
+          val += shift;
+        } else {
+          val = std::exp((val > 0. ? std::log(val) : -999.) + shift);
+        }
+      }
+      if (val < 0.) val = 0.;
+      out[b] += p_rate * val;
+    }
+  }
+}
+
+void EvaluationPlan::EvaluateProcessRates(double const* vals,
+                                          double * out) const {
+  for (unsigned j = 0; j < procs_.size(); ++j) {
+    out[j] = procs_[j].rate * std::exp(LogKappa(procs_[j], vals));
+  }
+}
+
+void EvaluationPlan::EvaluateRates(double const* vals, unsigned n_points,
+                                   double * out) const {
+  unsigned n_pars = par_names_.size();
+  for (unsigned i = 0; i < n_points; ++i) {
+    out[i] = EvaluateRate(vals + std::size_t(i) * n_pars);
+  }
+}
+
+void EvaluationPlan::EvaluateShapes(double const* vals, unsigned n_points,
+                                    double * out) const {
+  unsigned n_pars = par_names_.size();
+  for (unsigned i = 0; i < n_points; ++i) {
+    EvaluateShape(vals + std::size_t(i) * n_pars, out + std::size_t(i) * n_bins_);
+  }
+}
+
+double EvaluationPlan::GetRate(std::vector<double> const& vals) const {
+  CheckSize(vals);
+  return EvaluateRate(vals.data());
+}
+
+TH1F EvaluationPlan::GetShape(std::vector<double> const& vals) const {
+  CheckSize(vals);
+  TH1F shape = axis_;
+  std::vector<double> content(n_bins_);
+  EvaluateShape(vals.data(), content.data());
+  for (unsigned b = 0; b < n_bins_; ++b) {
+    shape.SetBinContent(b + 1, content[b]);
+  }
+  return shape;
+}
+
+void EvaluationPlan::CheckSize(std::vector<double> const& vals) const {
+  if (vals.size() != par_names_.size()) {
+    throw std::runtime_error(FNERROR("Expected " +
+                                     std::to_string(par_names_.size()) +
+                                     " parameter values, got " +
+                                     std::to_string(vals.size())));
+  }
+}
+}
@@ -0,0 +1,217 @@
+#include "CombineHarvester/CombineTools/interface/FilterQuery.h"
+#include <string>
+#include <vector>
+#include "CombineHarvester/CombineTools/interface/Algorithm.h"
+
+namespace ch {
+
+FilterQuery::FilterQuery(CombineHarvester & cb) : cb_(&cb) {}
+
+bool FilterQuery::Filter::Test(std::string const& val) const {
+  bool found = use_regex ? ch::contains_rgx(rgx, val) : values.count(val) > 0;
+  return found == cond;
+}
+
+bool FilterQuery::Filter::Test(int val) const {
+  return (ids.count(val) > 0) == cond;
+}
+
+FilterQuery& FilterQuery::AddFilter(Property property, unsigned targets,
+                                    std::vector<std::string> const& vec,
+                                    bool cond, bool use_regex,
+                                    std::string const& attr_label) {
+  Filter filter;
+  filter.property = property;
+  filter.targets = targets;
+  filter.cond = cond;
+  filter.use_regex = use_regex;
+  filter.attr_label = attr_label;
+  if (use_regex) {
+    for (auto const& ele : vec) filter.rgx.emplace_back(ele);
+  } else {
+    filter.values.insert(vec.begin(), vec.end());
+  }
+  filters_.push_back(std::move(filter));
+  return *this;
+}
+
+FilterQuery& FilterQuery::AddFlagFilter(Property property, unsigned targets,
+                                        bool cond) {
+  Filter filter;
+  filter.property = property;
+  filter.targets = targets;
+  filter.cond = cond;
+  filter.use_regex = false;
+  filters_.push_back(std::move(filter));
+  return *this;
+}
+
+FilterQuery& FilterQuery::bin(std::vector<std::string> const& vec,
+                              bool cond) {
+  return AddFilter(Property::bin, kObs | kProcs | kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::bin_id(std::vector<int> const& vec, bool cond) {
+  Filter filter;
+  filter.property = Property::bin_id;
+  filter.targets = kObs | kProcs | kSysts;
+  filter.cond = cond;
+  filter.use_regex = false;
+  filter.ids.insert(vec.begin(), vec.end());
+  filters_.push_back(std::move(filter));
+  return *this;
+}
+
+FilterQuery& FilterQuery::process(std::vector<std::string> const& vec,
+                                  bool cond) {
+  return AddFilter(Property::process, kProcs | kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::process_rgx(std::vector<std::string> const& vec,
+                                      bool cond) {
+  return AddFilter(Property::process, kProcs | kSysts, vec, cond, true);
+}
+
+FilterQuery& FilterQuery::analysis(std::vector<std::string> const& vec,
+                                   bool cond) {
+  return AddFilter(Property::analysis, kObs | kProcs | kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::era(std::vector<std::string> const& vec,
+                              bool cond) {
+  return AddFilter(Property::era, kObs | kProcs | kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::channel(std::vector<std::string> const& vec,
+                                  bool cond) {
+  return AddFilter(Property::channel, kObs | kProcs | kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::mass(std::vector<std::string> const& vec,
+                               bool cond) {
+  return AddFilter(Property::mass, kObs | kProcs | kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::attr(std::vector<std::string> const& vec,
+                               std::string attr_label, bool cond) {
+  return AddFilter(Property::attr, kObs | kProcs | kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"), attr_label);
+}
+
+FilterQuery& FilterQuery::syst_name(std::vector<std::string> const& vec,
+                                    bool cond) {
+  return AddFilter(Property::syst_name, kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::syst_type(std::vector<std::string> const& vec,
+                                    bool cond) {
+  return AddFilter(Property::syst_type, kSysts, vec, cond,
+                   cb_->GetFlag("filters-use-regex"));
+}
+
+FilterQuery& FilterQuery::signals() {
+  return AddFlagFilter(Property::signal, kProcs | kSysts, true);
+}
+
+FilterQuery& FilterQuery::backgrounds() {
+  return AddFlagFilter(Property::signal, kProcs | kSysts, false);
+}
+
+FilterQuery& FilterQuery::histograms() {
+  return AddFlagFilter(Property::histogram, kObs | kProcs, true);
+}
+
+FilterQuery& FilterQuery::pdfs() {
+  return AddFlagFilter(Property::pdf, kProcs, true);
+}
+
+FilterQuery& FilterQuery::data() {
+  return AddFlagFilter(Property::data, kObs, true);
+}
+
+bool FilterQuery::TestObject(Filter const& filter, Object const& obj) {
+  switch (filter.property) {
+    case Property::bin:
+      return filter.Test(obj.bin());
+    case Property::bin_id:
+      return filter.Test(obj.bin_id());
+    case Property::process:
+      return filter.Test(obj.process());
+    case Property::analysis:
+      return filter.Test(obj.analysis());
+    case Property::era:
+      return filter.Test(obj.era());
+    case Property::channel:
+      return filter.Test(obj.channel());
+    case Property::mass:
+      return filter.Test(obj.mass());
+    case Property::attr:
+      return filter.Test(obj.attribute(filter.attr_label));
+    case Property::signal:
+      return obj.signal() == filter.cond;
+    default:
+      return true;
+  }
+}
+
+bool FilterQuery::TestEntry(Filter const& filter, Observation const& obs) {
+  switch (filter.property) {
+    case Property::histogram:
+      return obs.shape() != nullptr;
+    case Property::data:
+      return obs.data() != nullptr;
+    default:
+      return TestObject(filter, obs);
+  }
+}
+
+bool FilterQuery::TestEntry(Filter const& filter, Process const& proc) {
+  switch (filter.property) {
+    case Property::histogram:
+      return proc.shape() != nullptr;
+    case Property::pdf:
+      return proc.pdf() != nullptr;
+    default:
+      return TestObject(filter, proc);
+  }
+}
+
+bool FilterQuery::TestEntry(Filter const& filter, Systematic const& sys) {
+  switch (filter.property) {
+    case Property::syst_name:
+      return filter.Test(sys.name());
+    case Property::syst_type:
+      return filter.Test(sys.type());
+    default:
+      return TestObject(filter, sys);
+  }
+}
+
+CombineHarvester FilterQuery::cp() const {
+  CombineHarvester res(*cb_, false);
+  res.obs_ = Select(cb_->obs_, kObs);
+  res.procs_ = Select(cb_->procs_, kProcs);
+  res.systs_ = Select(cb_->systs_, kSysts);
+  return res;
+}
+
+CombineHarvester& FilterQuery::Apply() {
+  ch::erase_if(cb_->obs_, [&](std::shared_ptr<Observation> const& ptr) {
+    return !Keep(*ptr, kObs);
+  });
+  ch::erase_if(cb_->procs_, [&](std::shared_ptr<Process> const& ptr) {
+    return !Keep(*ptr, kProcs);
+  });
+  ch::erase_if(cb_->systs_, [&](std::shared_ptr<Systematic> const& ptr) {
+    return !Keep(*ptr, kSysts);
+  });
+  return *cb_;
+}
+}
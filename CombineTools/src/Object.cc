@@ -2,6 +2,8 @@
 #include <iostream>
 namespace ch {
 
+std::atomic<unsigned long> Object::generation_(0);
+
 Object::Object()
     : bin_(""),
       process_(""),
@@ -26,6 +28,7 @@ void swap(Object& first, Object& second) {
   swap(first.bin_id_, second.bin_id_);
   swap(first.mass_, second.mass_);
   swap(first.attributes_, second.attributes_);
+  ++Object::generation_;
 }
 
 Object::Object(Object const& other)
@@ -0,0 +1,170 @@
+#include "CombineHarvester/CombineTools/interface/OutputManifest.h"
+#include <cstdio>
+#include <fstream>
+#include <map>
+#include <memory>
+#include <sstream>
+#include <string>
+#include <utility>
+#include <vector>
+#include "boost/algorithm/string.hpp"
+#include "boost/filesystem.hpp"
+#include "TFile.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/Logging.h"
+#include "CombineHarvester/CombineTools/interface/TFileIO.h"
+#include "CombineHarvester/CombineTools/interface/Utilities.h"
+#include "CombineHarvester/CombineTools/interface/json.hpp"
+#include "CombineHarvester/CombineTools/interface/zstr.hpp"
+
+namespace ch {
+
+OutputManifest::OutputManifest() : compression_(-1) {}
+
+std::string OutputManifest::PathFor(std::string const& root_file) {
+  return root_file + ".manifest.json";
+}
+
+OutputManifest OutputManifest::Read(std::string const& root_file) {
+  OutputManifest res;
+  std::ifstream input(PathFor(root_file));
+  if (!input.is_open()) return res;
+  try {
+    nlohmann::json js;
+    input >> js;
+    if (js.value("version", 0) != 1) return res;
+    for (auto const& it : js.at("files").items()) {
+      res.files_[it.key()] = {it.value().at("hash").get<std::string>(),
+                              it.value().at("size").get<std::uintmax_t>(),
+                              it.value().at("mtime").get<std::time_t>()};
+    }
+    res.objects_ =
+        js.at("objects").get<std::map<std::string, std::string>>();
+    res.compression_ = js.at("compression").get<int>();
+  } catch (std::exception const&) {
+    return OutputManifest();
+  }
+  return res;
+}
+
+bool OutputManifest::IsCurrent(std::string const& file,
+                               std::string const& hash) const {
+  auto it = files_.find(file);
+  return it != files_.end() && it->second.hash == hash && IsUnmodified(file);
+}
+
+bool OutputManifest::IsUnmodified(std::string const& file) const {
+  auto it = files_.find(file);
+  if (it == files_.end()) return false;
+  boost::system::error_code ec;
+  std::uintmax_t size = boost::filesystem::file_size(file, ec);
+  if (ec || size != it->second.size) return false;
+  std::time_t mtime = boost::filesystem::last_write_time(file, ec);
+  return !ec && mtime == it->second.mtime;
+}
+
+void OutputManifest::Record(std::string const& file, std::string const& hash) {
+  files_[file] = {hash, boost::filesystem::file_size(file),
+                  boost::filesystem::last_write_time(file)};
+}
+
+void OutputManifest::SetObjects(
+    std::map<std::string, std::string> const& objects, int compression) {
+  objects_ = objects;
+  compression_ = compression;
+}
+
+void OutputManifest::Write(std::string const& root_file) const {
+  nlohmann::json js;
+  js["version"] = 1;
+  js["compression"] = compression_;
+  js["files"] = nlohmann::json::object();
+  for (auto const& it : files_) {
+    js["files"][it.first] = {{"hash", it.second.hash},
+                             {"size", it.second.size},
+                             {"mtime", it.second.mtime}};
+  }
+  js["objects"] = objects_;
+  // Write a temporary file first so that an interrupted write never leaves
+  // a manifest that doesn't match the outputs
+  std::string path = PathFor(root_file);
+  std::string tmp_path = path + ".tmp";
+  {
+    std::ofstream output(tmp_path);
+    if (!output.is_open()) {
+      throw std::runtime_error(FNERROR("Unable to create file: " + tmp_path));
+    }
+    output << js.dump(1) << "\n";
+  }
+  if (std::rename(tmp_path.c_str(), path.c_str()) != 0) {
+    throw std::runtime_error(FNERROR("Unable to create file: " + path));
+  }
+}
+
+std::vector<std::string> WriteDatacardsIncremental(
+    std::string const& root_file,
+    std::vector<std::pair<std::string, CombineHarvester *>> const& cards) {
+  OutputManifest previous = OutputManifest::Read(root_file);
+  OutputManifest current;
+  std::vector<std::string> written;
+
+  // Produce everything in memory first
+  TFileBatchWriter writer(nullptr);
+  std::vector<std::string> texts;
+  for (auto const& card : cards) {
+    std::ostringstream txt;
+    card.second->FormatDatacard(card.first, root_file, txt, writer);
+    texts.push_back(txt.str());
+  }
+
+  // The ROOT file is identified by the hashes of all of its objects
+  auto const& objects = writer.Hashes();
+  std::string objects_str;
+  for (auto const& obj : objects) {
+    objects_str += obj.first + " " + obj.second + "\n";
+  }
+  std::string root_hash = ContentHash(objects_str.data(), objects_str.size());
+  current.SetObjects(objects, writer.GetCompression());
+  // A file that was modified since the last write, or written with other
+  // compression settings, can't be updated in place
+  bool update = previous.IsUnmodified(root_file) &&
+                previous.compression() == writer.GetCompression();
+  if (!update || !previous.IsCurrent(root_file, root_hash)) {
+    TFile file(root_file.c_str(), update ? "UPDATE" : "RECREATE");
+    if (!file.IsOpen()) {
+      throw std::runtime_error(FNERROR("Unable to create file: " + root_file));
+    }
+    writer.SetFile(&file);
+    if (update) {
+      writer.Update(previous.objects());
+    } else {
+      writer.Write();
+    }
+    file.Close();
+    written.push_back(root_file);
+  }
+  current.Record(root_file, root_hash);
+
+  for (unsigned i = 0; i < cards.size(); ++i) {
+    std::string const& name = cards[i].first;
+    std::string hash = ContentHash(texts[i].data(), texts[i].size());
+    if (!previous.IsCurrent(name, hash)) {
+      std::unique_ptr<std::ostream> txt_file;
+      if (boost::algorithm::ends_with(name, ".gz")) {
+        txt_file = std::unique_ptr<std::ostream>(new zstr::ofstream(name));
+      } else {
+        txt_file = std::unique_ptr<std::ostream>(new std::ofstream(name));
+      }
+      if (txt_file->fail()) {
+        throw std::runtime_error(FNERROR("Unable to create file: " + name));
+      }
+      *txt_file << texts[i];
+      txt_file.reset();
+      written.push_back(name);
+    }
+    current.Record(name, hash);
+  }
+  current.Write(root_file);
+  return written;
+}
+}
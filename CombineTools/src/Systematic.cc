@@ -18,7 +18,8 @@ Systematic::Systematic()
       pdf_u_(nullptr),
       pdf_d_(nullptr),
       data_u_(nullptr),
-      data_d_(nullptr) {
+      data_d_(nullptr),
+      sparse_() {
   }
 
 Systematic::~Systematic() { }
@@ -38,6 +39,7 @@ void swap(Systematic& first, Systematic& second) {
   swap(first.pdf_d_, second.pdf_d_);
   swap(first.data_u_, second.data_u_);
   swap(first.data_d_, second.data_d_);
+  swap(first.sparse_, second.sparse_);
 }
 
 Systematic::Systematic(Systematic const& other)
@@ -51,7 +53,8 @@ Systematic::Systematic(Systematic const& other)
       pdf_u_(other.pdf_u_),
       pdf_d_(other.pdf_d_),
       data_u_(other.data_u_),
-      data_d_(other.data_d_) {
+      data_d_(other.data_d_),
+      sparse_(other.sparse_) {
   TH1 *h_u = nullptr;
   if (other.shape_u_) {
     h_u = dynamic_cast<TH1*>(other.shape_u_->Clone());
@@ -79,7 +82,8 @@ Systematic::Systematic(Systematic&& other)
       pdf_u_(nullptr),
       pdf_d_(nullptr),
       data_u_(nullptr),
-      data_d_(nullptr) {
+      data_d_(nullptr),
+      sparse_() {
   swap(*this, other);
 }
 
@@ -95,6 +99,7 @@ void Systematic::set_shapes(std::unique_ptr<TH1> shape_u,
     throw std::runtime_error(
         "shape_u and shape_d must be either both valid or both null");
   }
+  sparse_ = nullptr;
   if (!shape_u && !shape_d) {
     shape_u_ = nullptr;
     shape_d_ = nullptr;
@@ -144,6 +149,50 @@ void Systematic::set_shapes(TH1 const& shape_u, TH1 const& shape_d,
              &nominal);
 }
 
+void Systematic::set_sparse_shapes(std::shared_ptr<TH1 const> nominal,
+                                   int bin, double content_u,
+                                   double content_d) {
+  if (!nominal) {
+    throw std::runtime_error(FNERROR("nominal TH1 must not be null"));
+  }
+  if (bin < 1 || bin > nominal->GetNbinsX()) {
+    throw std::runtime_error(
+        FNERROR("bin " + std::to_string(bin) + " is out of range"));
+  }
+  shape_u_ = nullptr;
+  shape_d_ = nullptr;
+  sparse_ = std::make_shared<SparseShapes>();
+  sparse_->nominal = std::move(nominal);
+  sparse_->bin = bin;
+  sparse_->content_u = content_u;
+  sparse_->content_d = content_d;
+}
+
+std::unique_ptr<TH1> Systematic::SparseShapes::Build(bool up) const {
+  std::unique_ptr<TH1> res(static_cast<TH1 *>(nominal->Clone()));
+  res->SetDirectory(0);
+  res->SetBinContent(bin, up ? content_u : content_d);
+  if (res->Integral() > 0.) res->Scale(1. / res->Integral());
+  return res;
+}
+
+void Systematic::SparseShapes::Materialise() const {
+  std::call_once(once_, [&]() {
+    shape_u_ = Build(true);
+    shape_d_ = Build(false);
+  });
+}
+
+TH1 const* Systematic::SparseShapes::ShapeU() const {
+  Materialise();
+  return shape_u_.get();
+}
+
+TH1 const* Systematic::SparseShapes::ShapeD() const {
+  Materialise();
+  return shape_d_.get();
+}
+
 void Systematic::set_data(RooDataHist* data_u, RooDataHist* data_d,
                           RooDataHist const* nominal) {
   if (nominal && nominal->sumEntries() > 0.) {
@@ -161,6 +210,7 @@ void Systematic::set_pdf(RooAbsReal* pdf_u, RooAbsReal* pdf_d,
 }
 
 std::unique_ptr<TH1> Systematic::ClonedShapeU() const {
+  if (sparse_) return sparse_->Build(true);
   if (!shape_u_) return std::unique_ptr<TH1>();
   std::unique_ptr<TH1> res(static_cast<TH1 *>(shape_u_->Clone()));
   res->SetDirectory(0);
@@ -168,6 +218,7 @@ std::unique_ptr<TH1> Systematic::ClonedShapeU() const {
 }
 
 std::unique_ptr<TH1> Systematic::ClonedShapeD() const {
+  if (sparse_) return sparse_->Build(false);
   if (!shape_d_) return std::unique_ptr<TH1>();
   std::unique_ptr<TH1> res(static_cast<TH1 *>(shape_d_->Clone()));
   res->SetDirectory(0);
@@ -245,8 +296,8 @@ std::ostream& operator<< (std::ostream &out, Systematic const& val) {
   % val.name()
   % val.type()
   % value_fmt
-  % (bool(val.shape_d()) || bool(val.data_d()) || bool(val.pdf_d()))
-  % (bool(val.shape_u()) || bool(val.data_u()) || bool(val.pdf_u()));
+  % (val.has_shapes() || bool(val.data_d()) || bool(val.pdf_d()))
+  % (val.has_shapes() || bool(val.data_u()) || bool(val.pdf_u()));
   return out;
 }
 
@@ -259,5 +310,13 @@ void Systematic::SwapUpAndDown() {
       value_d_ = tmp;
   }
   shape_u_.swap(shape_d_);
+  if (sparse_) {
+    auto swapped = std::make_shared<SparseShapes>();
+    swapped->nominal = sparse_->nominal;
+    swapped->bin = sparse_->bin;
+    swapped->content_u = sparse_->content_d;
+    swapped->content_d = sparse_->content_u;
+    sparse_ = swapped;
+  }
 }
 }
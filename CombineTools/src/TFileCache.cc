@@ -0,0 +1,283 @@
+#include "CombineHarvester/CombineTools/interface/TFileCache.h"
+#include <algorithm>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <set>
+#include <string>
+#include <vector>
+#include <sys/stat.h>
+#include "TClass.h"
+#include "TDirectory.h"
+#include "TKey.h"
+#include "TROOT.h"
+#include "CombineHarvester/CombineTools/interface/Logging.h"
+#include "CombineHarvester/CombineTools/interface/TFileIO.h"
+#include "CombineHarvester/CombineTools/interface/ThreadPool.h"
+
+namespace {
+void FindTH1Keys(TDirectory* dir, std::string const& prefix,
+                 std::set<std::string>* keys) {
+  TIter next(dir->GetListOfKeys());
+  while (TKey* key = static_cast<TKey*>(next())) {
+    TClass* cl = TClass::GetClass(key->GetClassName());
+    if (!cl) continue;
+    std::string name = prefix + key->GetName();
+    if (cl->InheritsFrom(TDirectory::Class())) {
+      TDirectory* subdir = dir->GetDirectory(key->GetName());
+      if (subdir) FindTH1Keys(subdir, name + "/", keys);
+    } else if (cl->InheritsFrom(TH1::Class())) {
+      keys->insert(name);
+    }
+  }
+}
+}
+
+namespace ch {
+
+TFileCache& TFileCache::Instance() {
+  static TFileCache instance;
+  return instance;
+}
+
+bool TFileCache::FileStamp::operator==(FileStamp const& other) const {
+  return device == other.device && inode == other.inode &&
+         size == other.size && mtime_sec == other.mtime_sec &&
+         mtime_nsec == other.mtime_nsec;
+}
+
+TFileCache::FileStamp TFileCache::FileStatus(std::string const& path) {
+  // The modification time alone has a resolution of one second, so a file
+  // rewritten within the same second could otherwise be missed. Replacing
+  // the file, e.g. via a rename, changes the inode.
+  FileStamp stamp = {-1, -1, -1, -1, -1};
+  struct stat st;
+  if (::stat(path.c_str(), &st) != 0) return stamp;
+  stamp.device = st.st_dev;
+  stamp.inode = st.st_ino;
+  stamp.size = st.st_size;
+  stamp.mtime_sec = st.st_mtime;
+#if defined(__APPLE__)
+  stamp.mtime_nsec = st.st_mtimespec.tv_nsec;
+#else
+  stamp.mtime_nsec = st.st_mtim.tv_nsec;
+#endif
+  return stamp;
+}
+
+std::size_t TFileCache::HistBytes(TH1 const* hist) {
+  // Dominated by the bin contents and, if stored, the sums of squared
+  // weights, counted here as doubles
+  std::size_t per_cell = sizeof(double) * (hist->GetSumw2N() ? 2 : 1);
+  return hist->IsA()->Size() + per_cell * std::size_t(hist->GetNcells());
+}
+
+TFileCache::Entry& TFileCache::GetEntry(std::string const& path) {
+  FileStamp stamp = FileStatus(path);
+  auto it = files_.find(path);
+  if (it != files_.end()) {
+    if (it->second.stamp == stamp) return it->second;
+    EraseEntry(it);
+  }
+  Entry entry;
+  entry.file = std::make_shared<TFile>(path.c_str());
+  entry.io_mutex = std::make_shared<std::mutex>();
+  entry.stamp = stamp;
+  entry.listed = false;
+  if (!entry.file->IsOpen() || entry.file->IsZombie()) {
+    throw std::runtime_error(FNERROR("Unable to open file " + path));
+  }
+  paths_[entry.file.get()] = path;
+  return files_.emplace(path, std::move(entry)).first->second;
+}
+
+void TFileCache::EraseEntry(std::map<std::string, Entry>::iterator it) {
+  for (auto const& hist : it->second.hists) {
+    lru_.erase(hist.second.lru);
+    bytes_ -= hist.second.bytes;
+  }
+  paths_.erase(it->second.file.get());
+  files_.erase(it);
+}
+
+void TFileCache::InsertHist(std::string const& path, Entry& entry,
+                            std::string const& obj,
+                            std::shared_ptr<TH1 const> hist) {
+  if (max_bytes_ == 0 || entry.hists.count(obj)) return;
+  CachedHist cached;
+  cached.bytes = HistBytes(hist.get());
+  cached.hist = std::move(hist);
+  cached.lru = lru_.emplace(lru_.begin(), path, obj);
+  bytes_ += cached.bytes;
+  entry.hists.emplace(obj, std::move(cached));
+}
+
+void TFileCache::Evict() {
+  while (bytes_ > max_bytes_ && !lru_.empty()) {
+    auto const& key = lru_.back();
+    Entry& entry = files_.at(key.first);
+    auto it = entry.hists.find(key.second);
+    bytes_ -= it->second.bytes;
+    entry.hists.erase(it);
+    lru_.pop_back();
+  }
+}
+
+std::shared_ptr<TFile> TFileCache::GetFile(std::string const& path) {
+  std::lock_guard<std::mutex> lock(mutex_);
+  try {
+    return GetEntry(path).file;
+  } catch (std::runtime_error const&) {
+    // Leave the error handling to the caller, as for an unpooled TFile
+    return std::make_shared<TFile>(path.c_str());
+  }
+}
+
+std::unique_ptr<TH1> TFileCache::GetClonedTH1(TFile* file,
+                                              std::string const& path) {
+  if (!file) {
+    throw std::runtime_error(FNERROR("Supplied ROOT file pointer is null"));
+  }
+  std::shared_ptr<TH1 const> master;
+  std::shared_ptr<std::mutex> io_mutex;
+  {
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto p_it = paths_.find(file);
+    if (p_it != paths_.end()) {
+      Entry& entry = files_.at(p_it->second);
+      io_mutex = entry.io_mutex;
+      auto h_it = entry.hists.find(path);
+      if (h_it != entry.hists.end()) {
+        master = h_it->second.hist;
+        lru_.splice(lru_.begin(), lru_, h_it->second.lru);
+      }
+    }
+  }
+  // Not a handle from the pool
+  if (!io_mutex) return ch::GetClonedTH1(file, path);
+
+  if (!master) {
+    {
+      std::lock_guard<std::mutex> io_lock(*io_mutex);
+      master = std::shared_ptr<TH1 const>(ch::GetClonedTH1(file, path));
+    }
+    std::lock_guard<std::mutex> lock(mutex_);
+    auto p_it = paths_.find(file);
+    if (p_it != paths_.end()) {
+      InsertHist(p_it->second, files_.at(p_it->second), path, master);
+      Evict();
+    }
+  }
+  std::unique_ptr<TH1> res(static_cast<TH1*>(master->Clone()));
+  res->SetDirectory(nullptr);
+  return res;
+}
+
+std::vector<std::string> TFileCache::ListTH1Keys(std::string const& path) {
+  std::shared_ptr<TFile> file;
+  std::shared_ptr<std::mutex> io_mutex;
+  {
+    std::lock_guard<std::mutex> lock(mutex_);
+    Entry& entry = GetEntry(path);
+    if (entry.listed) return entry.th1_keys;
+    file = entry.file;
+    io_mutex = entry.io_mutex;
+  }
+  std::set<std::string> keys;
+  {
+    std::lock_guard<std::mutex> io_lock(*io_mutex);
+    FindTH1Keys(file.get(), "", &keys);
+  }
+  std::vector<std::string> res(keys.begin(), keys.end());
+  std::lock_guard<std::mutex> lock(mutex_);
+  auto it = files_.find(path);
+  if (it != files_.end() && it->second.file == file) {
+    it->second.th1_keys = res;
+    it->second.listed = true;
+  }
+  return res;
+}
+
+void TFileCache::Prefetch(std::string const& path,
+                          std::vector<std::string> const& objects,
+                          unsigned n_threads) {
+  std::shared_ptr<TFile> file;
+  std::vector<std::string> todo;
+  {
+    std::lock_guard<std::mutex> lock(mutex_);
+    Entry& entry = GetEntry(path);
+    file = entry.file;
+    for (auto const& obj : objects) {
+      if (!entry.hists.count(obj)) todo.push_back(obj);
+    }
+  }
+  if (todo.empty()) return;
+  if (n_threads > 1) ROOT::EnableThreadSafety();
+
+  // The worker threads read through their own handles, which are returned
+  // here after each task so that at most one is opened per thread
+  std::mutex handle_mutex;
+  std::vector<std::unique_ptr<TFile>> handles;
+  const unsigned task_size = 16;
+  unsigned n_tasks = (todo.size() + task_size - 1) / task_size;
+  ThreadPool pool(n_threads);
+  pool.ParallelFor(n_tasks, [&](unsigned task) {
+    std::unique_ptr<TFile> handle;
+    {
+      std::lock_guard<std::mutex> lock(handle_mutex);
+      if (!handles.empty()) {
+        handle = std::move(handles.back());
+        handles.pop_back();
+      }
+    }
+    if (!handle) {
+      handle.reset(TFile::Open(path.c_str()));
+      if (!handle || handle->IsZombie()) {
+        throw std::runtime_error(FNERROR("Unable to open file " + path));
+      }
+    }
+    std::vector<std::pair<std::string, std::shared_ptr<TH1 const>>> read;
+    unsigned end = std::min(unsigned(todo.size()), (task + 1) * task_size);
+    for (unsigned i = task * task_size; i < end; ++i) {
+      TH1* hist = dynamic_cast<TH1*>(handle->Get(todo[i].c_str()));
+      if (!hist) {
+        throw std::runtime_error(FNERROR("TH1 " + todo[i] + " not found in " +
+                                         path));
+      }
+      hist->SetDirectory(nullptr);
+      read.emplace_back(todo[i], std::shared_ptr<TH1 const>(hist));
+    }
+    {
+      std::lock_guard<std::mutex> lock(mutex_);
+      auto it = files_.find(path);
+      if (it != files_.end() && it->second.file == file) {
+        for (auto& entry : read) {
+          InsertHist(path, it->second, entry.first, entry.second);
+        }
+        Evict();
+      }
+    }
+    std::lock_guard<std::mutex> lock(handle_mutex);
+    handles.push_back(std::move(handle));
+  });
+}
+
+void TFileCache::Clear() {
+  std::lock_guard<std::mutex> lock(mutex_);
+  files_.clear();
+  paths_.clear();
+  lru_.clear();
+  bytes_ = 0;
+}
+
+void TFileCache::SetMaxBytes(std::size_t max_bytes) {
+  std::lock_guard<std::mutex> lock(mutex_);
+  max_bytes_ = max_bytes;
+  Evict();
+}
+
+std::size_t TFileCache::CachedBytes() {
+  std::lock_guard<std::mutex> lock(mutex_);
+  return bytes_;
+}
+}
@@ -5,7 +5,9 @@
 #include "TFile.h"
 #include "TH1.h"
 #include "TDirectory.h"
+#include "TBufferFile.h"
 #include "CombineHarvester/CombineTools/interface/Logging.h"
+#include "CombineHarvester/CombineTools/interface/Utilities.h"
 
 namespace ch {
 
@@ -35,4 +37,141 @@ std::unique_ptr<TH1> GetClonedTH1(TFile* file, std::string const& path) {
   gDirectory = backup_dir;
   return res;
 }
+
+TFileBatchWriter::TFileBatchWriter(TFile* file)
+    : file_(file), compression_(-1), buffer_size_(0) {}
+
+TFileBatchWriter& TFileBatchWriter::SetFile(TFile* file) {
+  file_ = file;
+  return *this;
+}
+
+TFileBatchWriter& TFileBatchWriter::SetCompression(int settings) {
+  compression_ = settings;
+  return *this;
+}
+
+TFileBatchWriter& TFileBatchWriter::SetBufferSize(int size) {
+  buffer_size_ = size;
+  return *this;
+}
+
+void TFileBatchWriter::Add(std::string const& path,
+                           std::unique_ptr<TH1> hist) {
+  Add(path, std::shared_ptr<TObject>(std::move(hist)));
+}
+
+void TFileBatchWriter::Add(std::string const& path,
+                           std::shared_ptr<TObject> obj) {
+  std::size_t slash = path.find_last_of('/');
+  std::string dir = slash == path.npos ? "" : path.substr(0, slash);
+  std::string name = slash == path.npos ? path : path.substr(slash + 1);
+  auto & dir_objects = objects_[dir];
+  if (dir_objects.count(name)) return;
+  dir_objects[name] = std::move(obj);
+  hashes_.clear();
+}
+
+unsigned TFileBatchWriter::size() const {
+  unsigned n = 0;
+  for (auto const& dir : objects_) n += dir.second.size();
+  return n;
+}
+
+std::map<std::string, std::string> const& TFileBatchWriter::Hashes() {
+  if (hashes_.size() == size()) return hashes_;
+  hashes_.clear();
+  for (auto & dir : objects_) {
+    for (auto & obj : dir.second) {
+      obj.second->SetName(obj.first.c_str());
+      TBufferFile buf(TBuffer::kWrite);
+      buf.WriteObjectAny(obj.second.get(), obj.second->IsA());
+      std::string path =
+          dir.first.size() ? dir.first + "/" + obj.first : obj.first;
+      hashes_[path] = ContentHash(buf.Buffer(), buf.Length());
+    }
+  }
+  return hashes_;
+}
+
+TDirectory* TFileBatchWriter::GetDirectory(std::string const& dir) {
+  TDirectory* target = file_;
+  std::vector<std::string> as_vec;
+  if (dir.size()) boost::split(as_vec, dir, boost::is_any_of("/"));
+  for (auto const& sub : as_vec) {
+    TDirectory* next = target->GetDirectory(sub.c_str());
+    if (!next) next = target->mkdir(sub.c_str());
+    target = next;
+  }
+  return target;
+}
+
+void TFileBatchWriter::WriteObjects(
+    std::function<bool(std::string const&)> const& overwrite) {
+  if (!file_) {
+    throw std::runtime_error(FNERROR("Supplied ROOT file pointer is null"));
+  }
+  TDirectory* backup_dir = gDirectory;
+  int file_compression = file_->GetCompressionSettings();
+  if (compression_ >= 0) file_->SetCompressionSettings(compression_);
+  for (auto & dir : objects_) {
+    // The directories are visited in sorted order, so a parent is always
+    // created before its subdirectories
+    TDirectory* target = GetDirectory(dir.first);
+    for (auto & obj : dir.second) {
+      if (target->FindKey(obj.first.c_str())) {
+        std::string path =
+            dir.first.size() ? dir.first + "/" + obj.first : obj.first;
+        if (!overwrite(path)) continue;
+        target->Delete((obj.first + ";*").c_str());
+      }
+      obj.second->SetName(obj.first.c_str());
+      target->WriteTObject(obj.second.get(), obj.first.c_str(), "",
+                           buffer_size_);
+    }
+  }
+  if (compression_ >= 0) file_->SetCompressionSettings(file_compression);
+  objects_.clear();
+  hashes_.clear();
+  gDirectory = backup_dir;
+}
+
+void TFileBatchWriter::Write() {
+  if (objects_.empty()) return;
+  WriteObjects([](std::string const&) { return false; });
+}
+
+void TFileBatchWriter::Update(
+    std::map<std::string, std::string> const& previous) {
+  if (!file_) {
+    throw std::runtime_error(FNERROR("Supplied ROOT file pointer is null"));
+  }
+  std::map<std::string, std::string> current = Hashes();
+  // Drop the objects that are already in the file as they are now
+  for (auto & dir : objects_) {
+    for (auto it = dir.second.begin(); it != dir.second.end();) {
+      std::string path =
+          dir.first.size() ? dir.first + "/" + it->first : it->first;
+      auto prev = previous.find(path);
+      if (prev != previous.end() && prev->second == current.at(path)) {
+        it = dir.second.erase(it);
+      } else {
+        ++it;
+      }
+    }
+  }
+  TDirectory* backup_dir = gDirectory;
+  for (auto const& prev : previous) {
+    if (current.count(prev.first)) continue;
+    std::size_t slash = prev.first.find_last_of('/');
+    std::string dir = slash == prev.first.npos ? "" : prev.first.substr(0, slash);
+    std::string name =
+        slash == prev.first.npos ? prev.first : prev.first.substr(slash + 1);
+    TDirectory* target =
+        dir.size() ? file_->GetDirectory(dir.c_str()) : file_;
+    if (target) target->Delete((name + ";*").c_str());
+  }
+  gDirectory = backup_dir;
+  WriteObjects([](std::string const&) { return true; });
+}
 }
@@ -0,0 +1,92 @@
+#include "CombineHarvester/CombineTools/interface/ThreadPool.h"
+#include <exception>
+#include <functional>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+namespace ch {
+
+ThreadPool::ThreadPool(unsigned n_threads)
+    : func_(nullptr),
+      n_tasks_(0),
+      next_(0),
+      active_(0),
+      epoch_(0),
+      stop_(false) {
+  for (unsigned i = 1; i < n_threads; ++i) {
+    workers_.emplace_back(&ThreadPool::WorkerLoop, this);
+  }
+}
+
+ThreadPool::~ThreadPool() {
+  {
+    std::lock_guard<std::mutex> lock(mutex_);
+    stop_ = true;
+  }
+  start_cv_.notify_all();
+  for (auto & worker : workers_) worker.join();
+}
+
+unsigned ThreadPool::HardwareThreads() {
+  unsigned n = std::thread::hardware_concurrency();
+  return n > 0 ? n : 1;
+}
+
+void ThreadPool::ParallelFor(unsigned n_tasks,
+                             std::function<void(unsigned)> const& func) {
+  if (workers_.empty() || n_tasks <= 1) {
+    for (unsigned i = 0; i < n_tasks; ++i) func(i);
+    return;
+  }
+  {
+    std::lock_guard<std::mutex> lock(mutex_);
+    func_ = &func;
+    n_tasks_ = n_tasks;
+    next_ = 0;
+    error_ = nullptr;
+    active_ = workers_.size();
+    ++epoch_;
+  }
+  start_cv_.notify_all();
+  RunTasks();
+  std::exception_ptr error;
+  {
+    std::unique_lock<std::mutex> lock(mutex_);
+    done_cv_.wait(lock, [&] { return active_ == 0; });
+    func_ = nullptr;
+    std::swap(error, error_);
+  }
+  if (error) std::rethrow_exception(error);
+}
+
+void ThreadPool::WorkerLoop() {
+  unsigned long seen = 0;
+  while (true) {
+    {
+      std::unique_lock<std::mutex> lock(mutex_);
+      start_cv_.wait(lock, [&] { return stop_ || epoch_ != seen; });
+      if (stop_) return;
+      seen = epoch_;
+    }
+    RunTasks();
+    {
+      std::lock_guard<std::mutex> lock(mutex_);
+      if (--active_ == 0) done_cv_.notify_one();
+    }
+  }
+}
+
+void ThreadPool::RunTasks() {
+  unsigned i;
+  while ((i = next_++) < n_tasks_) {
+    try {
+      (*func_)(i);
+    } catch (...) {
+      std::lock_guard<std::mutex> lock(mutex_);
+      if (!error_) error_ = std::current_exception();
+      next_ = n_tasks_;
+    }
+  }
+}
+}
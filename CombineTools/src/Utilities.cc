@@ -1,4 +1,5 @@
 #include "CombineHarvester/CombineTools/interface/Utilities.h"
+#include <cstdint>
 #include <iostream>
 #include <vector>
 #include <set>
@@ -353,4 +354,13 @@ void ZeroNegativeBins(TH1 *h) {
     }
   }
 }
+
+std::string ContentHash(char const* data, std::size_t size) {
+  uint64_t hash = 14695981039346656037ULL;
+  for (std::size_t i = 0; i < size; ++i) {
+    hash ^= static_cast<unsigned char>(data[i]);
+    hash *= 1099511628211ULL;
+  }
+  return (boost::format("%016x") % hash).str();
+}
 }
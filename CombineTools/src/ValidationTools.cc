@@ -12,6 +12,7 @@
 #include "RooAbsReal.h"
 #include "RooAbsData.h"
 #include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvesterView.h"
 
 namespace ch {
 using json = nlohmann::json;
@@ -176,7 +177,7 @@ void CheckEmptyBins(CombineHarvester& cb){
   TH1F tothist;
   auto bins = cb.bin_set();
   for(auto b : bins){
-    auto cb_bin_backgrounds = cb.cp().bin({b}).backgrounds();
+    auto cb_bin_backgrounds = cb.partition(b).backgrounds();
     tothist = cb_bin_backgrounds.GetShape();
     for(int i=1;i<=tothist.GetNbinsX();i++){
       if(tothist.GetBinContent(i)<=0){ 
@@ -190,7 +191,7 @@ void CheckEmptyBins(CombineHarvester& cb, json& jsobj){
   TH1F tothist;
   auto bins = cb.bin_set();
   for(auto b : bins){
-    auto cb_bin_backgrounds = cb.cp().bin({b}).backgrounds();
+    auto cb_bin_backgrounds = cb.partition(b).backgrounds();
     tothist = cb_bin_backgrounds.GetShape();
     for(int i=1;i<=tothist.GetNbinsX();i++){
       if(tothist.GetBinContent(i)<=0){ 
@@ -214,7 +215,7 @@ void CheckSizeOfShapeEffect(CombineHarvester& cb){
     if(sys->type()=="shape"){
       hist_u = sys->shape_u();
       hist_d = sys->shape_d();
-      hist_nom=cb.cp().bin({sys->bin()}).process({sys->process()}).GetShape();
+      hist_nom=cb.partition(sys->bin()).process({sys->process()}).GetShape();
       hist_nom.Scale(1./hist_nom.Integral());
       double up_diff=0;
       double down_diff=0;
@@ -244,7 +245,7 @@ void CheckSizeOfShapeEffect(CombineHarvester& cb, json& jsobj){
     if(sys->type()=="shape"){
       hist_u = sys->shape_u();
       hist_d = sys->shape_d();
-      hist_nom=cb.cp().bin({sys->bin()}).process({sys->process()}).GetShape();
+      hist_nom=cb.partition(sys->bin()).process({sys->process()}).GetShape();
       hist_nom.Scale(1./hist_nom.Integral());
       double up_diff=0;
       double down_diff=0;
@@ -264,9 +265,9 @@ void CheckSizeOfShapeEffect(CombineHarvester& cb, json& jsobj){
 void CheckSmallSignals(CombineHarvester& cb,double minSigFrac){
   auto bins = cb.bin_set();
   for(auto b : bins){
-    auto cb_bin_signals = cb.cp().bin({b}).signals();
-    auto cb_bin_backgrounds = cb.cp().bin({b}).backgrounds();
-    auto cb_bin = cb.cp().bin({b}); 
+    auto cb_bin_signals = cb.partition(b).signals();
+    auto cb_bin_backgrounds = cb.partition(b).backgrounds();
+    auto cb_bin = cb.partition(b); 
     double sigrate = cb_bin_signals.GetRate();
     for(auto p : cb_bin_signals.process_set()){
       if(cb_bin_signals.cp().process({p}).GetRate() < minSigFrac*sigrate){
@@ -280,9 +281,9 @@ void CheckSmallSignals(CombineHarvester& cb,double minSigFrac){
 void CheckSmallSignals(CombineHarvester& cb, double minSigFrac, json& jsobj){
   auto bins = cb.bin_set();
   for(auto b : bins){
-    auto cb_bin_signals = cb.cp().bin({b}).signals();
-    auto cb_bin_backgrounds = cb.cp().bin({b}).backgrounds();
-    auto cb_bin = cb.cp().bin({b}); 
+    auto cb_bin_signals = cb.partition(b).signals();
+    auto cb_bin_backgrounds = cb.partition(b).backgrounds();
+    auto cb_bin = cb.partition(b); 
     double sigrate = cb_bin_signals.GetRate();
     for(auto p : cb_bin_signals.process_set()){
       if(cb_bin_signals.cp().process({p}).GetRate() < minSigFrac*sigrate){
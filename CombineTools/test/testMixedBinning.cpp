@@ -0,0 +1,90 @@
+#include <string>
+#include <vector>
+#include <cmath>
+#include <iostream>
+#include "TH1F.h"
+#include "TH2F.h"
+#include "RooRealVar.h"
+#include "RooArgList.h"
+#include "RooFitResult.h"
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/EvaluationPlan.h"
+#include "CombineHarvester/CombineTools/interface/Systematics.h"
+
+// Checks that the rate-only evaluation methods work when the bins of an
+// instance have templates with different binnings, as in a yield table
+// spanning several categories. Run with "scram b runtests".
+
+namespace {
+int n_failed = 0;
+
+void Check(bool pass, std::string const& what) {
+  if (!pass) {
+    std::cout << "FAILED: " << what << "\n";
+    ++n_failed;
+  }
+}
+
+bool Near(double a, double b, double rel) {
+  return std::fabs(a - b) <= rel * std::fabs(b);
+}
+}
+
+int main() {
+  using ch::syst::SystMap;
+  ch::CombineHarvester cb;
+  cb.SetVerbosity(0);
+  ch::Categories cats = {{0, "b1"}, {1, "b2"}};
+  cb.AddProcesses({"*"}, {"ana"}, {"13TeV"}, {"ch"}, {"bkg"}, cats, false);
+  cb.ForEachProc([](ch::Process *p) {
+    int n_bins = p->bin() == "b1" ? 3 : 5;
+    TH1F h("h", "h", n_bins, 0., 1.);
+    for (int b = 1; b <= n_bins; ++b) h.SetBinContent(b, 10. * b);
+    p->set_shape(h, true);
+  });
+  cb.cp().AddSyst(cb, "lumi", "lnN", SystMap<>::init(1.1));
+  double rate = cb.GetRate();
+  Check(std::fabs(rate - 210.) < 1E-6, "rate");
+
+  Check(!ch::EvaluationPlan::CanCompile(cb), "shape plan with mixed binning");
+  Check(ch::EvaluationPlan::CanCompile(cb, true), "rate plan");
+  Check(ch::EvaluationPlan::CanCompile(cb.cp().bin({"b2"})),
+        "shape plan for a single bin");
+
+  ch::EvaluationPlan plan(cb, true);
+  Check(plan.NumBins() == 0, "rate-only plan has no bins");
+  Check(std::fabs(plan.GetRate(plan.CurrentValues(cb)) - rate) < 1E-6,
+        "rate-only plan rate");
+
+  RooRealVar lumi("lumi", "lumi", 0., -7., 7.);
+  lumi.setError(1.);
+  RooFitResult *fit = RooFitResult::prefitResult(RooArgList(lumi));
+
+  // The sampled uncertainty should agree with the +/- 1 sigma variation
+  // within the difference between the two definitions and the sampling
+  // precision
+  double err = cb.GetUncertainty();
+  for (unsigned threads : {0, 2}) {
+    std::string label = " with " + std::to_string(threads) + " threads";
+    cb.SetSamplingThreads(threads, 1234);
+    Check(Near(cb.GetUncertainty(*fit, 20000), err, 0.05),
+          "sampled uncertainty" + label);
+    TH2F cov = cb.GetRateCovariance(*fit, 20000);
+    Check(cov.GetNbinsX() == 2, "covariance size" + label);
+    // Both processes scale with lumi, so they are fully correlated
+    double v1 = cov.GetBinContent(1, 2), v2 = cov.GetBinContent(2, 1);
+    double c12 = cov.GetBinContent(2, 2);
+    Check(Near(std::sqrt(v1), err * 60. / 210., 0.05), "b1 variance" + label);
+    Check(Near(std::sqrt(v2), err * 150. / 210., 0.05), "b2 variance" + label);
+    Check(Near(c12, std::sqrt(v1 * v2), 1E-3), "b1-b2 covariance" + label);
+  }
+
+  std::vector<double> rates = cb.GetRates({"lumi"}, {0., 1.});
+  Check(rates.size() == 2 && std::fabs(rates[0] - rate) < 1E-6 &&
+            std::fabs(rates[1] - 1.1 * rate) < 1E-6,
+        "GetRates");
+
+  delete fit;
+  if (n_failed) std::cout << n_failed << " check(s) failed\n";
+  return n_failed ? 1 : 0;
+}
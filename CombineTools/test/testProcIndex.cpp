@@ -0,0 +1,121 @@
+#include <string>
+#include <vector>
+#include <thread>
+#include <cmath>
+#include <iostream>
+#include "CombineHarvester/CombineTools/interface/CombineHarvester.h"
+#include "CombineHarvester/CombineTools/interface/Systematics.h"
+
+// Checks that the Process -> Systematic matching used by GetRate and
+// GetUncertainty is correct for shallow copies that are filtered or extended,
+// and when it is used from several threads. Run with "scram b runtests".
+
+namespace {
+int n_failed = 0;
+
+void Check(bool pass, std::string const& what) {
+  if (!pass) {
+    std::cout << "FAILED: " << what << "\n";
+    ++n_failed;
+  }
+}
+
+bool Close(double a, double b) {
+  return std::fabs(a - b) <= 1E-9 * std::max(1.0, std::fabs(b));
+}
+
+// The uncertainty on a rate from an lnN systematic of size kappa when the
+// parameter is varied by +/- 1
+double LnNError(double rate, double kappa) {
+  return rate * (kappa - 1. / kappa) / 2.;
+}
+}
+
+int main() {
+  using ch::syst::SystMap;
+  ch::CombineHarvester cb;
+  cb.SetVerbosity(0);
+  ch::Categories cats = {{0, "b1"}, {1, "b2"}};
+  cb.AddProcesses({"*"}, {"ana"}, {"13TeV"}, {"ch"}, {"sig"}, cats, true);
+  cb.AddProcesses({"*"}, {"ana"}, {"13TeV"}, {"ch"}, {"bkg"}, cats, false);
+  cb.ForEachProc([](ch::Process *p) {
+    p->set_rate((p->signal() ? 10. : 100.) * (p->bin() == "b1" ? 1. : 2.));
+  });
+  cb.cp().AddSyst(cb, "lumi", "lnN", SystMap<>::init(1.1));
+  cb.cp().bin({"b1"}).signals().AddSyst(cb, "sig_b1", "lnN",
+                                          SystMap<>::init(1.2));
+
+  double rate = cb.GetRate();
+  double err = cb.GetUncertainty();
+  double lumi_err = LnNError(330., 1.1);
+  Check(Close(rate, 330.), "original rate");
+  Check(Close(err, std::sqrt(lumi_err * lumi_err +
+                             std::pow(LnNError(10., 1.2), 2))),
+        "original uncertainty");
+
+  {
+    // A filtered copy only sees its own entries...
+    ch::CombineHarvester b2 = cb.cp().bin({"b2"});
+    Check(Close(b2.GetRate(), 220.), "filtered copy rate");
+    Check(Close(b2.GetUncertainty(), LnNError(220., 1.1)),
+          "filtered copy uncertainty");
+    // ...and filtering it further after it has been used is picked up
+    b2.process({"bkg"});
+    Check(Close(b2.GetRate(), 200.), "refiltered copy rate");
+    Check(Close(b2.GetUncertainty(), LnNError(200., 1.1)),
+          "refiltered copy uncertainty");
+  }
+
+  // The original is unaffected by the copies, including ones that have since
+  // been destroyed
+  Check(Close(cb.GetRate(), rate), "original rate after copy");
+  Check(Close(cb.GetUncertainty(), err), "original uncertainty after copy");
+
+  {
+    // A copy that is used, then filtered and extended with a new Process
+    ch::CombineHarvester cpy = cb.cp();
+    cpy.GetUncertainty();
+    cpy.FilterProcs([](ch::Process *p) { return p->signal(); });
+    cb.cp().bin({"b1"}).signals().ForEachProc([&](ch::Process *p) {
+      cpy.InsertProcess(*p);
+    });
+    Check(Close(cpy.GetRate(), 310.), "extended copy rate");
+    Check(Close(cpy.GetUncertainty(),
+                std::sqrt(std::pow(LnNError(310., 1.1), 2) +
+                          std::pow(LnNError(10., 1.2), 2))),
+          "extended copy uncertainty");
+  }
+
+  // Modifying a Process is picked up by every instance that contains it: move
+  // the b2 signal into b1, where it matches the b1 systematics instead
+  cb.cp().bin({"b2"}).signals().ForEachProc([](ch::Process *p) {
+    p->set_bin("b1");
+    p->set_bin_id(0);
+  });
+  err = std::sqrt(lumi_err * lumi_err + std::pow(LnNError(30., 1.2), 2));
+  Check(Close(cb.cp().bin({"b1"}).GetUncertainty(),
+              std::sqrt(std::pow(LnNError(130., 1.1), 2) +
+                        std::pow(LnNError(30., 1.2), 2))),
+        "copy uncertainty after set_bin");
+  Check(Close(cb.GetUncertainty(), err), "original uncertainty after set_bin");
+
+  // Several threads using the same instance and copies of it
+  std::vector<std::thread> threads;
+  std::vector<double> results(8, 0.);
+  for (unsigned t = 0; t < results.size(); ++t) {
+    threads.emplace_back([&, t]() {
+      for (unsigned i = 0; i < 50; ++i) {
+        results[t] = (t % 2) ? cb.GetUncertainty()
+                             : cb.cp().bin({"b2"}).GetUncertainty();
+      }
+    });
+  }
+  for (auto & thread : threads) thread.join();
+  for (unsigned t = 0; t < results.size(); ++t) {
+    Check(Close(results[t], (t % 2) ? err : LnNError(200., 1.1)),
+          "uncertainty from thread " + std::to_string(t));
+  }
+
+  if (n_failed) std::cout << n_failed << " check(s) failed\n";
+  return n_failed ? 1 : 0;
+}
@@ -0,0 +1,66 @@
+#include <string>
+#include <memory>
+#include <cstdio>
+#include <iostream>
+#include "TFile.h"
+#include "TH1F.h"
+#include "CombineHarvester/CombineTools/interface/TFileCache.h"
+
+// Checks that the TFileCache keeps the cached histograms within its memory
+// limit and notices a file that is rewritten within the same second. Run
+// with "scram b runtests".
+
+namespace {
+int n_failed = 0;
+
+void Check(bool pass, std::string const& what) {
+  if (!pass) {
+    std::cout << "FAILED: " << what << "\n";
+    ++n_failed;
+  }
+}
+
+void WriteFile(std::string const& path, double content) {
+  TFile f(path.c_str(), "RECREATE");
+  for (std::string name : {"h1", "h2", "h3"}) {
+    TH1F h(name.c_str(), name.c_str(), 1000, 0., 1.);
+    h.SetBinContent(1, content);
+    h.Write();
+  }
+  f.Close();
+}
+}
+
+int main() {
+  std::string path = "testTFileCache.root";
+  ch::TFileCache & cache = ch::TFileCache::Instance();
+  cache.Clear();
+  WriteFile(path, 1.);
+
+  // Room for two of the three histograms
+  cache.SetMaxBytes(2 * 1002 * sizeof(double) + 4096);
+  auto file = cache.GetFile(path);
+  for (std::string name : {"h1", "h2", "h3", "h1", "h3"}) {
+    auto h = cache.GetClonedTH1(file.get(), name);
+    Check(h && h->GetBinContent(1) == 1., "content of " + name);
+    Check(cache.CachedBytes() <= 2 * 1002 * sizeof(double) + 4096,
+          "cache size after reading " + name);
+  }
+  Check(cache.CachedBytes() > 0, "histograms are cached");
+
+  // Rewrite the file straight away, so that the modification time is very
+  // likely to be in the same second
+  WriteFile(path, 2.);
+  auto new_file = cache.GetFile(path);
+  Check(new_file != file, "rewritten file is reopened");
+  auto h = cache.GetClonedTH1(new_file.get(), "h1");
+  Check(h && h->GetBinContent(1) == 2., "content of the rewritten file");
+
+  cache.SetMaxBytes(0);
+  Check(cache.CachedBytes() == 0, "setting the limit to zero empties the cache");
+
+  cache.Clear();
+  std::remove(path.c_str());
+  if (n_failed) std::cout << n_failed << " check(s) failed\n";
+  return n_failed ? 1 : 0;
+}
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Checks that a MultiDimFit grid scan of a nuisance parameter, run by the
+workers as a Task, writes the scanned parameter to the limit tree as combine
+does. Run with "scram b runtests".
+"""
+
+import os
+import sys
+
+import ROOT
+from CombineHarvester.CombineTools.combine.WorkerFits import command_task, grid_points
+
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+ROOT.gROOT.SetBatch(ROOT.kTRUE)
+
+n_failed = 0
+
+
+def check(passed, what):
+    global n_failed
+    if not passed:
+        print 'FAILED: %s' % what
+        n_failed += 1
+
+
+def write_workspace(path):
+    # A counting experiment with one constrained nuisance parameter
+    w = ROOT.RooWorkspace('w')
+    w.factory('r[1,0,5]')
+    w.factory('nuis[0,-4,4]')
+    w.factory('nuis_In[0]')
+    w.factory('expr::mu("10*@0*(1+0.2*@1)+5", r, nuis)')
+    w.factory('Poisson::main(n[17,0,100], mu)')
+    w.factory('Gaussian::nuis_pdf(nuis_In, nuis, 1)')
+    w.factory('PROD::model(main, nuis_pdf)')
+    mc = ROOT.RooStats.ModelConfig('ModelConfig', w)
+    mc.SetPdf('model')
+    mc.SetParametersOfInterest('r')
+    mc.SetNuisanceParameters('nuis')
+    mc.SetObservables('n')
+    getattr(w, 'import')(mc)
+    data = ROOT.RooDataSet('data_obs', '', ROOT.RooArgSet(w.var('n')))
+    data.add(ROOT.RooArgSet(w.var('n')))
+    getattr(w, 'import')(data)
+    w.writeToFile(path)
+
+
+def main():
+    path = 'testWorkerFits.root'
+    write_workspace(path)
+    task = command_task('combine -M MultiDimFit --algo grid -d %s --redefineSignalPOIs r '
+                        '-P nuis --floatOtherPOIs 1 --points 5 -n .testWorkerFits' % path)
+    check(task is not None and task.function == 'grid_fit', 'the scan is converted to a Task')
+    if task is None:
+        return 1
+    output = 'higgsCombine.testWorkerFits.MultiDimFit.mH120.root'
+    check(task.run() == 5, 'number of scan points')
+
+    fin = ROOT.TFile(output)
+    tree = fin.Get('limit')
+    for branch in ['r', 'nuis', 'deltaNLL', 'quantileExpected']:
+        check(tree.GetBranch(branch) != None, 'branch %s in the limit tree' % branch)
+    check(tree.GetEntries() == 6, 'the initial fit and the scan points are written')
+    expected = grid_points([(-4., 4.)], 5, 0, 4)
+    for i in xrange(tree.GetEntries()):
+        tree.GetEntry(i)
+        if i == 0:
+            check(tree.quantileExpected == 1. and tree.deltaNLL == 0., 'initial fit entry')
+            continue
+        check(abs(tree.nuis - expected[i - 1][0]) < 1E-4, 'value of nuis at point %i' % (i - 1))
+        check(tree.deltaNLL > -1E-3, 'deltaNLL at point %i' % (i - 1))
+        # One scanned parameter, so one degree of freedom
+        cl = ROOT.Math.chisquared_cdf_c(max(0., 2. * tree.deltaNLL), 1)
+        check(abs(tree.quantileExpected - cl) < 1E-4, 'quantileExpected at point %i' % (i - 1))
+    fin.Close()
+
+    os.remove(output)
+    os.remove(path)
+    if n_failed:
+        print '%i check(s) failed' % n_failed
+    return 1 if n_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())